@@ -0,0 +1,112 @@
+"""
+Expiration derived document fields: recomputed for every ticker
+document with the previous per day loop vs dh.expr_time_context
+(once per expiration / sweep, market seconds from the MarketCalendar
+index)
+
+python -m benchmarks.expr_time_context [expiration] [tickers] [sweeps]
+
+Needs redis, market hours are fetched from the API on the first run.
+Both paths read market hours through the in process cache, so the
+baseline is the loop itself rather than a redis round trip per day
+"""
+
+from config import config  # pylint: disable=wrong-import-order,unused-import
+
+import sys
+import time
+from datetime import datetime, timedelta
+
+import dateutil.parser
+import pytz
+
+import helpers.date_helpers as dh
+
+#################
+# PREVIOUS PATH #
+#################
+
+# copy of the per day loop market_seconds_until_expr ran before the
+# MarketCalendar index, kept here as the baseline. Only timings are
+# compared: it miscounts some ranges not starting on a session
+# (e.g. friday after the close to the next friday)
+
+
+def _market_seconds_in_day(iso_date):
+    if not dh.is_market_open_on(iso_date):
+        return 0
+
+    res = dh.get_market_hours(iso_date)
+    t0 = dateutil.parser.isoparse(res["opens_at"])
+    tf = dateutil.parser.isoparse(res["closes_at"])
+
+    if t0 and tf:
+        return (tf - t0).seconds
+
+    return 0
+
+
+def _market_seconds_between(dt_from, dt_to):
+    dt_from = dt_from.replace(tzinfo=pytz.UTC)
+    dt_to = dt_to.replace(tzinfo=pytz.UTC)
+
+    if dt_from > dt_to:
+        return 0
+
+    seconds = 0
+    open_dt = dh.market_opens_at(dt_from.date().isoformat())
+    close_dt = dh.market_closes_at(dt_to.date().isoformat())
+    for d in (dt_from + timedelta(n) for n in range((dt_to - dt_from).days + 1)):
+        market_seconds = _market_seconds_in_day(d.date().isoformat())
+        if market_seconds == 0:
+            continue
+        if d.day == dt_from.day and dt_from > open_dt:
+            seconds -= min([market_seconds, (dt_from - open_dt).seconds])
+        if d.day == dt_to.day and dt_to < close_dt:
+            seconds -= min([market_seconds, (close_dt - dt_to).seconds])
+        seconds += market_seconds
+
+    return seconds
+
+
+def per_document(expr, timestamp, tickers):
+    for _ in range(tickers):
+        dt = datetime.utcfromtimestamp(timestamp)
+        dh.absolute_seconds_between(dt, dh.market_closes_at(expr))
+        _market_seconds_between(dt, dh.market_closes_at(expr))
+
+
+################
+# CURRENT PATH #
+################
+
+
+def per_sweep(expr, timestamp, tickers):
+    for _ in range(tickers):
+        dh.expr_time_context(expr, timestamp)
+
+
+def timed(func, expr, tickers, sweeps):
+    """
+    seconds per document
+    """
+    start = int(time.time())
+    t0 = time.perf_counter()
+    for sweep in range(sweeps):
+        func(expr, start + sweep, tickers)
+    return (time.perf_counter() - t0) / (tickers * sweeps)
+
+
+if __name__ == "__main__":
+    expr = sys.argv[1] if len(sys.argv) > 1 else dh.current_expr()
+    tickers = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    sweeps = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    # market hours / calendar index loaded outside the timings
+    per_document(expr, int(time.time()), 1)
+
+    before = timed(per_document, expr, tickers, sweeps)
+    after = timed(per_sweep, expr, tickers, sweeps)
+    print(f"{expr}: {tickers} tickers x {sweeps} sweeps")
+    print(f"per document: {before * 1e6:,.1f} us")
+    print(f"per sweep:    {after * 1e6:,.1f} us ({before / after:,.0f}x)")
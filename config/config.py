@@ -1,15 +1,19 @@
 # pylint: skip-file
 # TODO: migrate constants to config
+import atexit
 import os
-import yaml
 
 
 def parse_yaml_vendors():
+    import yaml
+
     with open("config/vendors.yml", "r") as f:
         return yaml.safe_load(f)
 
 
 def parse_yaml_settings():
+    import yaml
+
     with open("config/settings.yml", "r") as f:
         return yaml.safe_load(f)
 
@@ -26,92 +30,304 @@ class DictAsMember(dict):
         return value
 
 
-conf = DictAsMember(parse_yaml_settings() | parse_yaml_vendors())
+##########################
+# LAZY MODULE ATTRIBUTES #
+##########################
+
+# conf / version / namespace / crypto_tickers / anomalies are
+# loaded on first access (see __getattr__), so importing config
+# doesn't parse YAML until something actually reads a setting
+
+
+def _load_conf():
+    return DictAsMember(parse_yaml_settings() | parse_yaml_vendors())
+
+
+def _load_crypto_tickers():
+    # deduplicated, in settings order
+    return list(dict.fromkeys(_get("conf").tickers))
+
+
+_LAZY_ATTRIBUTES = {
+    "conf": _load_conf,
+    "version": lambda: _get("conf").version,
+    "namespace": lambda: _get("conf").namespace,
+    "crypto_tickers": _load_crypto_tickers,
+    "anomalies": lambda: _get("conf").get("anomalies", {}),
+}
+
+
+def _get(name):
+    if name not in globals():
+        globals()[name] = _LAZY_ATTRIBUTES[name]()
+    return globals()[name]
+
+
+def _conf():
+    return _get("conf")
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return _get(name)
+
+
+def get_setting(*path, default=None):
+    """
+    conf value at path (e.g. "storage", "mode"), default if missing
+    """
+    value = _conf()
+    for key in path:
+        if not isinstance(value, dict) or value.get(key) is None:
+            return default
+        value = value[key]
+    return value
+
+
+class LazyAttribute:
+    """
+    Class attribute computed by load() on every access, so classes
+    can be defined (modules imported) before settings are loaded.
+    Instances / monkeypatching can still assign over it
+    """
+
+    def __init__(self, load):
+        self.load = load
+
+    def __get__(self, obj, objtype=None):
+        return self.load()
+
+
+def setting(*path, default=None):
+    """
+    LazyAttribute reading get_setting(*path, default=default)
+    """
+    return LazyAttribute(lambda: get_setting(*path, default=default))
+
+
+###############################
+# PER PROCESS CLIENTS / POOLS #
+###############################
+
+# Clients are created on first use and reused for the life of the
+# process. Forked children (rq work horses, gunicorn workers) start
+# with an empty registry so they never share sockets with the parent
+_clients = {}
+_mongo_pool_events = {}
+
 
-version = conf.version
-namespace = conf.namespace
+def _reset_after_fork():
+    _clients.clear()
+    _mongo_pool_events.clear()
 
-crypto_tickers = []
-tmp_set = set()
-for ticker in conf.tickers:
-    if ticker not in tmp_set:
-        tmp_set.add(ticker)
-        crypto_tickers.append(ticker)
 
-anomalies = conf.get("anomalies", {})
+os.register_at_fork(after_in_child=_reset_after_fork)
 
 
-if conf.get("redis"):
+def _per_process(name, factory):
+    if name not in _clients:
+        _clients[name] = factory()
+    return _clients[name]
+
+
+def _redis_pool(decode_responses):
     import redis as r
 
-    redis_host = conf.redis.host
-    redis_port = conf.redis.port
-    redis_password = conf.redis.get("password")
-
-    if redis_password:
-        redis_cli = r.Redis(
-            host=redis_host,
-            port=redis_port,
-            password=redis_password,
-            decode_responses=True,
-        )
-        redis_worker = r.Redis(
-            host=redis_host,
-            port=redis_port,
-            password=redis_password,
-            decode_responses=False,
-        )
-    else:
-        redis_cli = r.Redis(host=redis_host, port=redis_port, decode_responses=True)
-        redis_worker = r.Redis(
-            host=redis_host,
-            port=redis_port,
-            decode_responses=False,
-        )
+    class CountingConnectionPool(r.ConnectionPool):
+        """
+        Counts connections made / checked out / released, the
+        redis counterpart of the mongo pool listener
+        """
+
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.events = {}
+
+        def count(self, event_name):
+            self.events[event_name] = self.events.get(event_name, 0) + 1
+
+        def make_connection(self):
+            self.count("connection_created")
+            return super().make_connection()
+
+        def get_connection(self, *args, **kwargs):
+            connection = super().get_connection(*args, **kwargs)
+            self.count("connection_checked_out")
+            return connection
+
+        def release(self, connection):
+            self.count("connection_checked_in")
+            return super().release(connection)
+
+    return CountingConnectionPool(
+        host=_conf().redis.host,
+        port=_conf().redis.port,
+        password=_conf().redis.get("password"),
+        decode_responses=decode_responses,
+        max_connections=_conf().redis.get("max_connections", 50),
+    )
 
 
 def redis_client(decode_responses=True):
-    if not conf.get("redis"):
+    if not _conf().get("redis"):
         return None
 
-    if decode_responses:
-        return redis_cli
+    import redis as r
 
-    return redis_worker
+    # decode_responses is a connection option so each mode gets its own pool
+    name = "redis_cli" if decode_responses else "redis_worker"
+    return _per_process(
+        name, lambda: r.Redis(connection_pool=_redis_pool(decode_responses))
+    )
 
 
-def mongo_client():
-    if not conf.get("mongo"):
-        return None
+class _LazyClient:
+    """
+    Module level stand-in for a client: every attribute access
+    resolves the current process' client, so it's only created on
+    first use and never shared with forked children
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __getattr__(self, name):
+        return getattr(self._factory(), name)
+
+
+def lazy_redis_client(decode_responses=True):
+    """
+    redis_client() for module level `r = ...` assignments
+    """
+    return _LazyClient(lambda: redis_client(decode_responses))
+
+
+def _mongo_pool_listener():
+    from pymongo import monitoring
+
+    def count(event_name):
+        _mongo_pool_events[event_name] = _mongo_pool_events.get(event_name, 0) + 1
+
+    class PoolStatsListener(monitoring.ConnectionPoolListener):
+        def pool_created(self, event):
+            count("pool_created")
+
+        def pool_ready(self, event):
+            count("pool_ready")
+
+        def pool_cleared(self, event):
+            count("pool_cleared")
+
+        def pool_closed(self, event):
+            count("pool_closed")
+
+        def connection_created(self, event):
+            count("connection_created")
+
+        def connection_ready(self, event):
+            count("connection_ready")
+
+        def connection_closed(self, event):
+            count("connection_closed")
+
+        def connection_check_out_started(self, event):
+            count("connection_check_out_started")
+
+        def connection_check_out_failed(self, event):
+            count("connection_check_out_failed")
+
+        def connection_checked_out(self, event):
+            count("connection_checked_out")
 
+        def connection_checked_in(self, event):
+            count("connection_checked_in")
+
+    return PoolStatsListener()
+
+
+def _mongo_client():
     import pymongo
 
-    mongo_username = conf.mongo.get("username")
-    mongo_password = conf.mongo.get("password")
-    mongo_auth_source = conf.mongo.get("auth_source")
+    mongo_username = _conf().mongo.get("username")
+    mongo_password = _conf().mongo.get("password")
+    mongo_auth_source = _conf().mongo.get("auth_source")
 
+    options = {
+        "maxPoolSize": _conf().mongo.get("max_pool_size", 10),
+        "event_listeners": [_mongo_pool_listener()],
+    }
     if mongo_username and mongo_password and mongo_auth_source:
-        mongo_cli = pymongo.MongoClient(
-            conf.mongo.host,
-            conf.mongo.port,
-            username=mongo_username,
-            password=mongo_password,
-            authSource=mongo_auth_source,
-        )
-    else:
-        mongo_cli = pymongo.MongoClient(
-            conf.mongo.host,
-            conf.mongo.port,
-        )
-
-    return mongo_cli
+        options |= {
+            "username": mongo_username,
+            "password": mongo_password,
+            "authSource": mongo_auth_source,
+        }
+
+    return pymongo.MongoClient(_conf().mongo.host, _conf().mongo.port, **options)
+
+
+def mongo_client():
+    """
+    Shared per process client, don't close() it
+    """
+    if not _conf().get("mongo"):
+        return None
+    return _per_process("mongo", _mongo_client)
 
 
 def mongo_db():
-    if not conf.get("mongo"):
+    if not _conf().get("mongo"):
         return None
-    return mongo_client()[conf.mongo.database]
+    return mongo_client()[_conf().mongo.database]
+
+
+def close_clients():
+    """
+    Closes this process' clients on interpreter exit (gunicorn /
+    rq workers shutting down). Forked children skip it (os._exit),
+    their sockets are closed with the process
+    """
+    if mongo := _clients.get("mongo"):
+        mongo.close()
+    for name in ("redis_cli", "redis_worker"):
+        if redis := _clients.get(name):
+            redis.connection_pool.disconnect()
+    _clients.clear()
+
+
+atexit.register(close_clients)
+
+
+def pool_stats():
+    res = {"pid": os.getpid()}
+
+    for name in ("redis_cli", "redis_worker"):
+        if not (redis := _clients.get(name)):
+            continue
+        pool = redis.connection_pool
+        events = dict(pool.events)
+        res[name] = {
+            "max_connections": pool.max_connections,
+            "created": events.get("connection_created", 0),
+            "in_use": events.get("connection_checked_out", 0)
+            - events.get("connection_checked_in", 0),
+            "events": events,
+        }
+
+    if "mongo" in _clients:
+        events = dict(_mongo_pool_events)
+        res["mongo"] = {
+            "max_pool_size": _conf().mongo.get("max_pool_size", 10),
+            "open": events.get("connection_created", 0)
+            - events.get("connection_closed", 0),
+            "checked_out": events.get("connection_checked_out", 0)
+            - events.get("connection_checked_in", 0),
+            "events": events,
+        }
+
+    return res
 
 
 def discord_webhooks():
-    return conf.get("discord", {}).get("webhooks", {})
+    return _conf().get("discord", {}).get("webhooks", {})
@@ -0,0 +1,178 @@
+from config import config  # pylint: disable=wrong-import-order
+
+import asyncio
+from collections import defaultdict
+from urllib.parse import urlparse
+
+from helpers import hood_helpers as hood
+from helpers.chain_helpers import project_option
+from helpers.retry_helpers import rate_limit_session
+
+# instruments per marketdata request, keeps query strings well below URL limits
+_MARKET_DATA_BATCH_SIZE = 20
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+class AsyncChainFetcher:
+    """
+    asyncio fetch engine for quotes and option chains
+
+    1. Blocking HTTP calls are pushed onto threads and bounded
+    by a semaphore per host so the broker API never sees more
+    than `concurrency` in flight requests from one process
+
+    2. Quotes for every ticker are fetched in a single bulk
+    request while the chain pages are being fetched, rather
+    than one get_price call per ticker after each chain
+
+    3. Market data is fetched in batches of instruments instead
+    of the 2 requests per contract robin_stocks makes
+
+    4. Every HTTP request takes one token / counts its failures
+    through the session's RateLimitedAdapter, an injected session
+    gets one mounted
+
+    api_url can be pointed at a local fake server for testing
+    """
+
+    concurrency = config.setting("concurrency", default=8)
+    timeout = 15
+
+    def __init__(self, session=None, api_url=None, concurrency=None):
+        # broker() already routes its session through RateLimitedAdapter
+        self.session = (
+            rate_limit_session(session)
+            if session is not None
+            else hood.broker().globals.SESSION
+        )
+        self.api_url = (
+            api_url
+            or config.get_setting(
+                "hood", "api_url", default="https://api.robinhood.com"
+            )
+        ).rstrip("/")
+        self.concurrency = concurrency or self.concurrency
+        self.semaphores = defaultdict(lambda: asyncio.Semaphore(self.concurrency))
+
+    def url(self, path):
+        return f"{self.api_url}/{path.lstrip('/')}"
+
+    def _get_blocking(self, url, params=None):
+        # rate limited / counted against the breaker by the session's adapter
+        res = self.session.get(url, params=params, timeout=self.timeout)
+        res.raise_for_status()
+        return res.json()
+
+    async def get(self, url, params=None):
+        async with self.semaphores[urlparse(url).netloc]:
+            return await asyncio.to_thread(self._get_blocking, url, params)
+
+    async def get_paginated(self, url, params=None):
+        data = await self.get(url, params)
+        results = data.get("results", [])
+        while data.get("next"):
+            data = await self.get(data["next"])
+            results += data.get("results", [])
+        return results
+
+    async def get_prices(self, tickers):
+        """
+        {ticker: latest price (str)} using the same extended hours
+        preference as rh.stocks.get_latest_price
+        """
+        prices = {}
+        for batch in _chunks(list(tickers), _MARKET_DATA_BATCH_SIZE):
+            data = await self.get(self.url("quotes/"), {"symbols": ",".join(batch)})
+            for quote in data.get("results", []):
+                if not quote:
+                    continue
+                prices[quote["symbol"]] = (
+                    quote.get("last_extended_hours_trade_price")
+                    or quote["last_trade_price"]
+                )
+        return prices
+
+    async def get_chain_id(self, ticker):
+        data = await self.get(self.url("instruments/"), {"symbol": ticker})
+        if not (results := data.get("results")):
+            return None
+        return results[0].get("tradable_chain_id")
+
+    async def get_market_data(self, instrument_urls):
+        data = await self.get(
+            self.url("marketdata/options/"),
+            {"instruments": ",".join(instrument_urls)},
+        )
+        return {md["instrument"]: md for md in data.get("results", []) if md}
+
+    async def get_option_chain(self, ticker, expr, fields=None, chain_id=None):
+        """
+        Same shape as hood.get_option_chain: instrument dicts
+        updated with their market data. With fields, options are
+        projected as each market data batch arrives so full API
+        dicts never pile up (see hood.iter_option_chain)
+        """
+        if not (chain_id := chain_id or await self.get_chain_id(ticker)):
+            raise ConnectionError(f"Failed to find the chain id of {ticker}")
+
+        instruments = await self.get_paginated(
+            self.url("options/instruments/"),
+            {
+                "chain_id": chain_id,
+                "chain_symbol": ticker,
+                "expiration_dates": expr,
+                "state": "active",
+            },
+        )
+        instruments = [i for i in instruments if i.get("expiration_date") == expr]
+
+        async def merge(batch):
+            market_data = await self.get_market_data([i["url"] for i in batch])
+            options = [i | market_data.get(i["url"], {}) for i in batch]
+            return [project_option(o, fields) for o in options] if fields else options
+
+        batches = await asyncio.gather(
+            *[merge(b) for b in _chunks(instruments, _MARKET_DATA_BATCH_SIZE)]
+        )
+        return [option for batch in batches for option in batch]
+
+    async def fetch(self, ticker_exprs, fields=None, chain_ids=None):
+        """
+        ticker_exprs: [(ticker, expr), ...], a ticker can have several
+        expirations which share one quote and one chain id lookup
+        chain_ids: {ticker: chain id} already known (cached chain metadata)
+
+        returns ({ticker: price}, {(ticker, expr): chain or exception})
+        """
+        tickers = list(dict.fromkeys(ticker for ticker, _ in ticker_exprs))
+        chain_ids = chain_ids or {}
+        lookups = {
+            ticker: asyncio.ensure_future(self.get_chain_id(ticker))
+            for ticker in tickers
+            if not chain_ids.get(ticker)
+        }
+
+        async def get_option_chain(ticker, expr):
+            chain_id = chain_ids.get(ticker) or await lookups[ticker]
+            if not chain_id:
+                raise ConnectionError(f"Failed to find the chain id of {ticker}")
+            return await self.get_option_chain(ticker, expr, fields, chain_id)
+
+        prices, *chains = await asyncio.gather(
+            self.get_prices(tickers),
+            *[get_option_chain(t, e) for t, e in ticker_exprs],
+            return_exceptions=True,
+        )
+        if isinstance(prices, Exception):
+            prices = {}
+        return prices, dict(zip(ticker_exprs, chains))
+
+
+def fetch_chains(ticker_exprs, fields=None, chain_ids=None, **kwargs):
+    return asyncio.run(
+        AsyncChainFetcher(**kwargs).fetch(ticker_exprs, fields, chain_ids)
+    )
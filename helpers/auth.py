@@ -1,9 +1,10 @@
-import robin_stocks.robinhood as r
-import pyotp
 from config import config
 
 
 def hood():
+    import pyotp
+    import robin_stocks.robinhood as r
+
     login = config.conf.hood.login
     passw = config.conf.hood.password
     my2fa = config.conf.hood.my2fa
@@ -0,0 +1,182 @@
+from config import config  # pylint: disable=wrong-import-order
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from helpers import redis_helpers as redh
+
+# seconds between pub/sub reconnection attempts
+_RECONNECT_DELAY = 5
+
+_MISSING = object()
+
+
+class LocalCache:
+    """
+    In process LRU cache with a TTL per entry, in front of redis for
+    small hot lookups that rarely change (market hours, expirations,
+    chain metadata)
+
+    1. Entries expire `ttl` seconds after being set, the least
+    recently used ones are evicted past `maxsize` entries
+
+    2. invalidate() only drops this process' entries, publish()
+    drops them in every process (redis pub/sub, see _Listener).
+    Writers of the backing redis keys publish, the TTL bounds
+    staleness when a message is missed
+
+    3. Cached values are shared, callers must not mutate them
+
+    4. hits / misses are counted per cache, see stats()
+    """
+
+    # every cache by name, for invalidation messages and stats
+    registry = {}
+
+    ttl = config.setting("local_cache", "ttl", default=300)
+    maxsize = config.setting("local_cache", "maxsize", default=1024)
+
+    def __init__(self, name, ttl=None, maxsize=None):
+        self.name = name
+        if ttl is not None:
+            self.ttl = ttl
+        if maxsize is not None:
+            self.maxsize = maxsize
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.registry[name] = self
+
+    def get(self, key, default=None):
+        _listen()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def get_or_load(self, key, load):
+        """
+        cached value or load() (cached unless None)
+        """
+        if (res := self.get(key, _MISSING)) is not _MISSING:
+            return res
+        if (res := load()) is not None:
+            self.set(key, res)
+        return res
+
+    def invalidate(self, *keys):
+        """
+        drops keys (every entry without keys) in this process
+        """
+        with self.lock:
+            if not keys:
+                self.entries.clear()
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def publish(self, *keys):
+        """
+        drops keys (every entry without keys) in all processes
+        """
+        self.invalidate(*keys)
+        redh.publish_cache_invalidation(self.name, *keys)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+    def reset_after_fork(self):
+        self.lock = threading.Lock()
+
+
+def cache_stats():
+    return [cache.stats() for cache in LocalCache.registry.values()]
+
+
+def print_cache_stats():
+    for stats in cache_stats():
+        if stats["hits"] or stats["misses"]:
+            print(
+                f"Local cache {stats['name']}: {stats['hits']} hits"
+                f" / {stats['misses']} misses ({stats['size']} entries)"
+            )
+
+
+########################
+# PUB/SUB INVALIDATION #
+########################
+
+
+class _Listener(threading.Thread):
+    """
+    Drops the cache entries named in invalidation messages (see
+    redh.publish_cache_invalidation), reconnects on redis errors
+    """
+
+    def __init__(self):
+        super().__init__(name="local-cache-listener", daemon=True)
+
+    def run(self):
+        while True:
+            try:
+                for name, keys in redh.listen_cache_invalidations():
+                    if cache := LocalCache.registry.get(name):
+                        cache.invalidate(*keys)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                print(f"Unexpected {err=}, {type(err)=}")
+
+            # messages published while disconnected are lost
+            for cache in LocalCache.registry.values():
+                cache.invalidate()
+            time.sleep(_RECONNECT_DELAY)
+
+
+# one listener per process, threads don't survive fork
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _listen():
+    global _listener  # pylint: disable=global-statement
+
+    if _listener is not None:
+        return
+    with _listener_lock:
+        if _listener is None:
+            _listener = _Listener()
+            _listener.start()
+
+
+def _reset_after_fork():
+    global _listener, _listener_lock  # pylint: disable=global-statement
+
+    _listener = None
+    _listener_lock = threading.Lock()
+    for cache in LocalCache.registry.values():
+        cache.reset_after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,256 @@
+from collections import defaultdict
+
+import numpy as np
+
+OPTION_TYPES = ["call", "put"]
+
+# option API properties kept in compact documents
+_INT_FIELDS = ["volume", "open_interest"]
+_FLOAT_FIELDS = [
+    "bid_price",
+    "ask_price",
+    "mark_price",
+    "implied_volatility",
+    "delta",
+    "gamma",
+    "theta",
+    "vega",
+]
+
+# everything scrapers need from the API in compact / delta storage modes
+KEPT_FIELDS = ["id", "strike_price", "type", "expiration_date"]
+KEPT_FIELDS += _INT_FIELDS + _FLOAT_FIELDS
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def project_option(option, fields=None):
+    return {field: option.get(field) for field in fields or KEPT_FIELDS}
+
+
+#####################
+# VECTORIZED CHAINS #
+#####################
+
+# missing / unparsable int values, volume and open interest are never negative
+_MISSING_INT = -1
+
+
+class ChainArrays:
+    """
+    Option API dicts parsed once into typed numpy arrays (one row
+    per contract, same order as options) for vectorized ATM
+    ordering and compaction. Rows without a parsable strike or
+    type are dropped
+    """
+
+    def __init__(self, options):
+        options = [
+            o
+            for o in options
+            if o
+            and _to_float(o.get("strike_price")) is not None
+            and o.get("type") in OPTION_TYPES
+        ]
+        self.options = options
+        self.strikes = np.array(
+            [float(o["strike_price"]) for o in options], dtype=float
+        )
+        self.types = np.array(
+            [OPTION_TYPES.index(o["type"]) for o in options], dtype=np.int8
+        )
+        self.columns = {
+            field: np.array(
+                [
+                    _MISSING_INT if (v := _to_int(o.get(field))) is None else v
+                    for o in options
+                ],
+                dtype=np.int64,
+            )
+            for field in _INT_FIELDS
+        } | {
+            field: np.array([_to_float(o.get(field)) for o in options], dtype=float)
+            for field in _FLOAT_FIELDS
+        }
+
+    def __len__(self):
+        return len(self.options)
+
+    def atm_order(self, price):
+        """
+        Row indices sorted by distance from price (stable)
+        """
+        return np.argsort(np.abs(self.strikes - price), kind="stable")
+
+    def sorted_by_atm(self, price):
+        return [self.options[i] for i in self.atm_order(price)]
+
+    def compact(self):
+        """
+        see compact_chain
+        """
+        strikes, rows = np.unique(self.strikes, return_inverse=True)
+        res = {"strikes": strikes.tolist()}
+        for code, option_type in enumerate(OPTION_TYPES):
+            mask = self.types == code
+            idx = rows[mask]
+            present = np.zeros(len(strikes), dtype=bool)
+            present[idx] = True
+
+            res[option_type] = {}
+            for field, values in self.columns.items():
+                if field in _INT_FIELDS:
+                    col = np.full(len(strikes), _MISSING_INT, dtype=np.int64)
+                    col[idx] = values[mask]
+                    valid = present & (col != _MISSING_INT)
+                else:
+                    col = np.full(len(strikes), np.nan)
+                    col[idx] = values[mask]
+                    valid = present & ~np.isnan(col)
+                res[option_type][field] = np.where(
+                    valid, col.astype(object), None
+                ).tolist()
+        return res
+
+
+###################
+# COMPACT STORAGE #
+###################
+
+
+def compact_chain(chain):
+    """
+    Prunes option API dicts (or ChainArrays) into numeric arrays
+    aligned on strike:
+
+    {
+        "strikes": [float, ...] (ascending),
+        "call": {"volume": [int, ...], "open_interest": [int, ...], "bid_price": [float, ...], ...},
+        "put": {...},
+    }
+
+    Contracts / values missing for a strike / type are null
+    """
+    if not isinstance(chain, ChainArrays):
+        chain = ChainArrays(chain)
+    return chain.compact()
+
+
+def project_compact(compact, fields=None):
+    """
+    compact chain with only fields (volume / open interest by default) per type
+    """
+    fields = fields or _INT_FIELDS
+    res = {"strikes": compact.get("strikes", [])}
+    for option_type in OPTION_TYPES:
+        columns = compact.get(option_type, {})
+        res[option_type] = {f: columns[f] for f in fields if f in columns}
+    return res
+
+
+def strikes_from_compact(compact):
+    """
+    {strike: {type: {"volume": int, "open_interest": int}}}
+    """
+    strikes = defaultdict(dict)
+    for option_type in OPTION_TYPES:
+        columns = compact.get(option_type, {})
+        volumes = columns.get("volume", [])
+        open_interests = columns.get("open_interest", [])
+        for i, strike in enumerate(compact.get("strikes", [])):
+            if volumes[i] is None and open_interests[i] is None:
+                continue
+            strikes[strike][option_type] = {
+                "volume": volumes[i] or 0,
+                "open_interest": open_interests[i] or 0,
+            }
+    return strikes
+
+
+def strikes_from_options(options):
+    """
+    Same as strikes_from_compact for raw (v1) documents
+    """
+    strikes = defaultdict(dict)
+    for option in options:
+        if not (strike := option.get("strike_price")):
+            continue
+
+        strikes[float(strike)] |= {
+            option["type"]: {
+                "volume": option.get("volume", 0),
+                "open_interest": option.get("open_interest", 0),
+            }
+        }
+    return strikes
+
+
+def strikes_from_document(doc):
+    if "chain" in doc:
+        return strikes_from_compact(doc["chain"])
+    return strikes_from_options(doc.get("options", []))
+
+
+##################
+# DELTA ENCODING #
+##################
+
+
+def diff_compact(prev, curr):
+    """
+    Changed contracts / fields between two compact chains:
+
+    {type: {field: {"i": [index, ...], "v": [value, ...]}}}
+
+    None when the strikes differ (listing changed), which calls for a keyframe
+    """
+    if prev.get("strikes") != curr["strikes"]:
+        return None
+
+    diff = {}
+    for option_type in OPTION_TYPES:
+        for field, values in curr[option_type].items():
+            prev_values = prev.get(option_type, {}).get(field)
+            if prev_values is None:
+                changed = list(range(len(values)))
+            else:
+                changed = [i for i, v in enumerate(values) if v != prev_values[i]]
+            if changed:
+                diff.setdefault(option_type, {})[field] = {
+                    "i": changed,
+                    "v": [values[i] for i in changed],
+                }
+    return diff
+
+
+def apply_compact_diff(compact, diff):
+    """
+    New compact chain with diff applied, fields missing from
+    compact (e.g. projected out) are skipped
+    """
+    res = {"strikes": compact["strikes"]}
+    for option_type in OPTION_TYPES:
+        columns = compact.get(option_type, {})
+        changes = diff.get(option_type, {})
+        res[option_type] = {}
+        for field, values in columns.items():
+            if field not in changes:
+                res[option_type][field] = values
+                continue
+            values = list(values)
+            for i, v in zip(changes[field]["i"], changes[field]["v"]):
+                values[i] = v
+            res[option_type][field] = values
+    return res
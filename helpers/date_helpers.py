@@ -1,6 +1,7 @@
 from config import config  # pylint: disable=wrong-import-order
 
 import calendar
+import functools
 import json
 from datetime import date, datetime, timedelta
 from pprint import pprint as pp  # pylint: disable=unused-import
@@ -11,13 +12,16 @@ import pytz
 
 from helpers.general_helpers import key_join
 from helpers import hood_helpers as hood
+from helpers.cache_helpers import LocalCache
 
-r = config.redis_client()
+r = config.lazy_redis_client()
 
 _DEFAULT_TICKER = "AAPL"
 _DEFAULT_TICKER_DAILIES = "SPY"
 _TIMEZONE = pytz.timezone("America/New_York")
 _NORMAL_DAILY_MARKET_SECONDS = 23400
+# furthest remaining_market_seconds_to_datetime looks back
+_MAX_LOOKBACK_DAYS = 3660
 
 
 #####################################
@@ -30,19 +34,33 @@ _EXPR_DATES_ALL_SET_KEY = key_join(_NS_EXPR_DATES, "all")
 _EXPR_DATES_FETCH_FLAG_KEY = key_join(_NS_EXPR_DATES, "api_fetch_flag")
 _EXPR_DATES_FETCH_TTL = 86400 * 7
 
+# sorted expiration date sets by redis key
+_expr_dates_cache = LocalCache("expr_dates")
+
 
 def all_unexpired(force_api=False):
+    if not force_api and (exprs := _expr_dates_cache.get(_EXPR_DATES_SET_KEY)):
+        return exprs
     if (
         force_api
         or not r.get(_EXPR_DATES_FETCH_FLAG_KEY)
         or not (exprs := r.smembers(_EXPR_DATES_SET_KEY))
     ):
         return get_exprs_from_api()["weekly"]
-    return list(sorted(exprs))
+
+    exprs = list(sorted(exprs))
+    _expr_dates_cache.set(_EXPR_DATES_SET_KEY, exprs)
+    return exprs
 
 
 def all_exprs():
-    return list(sorted(r.smembers(_EXPR_DATES_ALL_SET_KEY)))
+    return (
+        _expr_dates_cache.get_or_load(
+            _EXPR_DATES_ALL_SET_KEY,
+            lambda: list(sorted(r.smembers(_EXPR_DATES_ALL_SET_KEY))) or None,
+        )
+        or []
+    )
 
 
 # month == "01" to "12"
@@ -65,6 +83,7 @@ def get_exprs_from_api(ticker=_DEFAULT_TICKER, cache=True):
         r.sadd(_EXPR_DATES_SET_KEY, *expr_dates)
         r.sadd(_EXPR_DATES_ALL_SET_KEY, *expr_dates)
         r.set(_EXPR_DATES_FETCH_FLAG_KEY, 1, ex=_EXPR_DATES_FETCH_TTL)
+        _expr_dates_cache.publish()
     return sorted(expr_dates)
 
 
@@ -84,6 +103,7 @@ def next_expr_for_ticker(ticker):
 
 def expire_current_expr():
     r.srem(_EXPR_DATES_SET_KEY, today_date_utc())
+    _expr_dates_cache.publish()
 
 
 def current_expr():
@@ -113,6 +133,30 @@ def is_next_week_monthly_expr_week():
     return next_expr() == current_monthly_expr()
 
 
+def is_monthly_expr(iso_date, expr_dates=()):
+    """
+    Third friday of the month, or the thursday before it when
+    that friday isn't in expr_dates (market holiday)
+    """
+    d = date.fromisoformat(iso_date)
+    if d.weekday() == 4:
+        return 15 <= d.day <= 21
+    friday = (d + timedelta(days=1)).isoformat()
+    return d.weekday() == 3 and 14 <= d.day <= 20 and friday not in expr_dates
+
+
+def select_exprs(expr_dates, weeklies=1, monthlies=0):
+    """
+    Next `weeklies` expirations plus the next `monthlies` monthly
+    expirations out of a ticker's expiration dates (see get_chains).
+    Today's expiration is skipped like in next_expr_for_ticker
+    """
+    today = date.today().isoformat()
+    unexpired = sorted(e for e in expr_dates if e > today)
+    monthly = [e for e in unexpired if is_monthly_expr(e, expr_dates)]
+    return sorted(set(unexpired[:weeklies]) | set(monthly[:monthlies]))
+
+
 ####################################
 # EXPIRATION DATES CACHING DAILIES #
 ####################################
@@ -165,13 +209,19 @@ def next_expr_dailies():
 
 _NS_MARKET_HOURS = "market_hours"
 
+# a date's market hours only change when refetched (force_api)
+_market_hours_cache = LocalCache("market_hours", ttl=86400)
+
 
 def get_market_hours(iso_date, force_api=False, cache=True):
     if not force_api:
+        if res := _market_hours_cache.get(iso_date):
+            return res
+
         k = key_join(_NS_MARKET_HOURS, iso_date)
-        res = r.get(k)
-        if res:
-            return json.loads(res)
+        if res := json.loads(r.get(k) or "null"):
+            _market_hours_cache.set(iso_date, res)
+            return res
 
     res = hood.get_market_hours(iso_date)
     if cache:
@@ -180,8 +230,14 @@ def get_market_hours(iso_date, force_api=False, cache=True):
 
 
 def cache_market_hours(iso_date, js):
+    """
+    failed fetches (None) aren't cached, they'd read as closed days
+    """
+    if not js:
+        return None
     k = key_join(_NS_MARKET_HOURS, iso_date)
     res = r.set(k, json.dumps(js))
+    _market_hours_cache.publish(iso_date)
     return res
 
 
@@ -209,6 +265,136 @@ def is_market_open_today():
     return get_market_hours(today_date_utc())["opens_at"]
 
 
+#########################
+# MARKET CALENDAR INDEX #
+#########################
+
+
+class MarketCalendar:
+    """
+    In process index of cached market hours, built once and only
+    rebuilt when a query needs dates it doesn't cover:
+
+    - opens / closes: sorted session open / close epochs
+    - cumulative: cumulative[k] = market seconds of sessions before k
+
+    so market seconds between two instants is two binary searches
+    and a subtraction, without any redis / parsing per day
+    """
+
+    @classmethod
+    def from_cache(cls):
+        keys = list(r.scan_iter(key_join(_NS_MARKET_HOURS, "*")))
+        hours = {}
+        for k, v in zip(keys, r.mget(keys) if keys else []):
+            if js := json.loads(v or "null"):
+                hours[k.split(":")[-1]] = js
+        return cls(hours)
+
+    def __init__(self, hours):
+        """
+        hours: {iso_date: market hours JSON}
+        """
+        self.hours = hours
+        self.ordinals = np.array(
+            sorted(date.fromisoformat(d).toordinal() for d in hours), dtype=np.int64
+        )
+
+        sessions = sorted(
+            (
+                dateutil.parser.isoparse(h["opens_at"]).timestamp(),
+                dateutil.parser.isoparse(h["closes_at"]).timestamp(),
+                date.fromisoformat(d).toordinal(),
+            )
+            for d, h in hours.items()
+            if h and h.get("is_open") and h.get("opens_at") and h.get("closes_at")
+        )
+        self.opens = np.array([s[0] for s in sessions], dtype=float)
+        self.closes = np.array([s[1] for s in sessions], dtype=float)
+        self.session_ordinals = np.array([s[2] for s in sessions], dtype=np.int64)
+        self.cumulative = np.concatenate([[0.0], np.cumsum(self.closes - self.opens)])
+
+    def covers(self, d0, d1):
+        """
+        True if every date from d0 to d1 (inclusive) is indexed
+        """
+        o0, o1 = d0.toordinal(), d1.toordinal()
+        i0 = np.searchsorted(self.ordinals, o0)
+        i1 = np.searchsorted(self.ordinals, o1)
+        return (
+            i1 < len(self.ordinals)
+            and self.ordinals[i0] == o0
+            and self.ordinals[i1] == o1
+            and i1 - i0 == o1 - o0
+        )
+
+    def market_seconds_before(self, ts):
+        """
+        market seconds of all indexed sessions before epoch ts
+        """
+        k = np.searchsorted(self.opens, ts, side="right")
+        if k == 0:
+            return 0.0
+        return self.cumulative[k - 1] + min(ts, self.closes[k - 1]) - self.opens[k - 1]
+
+    def market_seconds_between(self, ts_from, ts_to):
+        return max(
+            0,
+            int(
+                self.market_seconds_before(ts_to) - self.market_seconds_before(ts_from)
+            ),
+        )
+
+    def open_days_between(self, d0, d1):
+        """
+        # of sessions from d0 (inclusive) to d1 (exclusive)
+        """
+        return int(
+            np.searchsorted(self.session_ordinals, d1.toordinal())
+            - np.searchsorted(self.session_ordinals, d0.toordinal())
+        )
+
+    def instant_before(self, ts, seconds):
+        """
+        epoch that is `seconds` market seconds before ts, None if
+        it falls before the first indexed session
+        """
+        target = self.market_seconds_before(ts) - seconds
+        if target < 0 or not len(self.opens):
+            return None
+        k = min(
+            np.searchsorted(self.cumulative[1:], target, side="left"),
+            len(self.opens) - 1,
+        )
+        return float(self.opens[k] + target - self.cumulative[k])
+
+
+_market_calendar = None
+
+
+def market_calendar(d0, d1):
+    """
+    Process wide MarketCalendar covering dates d0 to d1, missing
+    dates are loaded (from cache or API) and the index rebuilt.
+    Dates whose hours can't be fetched are left out (not indexed
+    as closed) and retried by the next call
+    """
+    global _market_calendar  # pylint: disable=global-statement
+
+    if _market_calendar is None:
+        _market_calendar = MarketCalendar.from_cache()
+
+    if not _market_calendar.covers(d0, d1):
+        hours = dict(_market_calendar.hours)
+        for n in range((d1 - d0).days + 1):
+            iso_date = (d0 + timedelta(n)).isoformat()
+            if iso_date not in hours and (js := get_market_hours(iso_date)):
+                hours[iso_date] = js
+        _market_calendar = MarketCalendar(hours)
+
+    return _market_calendar
+
+
 #########################
 # MARKET TIME FUNCTIONS #
 #########################
@@ -217,13 +403,11 @@ def is_market_open_today():
 def market_days_until_expr(iso_date):
     today = date.today()
     expr_date = date.fromisoformat(iso_date)
+    if expr_date <= today:
+        return 0
 
-    days = 0
-    for d in (today + timedelta(n) for n in range((expr_date - today).days)):
-        if is_market_open_on(d.isoformat()):
-            days += 1
-
-    return days
+    cal = market_calendar(today, expr_date - timedelta(1))
+    return cal.open_days_between(today, expr_date)
 
 
 def market_seconds_in_day(iso_date):
@@ -247,24 +431,12 @@ def market_seconds_between(dt_from, dt_to):
     if dt_from > dt_to:
         return 0
 
-    seconds = 0
-    open_dt = market_opens_at(dt_from.date().isoformat())
-    close_dt = market_closes_at(dt_to.date().isoformat())
-    for d in (dt_from + timedelta(n) for n in range((dt_to - dt_from).days + 1)):
-        market_seconds = market_seconds_in_day(d.date().isoformat())
-        if market_seconds == 0:
-            continue
-        if d.day == dt_from.day and dt_from > open_dt:
-            seconds -= min([market_seconds, (dt_from - open_dt).seconds])
-        if d.day == dt_to.day and dt_to < close_dt:
-            seconds -= min([market_seconds, (close_dt - dt_to).seconds])
-        seconds += market_seconds
-
-    return seconds
+    cal = market_calendar(dt_from.date(), dt_to.date())
+    return cal.market_seconds_between(dt_from.timestamp(), dt_to.timestamp())
 
 
-def market_seconds_until_expr(iso_date, dt=datetime.utcnow()):
-    return market_seconds_between(dt, market_closes_at(iso_date))
+def market_seconds_until_expr(iso_date, dt=None):
+    return market_seconds_between(dt or datetime.utcnow(), market_closes_at(iso_date))
 
 
 def total_market_seconds_in_week_expr(iso_date):
@@ -279,19 +451,24 @@ def is_extra_short_week(iso_date):
 
 
 def remaining_market_seconds_to_datetime(seconds, dt_to):
+    """
+    Instant that is `seconds` market seconds before dt_to. Raises
+    ValueError past _MAX_LOOKBACK_DAYS (e.g. hours can't be fetched)
+    """
     dt_to = dt_to.replace(tzinfo=pytz.UTC)
 
-    if dt_mc := market_closes_at(dt_to.date().isoformat()):
-        seconds += (dt_mc - dt_to).seconds
-
-    while seconds > 0:
-        seconds -= market_seconds_in_day(dt_to.date().isoformat())
-        dt_to -= timedelta(1)
-
-    dt_to += timedelta(1)
-    dt_mo = market_opens_at(dt_to.date().isoformat())
-
-    return dt_mo + timedelta(seconds=-seconds)
+    # calendar days to look back, doubled until the index covers it
+    days = int(seconds // _NORMAL_DAILY_MARKET_SECONDS) * 2 + 7
+    while days <= _MAX_LOOKBACK_DAYS:
+        cal = market_calendar(dt_to.date() - timedelta(days), dt_to.date())
+        if (ts := cal.instant_before(dt_to.timestamp(), seconds)) is not None:
+            return datetime.fromtimestamp(ts, pytz.UTC)
+        days *= 2
+
+    raise ValueError(
+        f"No instant {seconds} market seconds before {dt_to}"
+        f" within {_MAX_LOOKBACK_DAYS} days"
+    )
 
 
 def datetime_until_expr_from_market_seconds(seconds, iso_date):
@@ -308,6 +485,45 @@ def absolute_seconds_until_expr(iso_date):
     return absolute_seconds_between(datetime.utcnow(), market_closes_at(iso_date))
 
 
+def expr_time_context(iso_date, timestamp):
+    """
+    Expiration derived document fields as of epoch timestamp (a
+    sweep's scraper_timestamp):
+
+    - expires_at (datetime)
+    - absolute_seconds_remaining (float)
+    - market_seconds_remaining (int)
+
+    Computed once per (expiration, sweep) and shared by every ticker
+    document of it, the returned dict must not be mutated. Fields are
+    None (and not cached) while the market hours are unavailable
+    """
+    try:
+        return _expr_time_context(iso_date, timestamp)
+    except LookupError:
+        return {
+            "expires_at": None,
+            "absolute_seconds_remaining": None,
+            "market_seconds_remaining": None,
+        }
+
+
+@functools.lru_cache(maxsize=256)
+def _expr_time_context(iso_date, timestamp):
+    """
+    raises LookupError without market hours, lru_cache doesn't cache exceptions
+    """
+    if not (expires_at := market_closes_at(iso_date)):
+        raise LookupError(f"no market close for {iso_date}")
+
+    dt = datetime.utcfromtimestamp(int(timestamp))
+    return {
+        "expires_at": expires_at,
+        "absolute_seconds_remaining": absolute_seconds_between(dt, expires_at),
+        "market_seconds_remaining": market_seconds_between(dt, expires_at),
+    }
+
+
 def seconds_after_market_close(iso_date):
     return (today_datetime_utc() - market_closes_at(iso_date)).total_seconds()
 
@@ -0,0 +1,62 @@
+import io
+
+import numpy as np
+
+from helpers.chain_helpers import OPTION_TYPES
+
+# volume / open interest of contracts missing from a snapshot
+MISSING = -1
+
+_FIELDS = ["volume", "open_interest"]
+
+
+def chain_series(snapshots):
+    """
+    snapshots: iterable of {"scraper_timestamp", "price", "strikes"}
+    (see Option.aggregate_strikes) ->
+
+    - timestamps: int64 (T)
+    - prices: float64 (T)
+    - strikes: float64 (S) ascending
+    - call_volume, call_open_interest, put_volume, put_open_interest:
+      int64 (T x S) matrices, MISSING where a contract wasn't listed
+    """
+    snapshots = list(snapshots)
+    strikes = np.array(
+        sorted({float(k) for s in snapshots for k in s["strikes"]}), dtype=np.float64
+    )
+    columns = {strike: i for i, strike in enumerate(strikes.tolist())}
+
+    res = {
+        "timestamps": np.array(
+            [int(s["scraper_timestamp"]) for s in snapshots], dtype=np.int64
+        ),
+        "prices": np.array([float(s["price"] or 0) for s in snapshots]),
+        "strikes": strikes,
+    }
+    for option_type in OPTION_TYPES:
+        for field in _FIELDS:
+            res[f"{option_type}_{field}"] = np.full(
+                (len(snapshots), len(strikes)), MISSING, dtype=np.int64
+            )
+
+    for row, snapshot in enumerate(snapshots):
+        for strike, types in snapshot["strikes"].items():
+            col = columns[float(strike)]
+            for option_type, values in types.items():
+                for field in _FIELDS:
+                    res[f"{option_type}_{field}"][row, col] = int(
+                        values.get(field) or 0
+                    )
+
+    return res
+
+
+def to_npz(series):
+    """
+    .npz bytes, load with np.load(path) and e.g.
+    pd.DataFrame(npz["call_volume"], index=npz["timestamps"], columns=npz["strikes"])
+    """
+    buffer = io.BytesIO()
+    np.savez(buffer, **series)
+    return buffer.getvalue()
@@ -1,37 +1,161 @@
-import robin_stocks.robinhood as rh
-from helpers import auth
+import os
+import threading
 
-auth.hood()
+from helpers import auth
+from helpers.chain_helpers import ChainArrays, project_option
+from helpers.retry_helpers import rate_limit_session
 
 _MIC = "XNYS"  # NYSE market code
+_QUOTES_BATCH_SIZE = 50
+_MARKET_DATA_BATCH_SIZE = 20
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def broker():
+    """
+    robin_stocks.robinhood, imported and logged in on first use
+    instead of at import. Forked children set it up again (fresh
+    adapters, no sockets shared with the parent), see _reset_after_fork
+    """
+    global _broker  # pylint: disable=global-statement
+
+    if _broker is not None:
+        return _broker
+    with _broker_lock:
+        if _broker is None:
+            # pylint: disable=import-outside-toplevel
+            import robin_stocks.robinhood as rh
+            from robin_stocks.robinhood.globals import SESSION
+
+            # one token per HTTP request, not per wrapped call
+            rate_limit_session(SESSION)
+            auth.hood()
+            _broker = rh
+    return _broker
+
+
+def _reset_after_fork():
+    global _broker, _broker_lock  # pylint: disable=global-statement
+
+    _broker = None
+    _broker_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
 
 
 def get_market_hours(iso_date):
-    return rh.get_market_hours(_MIC, iso_date)
+    return broker().get_market_hours(_MIC, iso_date)
 
 
 def get_price(ticker):
-    return rh.stocks.get_latest_price(ticker)[0]
+    return broker().stocks.get_latest_price(ticker)[0]
+
+
+def get_prices(tickers):
+    """
+    Bulk version of get_price: {ticker: latest price (str)}.
+    A failed batch is logged and left out, its tickers
+    fall back to get_price (see PriceSnapshot.get)
+    """
+    tickers = list(tickers)
+    prices = {}
+    for i in range(0, len(tickers), _QUOTES_BATCH_SIZE):
+        batch = tickers[i : i + _QUOTES_BATCH_SIZE]
+        try:
+            quotes = broker().stocks.get_quotes(batch) or []
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            print(f"Unexpected {err=}, {type(err)=}")
+            print(f"Failed to get quotes for {len(batch)} tickers")
+            continue
+        for quote in quotes:
+            if not quote:
+                continue
+            prices[quote["symbol"]] = (
+                quote.get("last_extended_hours_trade_price")
+                or quote["last_trade_price"]
+            )
+    return prices
 
 
 def get_tradable_options(ticker, expr, option_type=None):
-    return rh.find_tradable_options(ticker, expr, optionType=option_type)
+    return broker().find_tradable_options(ticker, expr, optionType=option_type)
 
 
 def get_chains(ticker):
-    return rh.options.get_chains(ticker)
+    return broker().options.get_chains(ticker)
 
 
 def get_option_chain(ticker, expr, option_type=None):
     if option_type is None or option_type not in ["call", "put"]:
-        return rh.options.find_options_by_expiration(ticker, expr)
-
-    return rh.options.find_options_by_expiration(ticker, expr, optionType=option_type)
+        return broker().options.find_options_by_expiration(ticker, expr)
+
+    return broker().options.find_options_by_expiration(
+        ticker, expr, optionType=option_type
+    )
+
+
+def _request_page(url, payload=None):
+    if (res := broker().helper.request_get(url, "regular", payload)) is None:
+        raise ConnectionError(f"Failed to load {url}")
+    return res
+
+
+def _chain_id(ticker):
+    return broker().helper.id_for_chain(ticker)
+
+
+def iter_option_chain(ticker, expr, fields=None, option_type=None, chain_id=None):
+    """
+    Streaming version of get_option_chain. One page of instruments
+    is held at a time: it is merged with batched market data and
+    each option is projected to fields (default chain_helpers.KEPT_FIELDS)
+    before the next page is requested. Raises ConnectionError
+    when the chain id lookup or a page fails so empty / partial
+    chains are never stored.
+    chain_id: cached chain id, saves a lookup per call
+    """
+    if not (chain_id := chain_id or _chain_id(ticker)):
+        raise ConnectionError(f"Failed to find the chain id of {ticker}")
+
+    url = broker().urls.option_instruments_url()
+    payload = {
+        "chain_id": chain_id,
+        "chain_symbol": ticker,
+        "expiration_dates": expr,
+        "state": "active",
+    }
+    if option_type in ["call", "put"]:
+        payload["type"] = option_type
+    while url:
+        page = _request_page(url, payload)
+        url, payload = page.get("next"), None
+
+        instruments = [
+            i for i in page.get("results", []) if i.get("expiration_date") == expr
+        ]
+        for n in range(0, len(instruments), _MARKET_DATA_BATCH_SIZE):
+            batch = instruments[n : n + _MARKET_DATA_BATCH_SIZE]
+            market_data = _request_page(
+                broker().urls.marketdata_options_url(),
+                {"instruments": ",".join(i["url"] for i in batch)},
+            )
+            by_url = {
+                md["instrument"]: md for md in market_data.get("results", []) if md
+            }
+            for instrument in batch:
+                yield project_option(
+                    instrument | by_url.get(instrument["url"], {}), fields
+                )
 
 
 def get_option_chain_by_strike(ticker, expr, strike):
     try:
-        return rh.options.find_options_by_expiration_and_strike(ticker, expr, strike)
+        return broker().options.find_options_by_expiration_and_strike(
+            ticker, expr, strike
+        )
     except AttributeError as err:
         print(f"Unexpected {err=}, {type(err)=}")
         print(f"Failed to get option chain data for {ticker}")
@@ -42,9 +166,9 @@ def get_option_chain_by_strike(ticker, expr, strike):
         return []
 
 
-def condensed_option_chain(ticker, expr):
+def condensed_option_chain(ticker, expr, price=None):
     try:
-        strike1, strike2 = closest_strikes_to_price(ticker, expr)
+        strike1, strike2 = closest_strikes_to_price(ticker, expr, price)
         if not (strike1 and strike2):
             return []
         res = get_option_chain_by_strike(ticker, expr, strike1)
@@ -54,19 +178,14 @@ def condensed_option_chain(ticker, expr):
         return []
 
 
-def closest_strikes_to_price(ticker, expr):
+def closest_strikes_to_price(ticker, expr, price=None):
     try:
-        price = float(get_price(ticker))
+        price = float(price or get_price(ticker))
         options = get_tradable_options(ticker, expr, option_type="call")
-        if list(filter(None, options)):
-            return list(
-                map(
-                    lambda x: x["strike_price"],
-                    sorted(
-                        options, key=lambda o: abs(price - float(o["strike_price"]))
-                    ),
-                )
-            )[:2]
+        if len(chain := ChainArrays(options)):
+            return [
+                chain.options[i]["strike_price"] for i in chain.atm_order(price)[:2]
+            ]
     except TypeError as err:
         print(f"Unexpected {err=}, {type(err)=}")
         print(f"Failed to get option chain data for {ticker}")
@@ -1,28 +1,182 @@
 from config import config  # pylint: disable=wrong-import-order
 
+import atexit
 import json
-import random
+import os
+import queue
+import threading
 import time
 from datetime import datetime
-from urllib import request
+from urllib import error, request
 from pytz import timezone
 
+from helpers.retry_helpers import backoff_delay
 
 _WEBHOOK_HEADERS = {
     "User-Agent": "PostmanRuntime/7.28.4",
     "Content-Type": "application/json",
 }
 
+# discord message content limit
+_MAX_CONTENT = 2000
+_CODE_BLOCK = "```"
+
+# seconds queued messages get to go out when the process exits
+_EXIT_FLUSH_TIMEOUT = 30
+
+
+##############
+# DISPATCHER #
+##############
+
+
+def _coalesce(lines):
+    """
+    Joins lines into as few code block payloads of at most
+    _MAX_CONTENT chars as possible, oversized lines are split
+    """
+    budget = _MAX_CONTENT - 2 * len(_CODE_BLOCK)
+    chunk = ""
+    for line in lines:
+        for i in range(0, max(len(line), 1), budget):
+            piece = line[i : i + budget]
+            if chunk and len(chunk) + 1 + len(piece) > budget:
+                yield f"{_CODE_BLOCK}{chunk}{_CODE_BLOCK}"
+                chunk = ""
+            chunk = f"{chunk}\n{piece}" if chunk else piece
+    if chunk:
+        yield f"{_CODE_BLOCK}{chunk}{_CODE_BLOCK}"
+
+
+def _retry_after(err):
+    """
+    seconds to wait after a 429, from the header or the JSON body
+    """
+    if retry_after := err.headers.get("Retry-After"):
+        return float(retry_after)
+    try:
+        return float(json.loads(err.read()).get("retry_after", 1))
+    except (ValueError, AttributeError):
+        return 1.0
+
+
+def _post(webhook_url, content, retry_count):
+    """
+    Posts one message, waiting out the webhook's rate limit
+    (X-RateLimit-Remaining / X-RateLimit-Reset-After) before returning.
+    429s are retried after Retry-After and other failures with backoff
+    """
+    data = json.dumps({"content": content}).encode("utf-8")
+
+    for attempt in range(retry_count):
+        try:
+            req = request.Request(webhook_url, headers=_WEBHOOK_HEADERS, data=data)
+            with request.urlopen(req) as res:
+                if res.headers.get("X-RateLimit-Remaining") == "0":
+                    time.sleep(float(res.headers.get("X-RateLimit-Reset-After", 1)))
+            return True
+        except error.HTTPError as err:
+            if err.code == 429:
+                time.sleep(_retry_after(err))
+                continue
+            print(f"Unexpected {err=}, {type(err)=}")
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            print(f"Unexpected {err=}, {type(err)=}")
+        time.sleep(backoff_delay(attempt, cap=30))
+
+    print(f"Dropped discord message of {len(content)} chars")
+    return False
+
+
+class _Dispatcher(threading.Thread):
+    """
+    Background sender of one webhook's messages
+
+    1. send_notification only puts messages on a queue, so callers
+    (scrapers, jobs) never wait on discord
+
+    2. Everything queued while a request was in flight is coalesced
+    into as few 2000 char payloads as possible
+
+    3. Rate limits / retries are handled by _post
+    """
+
+    def __init__(self, webhook_url, retry_count):
+        super().__init__(name="discord-dispatcher", daemon=True)
+        self.webhook_url = webhook_url
+        self.retry_count = retry_count
+        self.messages = queue.Queue()
+
+    def run(self):
+        while True:
+            lines = [self.messages.get()]
+            while True:
+                try:
+                    lines.append(self.messages.get_nowait())
+                except queue.Empty:
+                    break
+
+            for content in _coalesce(lines):
+                _post(self.webhook_url, content, self.retry_count)
+            for _ in lines:
+                self.messages.task_done()
+
+    def flush(self, timeout=None):
+        """
+        waits until every queued message was sent (or dropped),
+        returns False on timeout
+        """
+        with self.messages.all_tasks_done:
+            return self.messages.all_tasks_done.wait_for(
+                lambda: not self.messages.unfinished_tasks, timeout
+            )
+
+
+# one dispatcher per webhook and process, threads don't survive fork
+_dispatchers = {}
+_dispatchers_lock = threading.Lock()
+
+
+def _dispatcher(webhook_url, retry_count):
+    with _dispatchers_lock:
+        if webhook_url not in _dispatchers:
+            _dispatchers[webhook_url] = _Dispatcher(webhook_url, retry_count)
+            _dispatchers[webhook_url].start()
+        return _dispatchers[webhook_url]
+
+
+def flush_notifications(timeout=_EXIT_FLUSH_TIMEOUT):
+    for dispatcher in list(_dispatchers.values()):
+        dispatcher.flush(timeout)
+
+
+os.register_at_fork(after_in_child=_dispatchers.clear)
+# forked rq work horses exit with os._exit and skip this, jobs
+# sending notifications use background=False and flush() instead
+atexit.register(flush_notifications)
+
+
+############
+# NOTIFIER #
+############
+
 
 class DiscordNotifier:
     """
     Notifications to Discord via webhooks
+
+    1. background=True: sent by a _Dispatcher thread, flush()
+    waits for delivery
+
+    2. background=False: buffered until flush() posts them
+    (coalesced) from the calling thread. For jobs, which may
+    exit before a background thread delivered anything
     """
 
     retry_count = 5
 
     @classmethod
-    def anomaly_notifier(cls, config_key="anomaly"):
+    def anomaly_notifier(cls, config_key="anomaly", background=True):
         webhook = config.discord_webhooks().get(config_key, {})
         if not webhook:
             raise DiscordNotifierException(f"{config_key} webhook not set!")
@@ -31,11 +185,13 @@ class DiscordNotifier:
         if not (enabled or url):
             return None
 
-        return cls(url)
+        return cls(url, background=background)
 
-    def __init__(self, webhook_url, test_mode=False):
+    def __init__(self, webhook_url, test_mode=False, background=True):
         self.webhook_url = webhook_url
         self.test_mode = test_mode
+        self.background = background
+        self.pending = []
 
     def debug(self, msg):
         self.send_notification(f"DEBUG - {msg}")
@@ -58,21 +214,33 @@ class DiscordNotifier:
             return None
 
         t = datetime.now(timezone("US/Eastern")).isoformat(sep=" ")[:24]
-        d = {"content": f"```({config.version}) [{t}] {msg}```"}
-        data = str(json.dumps(d)).encode("utf-8")
-
-        for _ in range(self.retry_count):
-            try:
-                req = request.Request(
-                    self.webhook_url, headers=_WEBHOOK_HEADERS, data=data
-                )
-                request.urlopen(req)
-                break
-            except Exception:
-                time.sleep(random.randint(1, 5))
+        msg = f"({config.version}) [{t}] {msg}"
+        if self.background:
+            _dispatcher(self.webhook_url, self.retry_count).messages.put(msg)
+        else:
+            self.pending.append(msg)
 
         return None
 
+    def flush(self, timeout=None):
+        """
+        False if a message was dropped (background=False) or
+        the timeout expired (background=True)
+        """
+        if self.test_mode:
+            return True
+
+        if not self.background:
+            lines, self.pending = self.pending, []
+            return all(
+                [_post(self.webhook_url, c, self.retry_count) for c in _coalesce(lines)]
+            )
+
+        # nothing was sent from this process if it has no dispatcher
+        if dispatcher := _dispatchers.get(self.webhook_url):
+            return dispatcher.flush(timeout)
+        return True
+
 
 class DiscordNotifierException(Exception):
     def __init__(self, message):
@@ -1,33 +1,545 @@
 from config import config  # pylint: disable=wrong-import-order
+
+import json
+import time
+from datetime import date
+
 from helpers.general_helpers import key_join
 
-r = config.redis_client()
+r = config.lazy_redis_client()
+rb = config.lazy_redis_client(decode_responses=False)
 
 
-_NAMESPACE = config.namespace
+def _key(*segments):
+    """
+    key under the configured namespace, read on use so importing
+    this module doesn't load settings
+    """
+    return key_join(config.namespace, *segments)
 
 
 ###########################
 # OPTION EXPIRATION DATES #
 ###########################
 
-_EXPIRATION_DATE_KEY = key_join(_NAMESPACE, "expr")
+_EXPIRATION_DATE_KEY = "expr"
 
 
 def get_all_expr_dates():
-    return r.hgetall(_EXPIRATION_DATE_KEY)
+    return r.hgetall(_key(_EXPIRATION_DATE_KEY))
 
 
 def get_expr_date(ticker):
-    return r.hget(_EXPIRATION_DATE_KEY, ticker)
+    return r.hget(_key(_EXPIRATION_DATE_KEY), ticker)
 
 
 def set_expr_date(ticker, expr):
-    return r.hset(_EXPIRATION_DATE_KEY, ticker, expr)
+    return r.hset(_key(_EXPIRATION_DATE_KEY), ticker, expr)
+
+
+def set_expr_dates(exprs):
+    """
+    exprs: {ticker: expr} written in a single HSET
+    """
+    if exprs:
+        r.hset(_key(_EXPIRATION_DATE_KEY), mapping=exprs)
 
 
 def purge_expr_dates():
-    r.delete(_EXPIRATION_DATE_KEY)
+    r.delete(_key(_EXPIRATION_DATE_KEY))
+
+
+# chain id / expiration dates per ticker (get_chains)
+_CHAIN_METADATA_KEY = "chains"
+
+
+def get_all_chain_metadata():
+    return {
+        ticker: json.loads(metadata)
+        for ticker, metadata in r.hgetall(_key(_CHAIN_METADATA_KEY)).items()
+    }
+
+
+def get_chain_metadata(ticker):
+    if res := r.hget(_key(_CHAIN_METADATA_KEY), ticker):
+        return json.loads(res)
+    return None
+
+
+def set_chain_metadata(metadata):
+    """
+    metadata: {ticker: {"id", "expiration_dates"}} written in a single HSET
+    """
+    if metadata:
+        r.hset(
+            _key(_CHAIN_METADATA_KEY),
+            mapping={ticker: json.dumps(m) for ticker, m in metadata.items()},
+        )
+
+
+def purge_chain_metadata():
+    r.delete(_key(_CHAIN_METADATA_KEY))
+
+
+###################
+# PRICE SNAPSHOTS #
+###################
+
+_PRICE_SNAPSHOT_KEY = "prices"
+_PRICE_SNAPSHOT_TTL = 3600
+
+
+def get_price_snapshot(timestamp):
+    return r.hgetall(_key(_PRICE_SNAPSHOT_KEY, timestamp))
+
+
+def set_price_snapshot(timestamp, prices, overwrite=True):
+    k = _key(_PRICE_SNAPSHOT_KEY, timestamp)
+    pipe = r.pipeline()
+    for ticker, price in prices.items():
+        if overwrite:
+            pipe.hset(k, ticker, price)
+        else:
+            pipe.hsetnx(k, ticker, price)
+    pipe.expire(k, _PRICE_SNAPSHOT_TTL)
+    pipe.execute()
+
+
+##########################
+# WRITE BEHIND DOCUMENTS #
+##########################
+
+_DOCUMENTS_KEY = "documents"
+
+
+def push_documents(collection_name, *blobs):
+    return rb.rpush(_key(_DOCUMENTS_KEY, collection_name), *blobs)
+
+
+def claim_documents(collection_name, count):
+    """
+    moves up to count documents from the head of the queue onto
+    its processing list, where they stay until release_documents
+    """
+    k = _key(_DOCUMENTS_KEY, collection_name)
+    pipe = rb.pipeline()
+    for _ in range(count):
+        pipe.lmove(k, key_join(k, "processing"), "LEFT", "RIGHT")
+    return [blob for blob in pipe.execute() if blob is not None]
+
+
+def release_documents(collection_name, *failed):
+    """
+    drops the processing list once its documents are written,
+    pushing failed ones back onto the queue in the same transaction
+    """
+    k = _key(_DOCUMENTS_KEY, collection_name)
+    pipe = rb.pipeline()
+    if failed:
+        pipe.rpush(k, *failed)
+    pipe.delete(key_join(k, "processing"))
+    pipe.execute()
+
+
+def requeue_claimed_documents(collection_name):
+    """
+    moves documents claimed by a flush that never released them
+    (crashed worker) back to the head of the queue, returns the count
+    """
+    k = _key(_DOCUMENTS_KEY, collection_name)
+    requeued = 0
+    while rb.lmove(key_join(k, "processing"), k, "RIGHT", "LEFT") is not None:
+        requeued += 1
+    return requeued
+
+
+_FLUSH_LOCK_TTL = 600
+
+
+def acquire_flush_lock(collection_name, token):
+    """
+    takes or extends the collection's flush lock, False
+    if another flush holds it
+    """
+    k = _key(_DOCUMENTS_KEY, collection_name, "flushing")
+    if r.set(k, token, nx=True, ex=_FLUSH_LOCK_TTL):
+        return True
+    return r.get(k) == token and bool(r.expire(k, _FLUSH_LOCK_TTL))
+
+
+def release_flush_lock(collection_name, token):
+    k = _key(_DOCUMENTS_KEY, collection_name, "flushing")
+    if r.get(k) == token:
+        r.delete(k)
+
+
+def count_documents(collection_name):
+    return rb.llen(_key(_DOCUMENTS_KEY, collection_name))
+
+
+########################
+# DELTA ENCODING STATE #
+########################
+
+_DELTA_STATE_KEY = "delta_state"
+_DELTA_STATE_TTL = 86400
+
+
+def get_delta_state(ticker, expr):
+    """
+    last buffered snapshot's state plus "stored": scraper_timestamp
+    of the last snapshot actually written (see set_delta_stored)
+    """
+    k = _key(_DELTA_STATE_KEY, ticker, expr)
+    state, stored = r.mget(k, key_join(k, "stored"))
+    if state:
+        return json.loads(state) | {"stored": stored}
+    return None
+
+
+def set_delta_state(ticker, expr, state):
+    k = _key(_DELTA_STATE_KEY, ticker, expr)
+    return r.set(k, json.dumps(state), ex=_DELTA_STATE_TTL)
+
+
+def set_delta_stored(timestamps):
+    """
+    timestamps: {(ticker, expr): scraper_timestamp} of written documents
+    """
+    pipe = r.pipeline()
+    for (ticker, expr), timestamp in timestamps.items():
+        k = _key(_DELTA_STATE_KEY, ticker, expr, "stored")
+        pipe.set(k, timestamp, ex=_DELTA_STATE_TTL)
+    pipe.execute()
+
+
+################
+# ROLLUP STATE #
+################
+
+_ROLLUP_STATE_KEY = "rollup_state"
+_ROLLUP_STATE_TTL = 7 * 86400
+
+
+def get_rollup_states(ticker_exprs):
+    """
+    ticker_exprs: list of (ticker, expiration) -> {(ticker, expiration): state}
+    """
+    pipe = r.pipeline()
+    for ticker, expr in ticker_exprs:
+        pipe.get(_key(_ROLLUP_STATE_KEY, ticker, expr))
+    return {
+        ticker_expr: json.loads(res)
+        for ticker_expr, res in zip(ticker_exprs, pipe.execute())
+        if res
+    }
+
+
+def set_rollup_states(states):
+    pipe = r.pipeline()
+    for (ticker, expr), state in states.items():
+        k = _key(_ROLLUP_STATE_KEY, ticker, expr)
+        pipe.set(k, json.dumps(state), ex=_ROLLUP_STATE_TTL)
+    pipe.execute()
+
+
+def purge_rollup_states():
+    purge_glob(_key(_ROLLUP_STATE_KEY, "*"))
+
+
+# one StrikeRollup.add at a time, a crashed holder's lock expires.
+# Holders extend it before every write so slow writes don't outlive it
+_ROLLUP_LOCK_KEY = "rollup_lock"
+_ROLLUP_LOCK_TTL = 60
+
+# deletes KEYS[1] only while it holds ARGV[1] (the lock wasn't taken over)
+_RELEASE_LOCK_LUA = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# resets the TTL of KEYS[1] to ARGV[2] only while it holds ARGV[1]
+_EXTEND_LOCK_LUA = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def acquire_rollup_lock(token):
+    while not r.set(_key(_ROLLUP_LOCK_KEY), token, nx=True, ex=_ROLLUP_LOCK_TTL):
+        time.sleep(0.05)
+
+
+def extend_rollup_lock(token):
+    """
+    False if token doesn't hold the lock anymore (expired / taken over)
+    """
+    k = _key(_ROLLUP_LOCK_KEY)
+    return bool(r.eval(_EXTEND_LOCK_LUA, 1, k, token, _ROLLUP_LOCK_TTL))
+
+
+def release_rollup_lock(token):
+    r.eval(_RELEASE_LOCK_LUA, 1, _key(_ROLLUP_LOCK_KEY), token)
+
+
+#####################
+# ANOMALY DETECTION #
+#####################
+
+_ANOMALY_STATE_KEY = "anomaly_state"
+_ANOMALY_STATE_TTL = 7 * 86400
+_ALERTS_KEY = "alerts"
+
+
+def get_anomaly_state(ticker, expr):
+    if res := r.get(_key(_ANOMALY_STATE_KEY, ticker, expr)):
+        return json.loads(res)
+    return None
+
+
+def set_anomaly_state(ticker, expr, state):
+    k = _key(_ANOMALY_STATE_KEY, ticker, expr)
+    return r.set(k, json.dumps(state), ex=_ANOMALY_STATE_TTL)
+
+
+def push_alerts(*alerts):
+    return r.rpush(_key(_ALERTS_KEY), *alerts)
+
+
+def pop_alerts(count):
+    return r.lpop(_key(_ALERTS_KEY), count) or []
+
+
+#############
+# JOB COSTS #
+#############
+
+_JOB_COSTS_KEY = "job_costs"
+_LAST_SWEEP_KEY = "last_sweep"
+_JOB_COSTS_TTL = 86400
+
+
+def swap_last_sweep(timestamp):
+    """
+    sets the last sweep's timestamp, returns the previous one
+    """
+    return r.set(_key(_LAST_SWEEP_KEY), timestamp, get=True)
+
+
+def add_job_cost(timestamp, ticker, expr, contracts, seconds):
+    """
+    shards of a ticker / expiration add up
+    """
+    k = _key(_JOB_COSTS_KEY, timestamp)
+    pipe = r.pipeline()
+    pipe.hincrby(k, key_join(ticker, expr, "contracts"), contracts)
+    pipe.hincrbyfloat(k, key_join(ticker, expr, "seconds"), seconds)
+    pipe.expire(k, _JOB_COSTS_TTL)
+    pipe.execute()
+
+
+def get_job_costs(timestamp):
+    """
+    {(ticker, expr): {"contracts": float, "seconds": float}}
+    """
+    res = {}
+    for field, value in r.hgetall(_key(_JOB_COSTS_KEY, timestamp)).items():
+        if len(parts := field.rsplit(":", 2)) != 3:
+            continue
+        ticker, expr, stat = parts
+        res.setdefault((ticker, expr), {})[stat] = float(value)
+    return res
+
+
+##########
+# SHARDS #
+##########
+
+_SHARDS_KEY = "shards"
+_SHARDS_TTL = 3600
+
+
+def set_shard(timestamp, ticker, expr, option_type, chain):
+    k = _key(_SHARDS_KEY, timestamp, ticker, expr, option_type)
+    return r.set(k, json.dumps(chain), ex=_SHARDS_TTL)
+
+
+def pop_shards(timestamp, ticker, expr, option_types):
+    """
+    {option_type: chain or None}, None when the shard was never
+    set. An empty shard is stored (and returned) as []
+    """
+    keys = [_key(_SHARDS_KEY, timestamp, ticker, expr, t) for t in option_types]
+    pipe = r.pipeline()
+    for k in keys:
+        pipe.get(k)
+    pipe.delete(*keys)
+    *shards, _ = pipe.execute()
+    return {
+        t: json.loads(shard) if shard else None
+        for t, shard in zip(option_types, shards)
+    }
+
+
+##########
+# SWEEPS #
+##########
+
+_SWEEP_KEY = "sweep"
+_CURRENT_SWEEP_KEY = key_join("sweep", "current")
+_SWEEPS_KEY = "sweeps"
+_SWEEP_TTL = 86400
+
+
+def begin_sweep(sweep_id, expected, started_at, timeout):
+    """
+    False if another sweep is in flight (for less than timeout seconds)
+    """
+    if not r.set(_key(_CURRENT_SWEEP_KEY), sweep_id, nx=True, ex=timeout):
+        return False
+
+    k = _key(_SWEEP_KEY, sweep_id)
+    pipe = r.pipeline()
+    pipe.hset(
+        k,
+        mapping={
+            "expected": expected,
+            "completed": 0,
+            "failed": 0,
+            "skipped": 0,
+            "started_at": started_at,
+        },
+    )
+    pipe.expire(k, _SWEEP_TTL)
+    pipe.zadd(_key(_SWEEPS_KEY), {sweep_id: int(sweep_id)})
+    pipe.zremrangebyscore(_key(_SWEEPS_KEY), "-inf", int(sweep_id) - _SWEEP_TTL)
+    pipe.execute()
+    return True
+
+
+def get_current_sweep():
+    return r.get(_key(_CURRENT_SWEEP_KEY))
+
+
+def incr_sweep(sweep_id, **counts):
+    """
+    increments counts (completed, failed, skipped), returns the sweep
+    """
+    k = _key(_SWEEP_KEY, sweep_id)
+    pipe = r.pipeline()
+    for field, count in counts.items():
+        pipe.hincrby(k, field, count)
+    pipe.hgetall(k)
+    return pipe.execute()[-1]
+
+
+def end_sweep(sweep_id, ended_at, aborted=False):
+    mapping = {"ended_at": ended_at} | ({"aborted": 1} if aborted else {})
+    r.hset(_key(_SWEEP_KEY, sweep_id), mapping=mapping)
+    if r.get(_key(_CURRENT_SWEEP_KEY)) == sweep_id:
+        r.delete(_key(_CURRENT_SWEEP_KEY))
+
+
+def get_sweep(sweep_id):
+    return r.hgetall(_key(_SWEEP_KEY, sweep_id))
+
+
+def get_recent_sweeps(count):
+    return r.zrevrange(_key(_SWEEPS_KEY), 0, count - 1)
+
+
+##################
+# RESPONSE CACHE #
+##################
+
+# bumped whenever a sweep's documents are written, versions every cached response
+_DATA_VERSION_KEY = "data_version"
+_RESPONSE_CACHE_KEY = "response"
+# about one sweep interval, bodies of superseded versions are never read again
+_RESPONSE_CACHE_TTL = 120
+
+
+def get_data_version():
+    return r.get(_key(_DATA_VERSION_KEY)) or "0"
+
+
+def bump_data_version():
+    return r.incr(_key(_DATA_VERSION_KEY))
+
+
+def get_cached_response(key):
+    return r.get(_key(_RESPONSE_CACHE_KEY, key))
+
+
+def set_cached_response(key, body, ttl=None):
+    ttl = ttl or config.get_setting(
+        "response_cache", "ttl", default=_RESPONSE_CACHE_TTL
+    )
+    return r.set(_key(_RESPONSE_CACHE_KEY, key), body, ex=ttl)
+
+
+###########
+# CATALOG #
+###########
+
+_CATALOG_EXPIRATIONS_KEY = key_join("catalog", "expirations")
+_CATALOG_TIMESTAMPS_KEY = key_join("catalog", "timestamps")
+
+
+def add_to_catalog(expr_timestamps):
+    """
+    expr_timestamps: iterable of (expiration, scraper_timestamp)
+    """
+    pipe = r.pipeline()
+    for expr, timestamp in expr_timestamps:
+        pipe.zadd(
+            _key(_CATALOG_EXPIRATIONS_KEY), {expr: date.fromisoformat(expr).toordinal()}
+        )
+        pipe.zadd(_key(_CATALOG_TIMESTAMPS_KEY, expr), {timestamp: int(timestamp)})
+    pipe.execute()
+
+
+def get_catalog_expirations():
+    return r.zrange(_key(_CATALOG_EXPIRATIONS_KEY), 0, -1)
+
+
+def get_catalog_timestamps(expr):
+    return r.zrange(_key(_CATALOG_TIMESTAMPS_KEY, expr), 0, -1)
+
+
+def purge_catalog():
+    purge_glob(_key(_CATALOG_TIMESTAMPS_KEY, "*"))
+    r.delete(_key(_CATALOG_EXPIRATIONS_KEY))
+
+
+############################
+# LOCAL CACHE INVALIDATION #
+############################
+
+_CACHE_INVALIDATION_CHANNEL = "invalidate"
+
+
+def publish_cache_invalidation(name, *keys):
+    r.publish(_key(_CACHE_INVALIDATION_CHANNEL), json.dumps([name, *keys]))
+
+
+def listen_cache_invalidations():
+    """
+    yields (cache name, [keys]) published on the channel (no keys:
+    every entry), blocks
+    """
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(_key(_CACHE_INVALIDATION_CHANNEL))
+    try:
+        for message in pubsub.listen():
+            name, *keys = json.loads(message["data"])
+            yield name, keys
+    finally:
+        pubsub.close()
 
 
 #####################
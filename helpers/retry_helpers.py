@@ -0,0 +1,283 @@
+from config import config  # pylint: disable=wrong-import-order
+
+import random
+import time
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+from helpers.general_helpers import key_join
+
+r = config.lazy_redis_client()
+
+
+###########
+# BACKOFF #
+###########
+
+_BACKOFF_BASE = 2.0
+_BACKOFF_CAP = 60.0
+
+
+def backoff_delay(attempt, base=_BACKOFF_BASE, cap=_BACKOFF_CAP):
+    """
+    "full jitter" exponential backoff: uniform(0, min(cap, base * 2^attempt))
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+################
+# TOKEN BUCKET #
+################
+
+# KEYS: bucket hash, pause flag
+# ARGV: rate (tokens/s), burst, tokens requested
+# returns seconds to wait before trying again, "0" if tokens were taken
+_TOKEN_BUCKET_LUA = """
+local pause_ms = redis.call("PTTL", KEYS[2])
+if pause_ms > 0 then
+    return tostring(pause_ms / 1000)
+end
+
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+
+local t = redis.call("TIME")
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+    """
+    Request budget shared by every process (rq workers, scrape-async,
+    populate-exprs) through redis. State lives in a single hash and
+    is refilled / consumed atomically in a lua script
+
+    pause() stops the whole pool, e.g. when the API answers 429
+
+    rate / burst default to rate_limit in settings.yml, read on use
+    """
+
+    def __init__(self, name, rate=None, burst=None):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.script = None
+
+    @property
+    def key(self):
+        return key_join(config.namespace, "rate_limit", self.name)
+
+    @property
+    def pause_key(self):
+        return key_join(self.key, "paused")
+
+    def limits(self):
+        """
+        (rate, burst)
+        """
+        return (
+            self.rate or config.get_setting("rate_limit", "rate", default=5),
+            self.burst or config.get_setting("rate_limit", "burst", default=10),
+        )
+
+    def try_acquire(self, tokens=1):
+        """
+        0 if tokens were taken, otherwise seconds to wait
+        """
+        if self.script is None:
+            self.script = r.register_script(_TOKEN_BUCKET_LUA)
+        # run on this process' client, not the one it was registered with
+        return float(
+            self.script(
+                keys=[self.key, self.pause_key],
+                args=[*self.limits(), tokens],
+                client=r,
+            )
+        )
+
+    def acquire(self, tokens=1):
+        while wait := self.try_acquire(tokens):
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        r.set(self.pause_key, 1, px=max(1, int(seconds * 1000)))
+
+
+###################
+# CIRCUIT BREAKER #
+###################
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` failures within `window` seconds and
+    stays open for `cooldown` seconds. Shared across processes
+    through redis so one worker noticing the API is down saves
+    the rest of the pool from retrying into it
+
+    Successes don't reset the count (workers succeeding on other
+    tickers would hide an outage), the counter expires with its window
+
+    threshold / window / cooldown default to circuit_breaker in
+    settings.yml, read on use
+    """
+
+    def __init__(self, name, threshold=None, window=None, cooldown=None):
+        self.name = name
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+
+    @property
+    def failures_key(self):
+        return key_join(config.namespace, "circuit", self.name, "failures")
+
+    @property
+    def open_key(self):
+        return key_join(config.namespace, "circuit", self.name, "open")
+
+    def limits(self):
+        """
+        (threshold, window, cooldown)
+        """
+        return (
+            self.threshold
+            or config.get_setting("circuit_breaker", "threshold", default=20),
+            self.window or config.get_setting("circuit_breaker", "window", default=60),
+            self.cooldown
+            or config.get_setting("circuit_breaker", "cooldown", default=120),
+        )
+
+    def is_open(self):
+        return bool(r.exists(self.open_key))
+
+    def record_failure(self):
+        threshold, window, cooldown = self.limits()
+        pipe = r.pipeline()
+        pipe.incr(self.failures_key)
+        pipe.expire(self.failures_key, window, nx=True)
+        failures, _ = pipe.execute()
+
+        if failures >= threshold:
+            pipe = r.pipeline()
+            pipe.set(self.open_key, 1, ex=cooldown)
+            pipe.delete(self.failures_key)
+            pipe.execute()
+
+
+api_bucket = TokenBucket("api")
+
+api_breaker = CircuitBreaker("api")
+
+
+#########
+# RETRY #
+#########
+
+
+# responses counted as failures by the breaker
+_FAILED_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    Transport adapter taking a token from `bucket` before every
+    HTTP request, so paginated and batched calls pay for each page.
+    Transport errors and 429 / 5xx responses count against `breaker`,
+    a 429 pauses the bucket for Retry-After seconds
+    """
+
+    def __init__(self, bucket, breaker, **kwargs):
+        self.bucket = bucket
+        self.breaker = breaker
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        self.bucket.acquire()
+        try:
+            res = super().send(request, **kwargs)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+
+        if res.status_code in _FAILED_STATUSES:
+            self.breaker.record_failure()
+        if res.status_code == 429:
+            self.bucket.pause(float(res.headers.get("Retry-After") or _BACKOFF_BASE))
+        return res
+
+
+def rate_limit_session(session, bucket=None, breaker=None):
+    """
+    Routes every request of a requests.Session through a
+    RateLimitedAdapter (api_bucket / api_breaker by default).
+    Mounting fresh adapters also drops pooled connections
+    """
+    adapter = RateLimitedAdapter(bucket or api_bucket, breaker or api_breaker)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def record_failure(err, breaker=api_breaker):
+    """
+    counts err against breaker unless it was raised through a
+    RateLimitedAdapter, which already counted transport errors and
+    429 / 5xx responses (requests exceptions)
+    """
+    if not isinstance(err, RequestException):
+        breaker.record_failure()
+
+
+def call_with_retry(
+    fn,
+    *args,
+    retry_count=8,
+    base=_BACKOFF_BASE,
+    cap=_BACKOFF_CAP,
+    breaker=api_breaker,
+    accept=bool,
+    **kwargs,
+):
+    """
+    Calls fn until accept(result) (default: truthy), with a jittered
+    exponential backoff between attempts. Gives up (returns None)
+    after retry_count attempts or as soon as the circuit is open
+
+    Only exceptions count against the breaker (see record_failure):
+    a falsy result is a valid answer (e.g. no expiration left)
+    """
+    for attempt in range(retry_count):
+        if breaker.is_open():
+            print(f"Circuit open, skipping {fn.__qualname__}")
+            return None
+
+        try:
+            if accept(res := fn(*args, **kwargs)):
+                return res
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            print(f"Unexpected {err=}, {type(err)=}")
+            record_failure(err, breaker)
+
+        if attempt < retry_count - 1:
+            time.sleep(backoff_delay(attempt, base, cap))
+
+    return None
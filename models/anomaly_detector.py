@@ -0,0 +1,176 @@
+from config import config
+
+import numpy as np
+
+from helpers import chain_helpers as ch
+from helpers import redis_helpers as redh
+from helpers.notification_helper import DiscordNotifier, DiscordNotifierException
+
+_FIELDS = ["volume", "open_interest"]
+
+
+def _column(compact, option_type, field):
+    """
+    compact chain column as floats, NaN where missing
+    """
+    return np.array(compact.get(option_type, {}).get(field, []), dtype=float)
+
+
+def _realign(values, prev_strikes, strikes, fill=np.nan):
+    """
+    values aligned on prev_strikes -> aligned on strikes (both ascending)
+    """
+    prev_strikes = np.asarray(prev_strikes, dtype=float)
+    res = np.full(len(strikes), fill, dtype=float)
+    if not len(prev_strikes):
+        return res
+
+    pos = np.minimum(np.searchsorted(prev_strikes, strikes), len(prev_strikes) - 1)
+    found = prev_strikes[pos] == strikes
+    res[found] = np.asarray(values, dtype=float)[pos[found]]
+    return res
+
+
+class AnomalyDetector:
+    """
+    Flags unusual volume / open interest changes per contract
+
+    1. Keeps EWMA mean / variance of every contract's volume and
+    open interest change between sweeps, aligned on the chain's
+    strikes in redis (one small state per ticker / expiration),
+    so observing a chain is a handful of vectorized O(contracts) ops
+
+    2. Changes more than `stdev` standard deviations from the mean
+    of contracts with at least `min_samples` observations are
+    flagged (anomalies.normal in settings.yml)
+
+    3. Alerts are queued in redis instead of sent from the scraper,
+    send_alerts() posts them through DiscordNotifier (coalesced and
+    rate limited) once the sweep's scrapes are done
+    """
+
+    min_samples = config.setting("anomalies", "normal", "min_samples", default=30)
+    stdev = config.setting("anomalies", "normal", "stdev", default=3)
+    alpha = config.setting("anomalies", "normal", "alpha", default=0.1)
+
+    # alerts popped from redis at a time
+    batch_size = 100
+
+    @classmethod
+    def enabled(cls):
+        return bool(config.get_setting("anomalies", "normal"))
+
+    @classmethod
+    def notifier(cls):
+        try:
+            return DiscordNotifier.anomaly_notifier(background=False)
+        except DiscordNotifierException as err:
+            print(err.message)
+            return None
+
+    @classmethod
+    def send_alerts(cls, notifier=None):
+        """
+        notifier: defaults to the anomaly webhook (printed when unset),
+        returns # of alerts sent. Each popped batch is flushed before
+        the next one, from this thread, so jobs exiting right after
+        (forked work horses skip atexit) don't lose alerts
+        """
+        notifier = notifier or cls.notifier() or DiscordNotifier(None, test_mode=True)
+
+        sent = 0
+        while alerts := redh.pop_alerts(cls.batch_size):
+            for alert in alerts:
+                notifier.warn(alert)
+            notifier.flush()
+            sent += len(alerts)
+        return sent
+
+    def __init__(self, ticker, expr):
+        self.ticker = ticker
+        self.expr = expr
+
+    def observe(self, timestamp, compact):
+        """
+        Updates statistics with a compact chain, queues and returns alerts
+        """
+        state = redh.get_anomaly_state(self.ticker, self.expr)
+        if state and int(timestamp) <= int(state["timestamp"]):
+            return []
+
+        strikes = np.array(compact.get("strikes", []), dtype=float)
+        alerts = []
+        values, stats = {}, {}
+        for option_type in ch.OPTION_TYPES:
+            values[option_type], stats[option_type] = {}, {}
+            for field in _FIELDS:
+                curr = _column(compact, option_type, field)
+                prev, mean, var, n = self.previous(state, option_type, field, strikes)
+
+                change = curr - prev
+                if field == "volume":
+                    # volume is cumulative per session, a drop means a new session
+                    change = np.where(change < 0, curr, change)
+                valid = ~np.isnan(change)
+
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    z = (change - mean) / np.sqrt(var)
+                flagged = valid & (n >= self.min_samples) & (var > 0)
+                flagged &= np.abs(z) >= self.stdev
+
+                for i in np.flatnonzero(flagged):
+                    alerts.append(
+                        f"{self.ticker} {self.expr} {strikes[i]:g}{option_type[0].upper()}"
+                        f" {field} {change[i]:+,.0f} (mean {mean[i]:,.0f}, z {z[i]:.1f})"
+                    )
+
+                # EWMA update, first observation of a contract seeds the mean
+                first = valid & (n == 0)
+                diff = np.where(valid, change - mean, 0)
+                incr = self.alpha * diff
+                var = np.where(
+                    valid & ~first, (1 - self.alpha) * (var + diff * incr), var
+                )
+                mean = np.where(first, change, mean + incr)
+                n = n + valid
+
+                values[option_type][field] = np.where(
+                    np.isnan(curr), None, curr.astype(object)
+                ).tolist()
+                stats[option_type][field] = {
+                    "mean": mean.tolist(),
+                    "var": var.tolist(),
+                    "n": n.astype(int).tolist(),
+                }
+
+        redh.set_anomaly_state(
+            self.ticker,
+            self.expr,
+            {
+                "timestamp": int(timestamp),
+                "strikes": strikes.tolist(),
+                "values": values,
+                "stats": stats,
+            },
+        )
+        if alerts:
+            redh.push_alerts(*alerts)
+        return alerts
+
+    def previous(self, state, option_type, field, strikes):
+        """
+        previous values and statistics realigned on strikes
+        """
+        if not state:
+            zeros = np.zeros(len(strikes))
+            return np.full(len(strikes), np.nan), zeros, zeros, zeros
+
+        prev_strikes = state["strikes"]
+        prev = _realign(state["values"][option_type][field], prev_strikes, strikes)
+        stats = state["stats"][option_type][field]
+        return (
+            prev,
+            _realign(stats["mean"], prev_strikes, strikes, 0),
+            _realign(stats["var"], prev_strikes, strikes, 0),
+            _realign(stats["n"], prev_strikes, strikes, 0),
+        )
@@ -0,0 +1,56 @@
+from helpers import redis_helpers as redh
+from models.option import Option
+
+
+class Catalog:
+    """
+    1. Known expirations and per expiration scraper timestamps
+    kept in redis sorted sets so the API doesn't have to run
+    distinct() over the whole options collection
+
+    2. Maintained by OptionWriter as documents are written
+
+    3. rebuild() backfills it from mongo (first deploy / after
+    a purge), it also runs automatically when the catalog is empty
+    """
+
+    @classmethod
+    def add(cls, docs):
+        redh.add_to_catalog(
+            (doc["expiration"], doc["scraper_timestamp"])
+            for doc in docs
+            if doc.get("expiration") and doc.get("scraper_timestamp")
+        )
+
+    @classmethod
+    def rebuild(cls):
+        redh.purge_catalog()
+        groups = Option().collection.aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": "$expiration",
+                        "timestamps": {"$addToSet": "$scraper_timestamp"},
+                    }
+                }
+            ]
+        )
+        for group in groups:
+            cls.add(
+                {"expiration": group["_id"], "scraper_timestamp": timestamp}
+                for timestamp in group["timestamps"]
+            )
+
+    @classmethod
+    def expirations(cls):
+        if not (res := redh.get_catalog_expirations()):
+            cls.rebuild()
+            res = redh.get_catalog_expirations()
+        return res
+
+    @classmethod
+    def timestamps(cls, expr):
+        if not (res := redh.get_catalog_timestamps(expr)) and expr in cls.expirations():
+            cls.rebuild()
+            res = redh.get_catalog_timestamps(expr)
+        return list(map(int, res))
@@ -1,6 +1,16 @@
-import time
+from config import config
+
+from concurrent.futures import ThreadPoolExecutor
+
 from helpers import redis_helpers as redh
 from helpers import date_helpers as dh
+from helpers import hood_helpers as hood
+from helpers.cache_helpers import LocalCache
+from helpers.retry_helpers import call_with_retry
+
+# in process copies of the redis hashes, dropped everywhere on purge
+_exprs_cache = LocalCache("exprs")
+_chain_metadata_cache = LocalCache("chain_metadata")
 
 
 class ExpirationDateCache:
@@ -21,25 +31,138 @@ class ExpirationDateCache:
     Saturdays and uploaded to git by Saturday evening:
 
     https://github.com/melder/symbols_options_csvs
+
+    4. With more than the next weekly configured (expirations in
+    settings.yml) each ticker's set of expirations is selected
+    from its cached chain metadata (chain id + expiration dates),
+    one get_chains call per ticker until purged
+
+    5. Both hashes are also cached in process (see LocalCache), so
+    chain_id() lookups of a sweep don't hit redis. Writes and
+    purge() drop those copies in every process
     """
 
     # scrape attempts assuming network/rate limit/etc errors
     retry_count = 10
-    retry_sleep = 10.1
+
+    # sweeps resolve before taking their lock and can't wait out a
+    # long backoff, populate-exprs prefetches with retry_count
+    sweep_retry_count = 2
+
+    # concurrent API lookups of missing tickers (rate limit still applies)
+    concurrency = config.setting("concurrency", default=8)
+
+    # expirations scraped per ticker: next N weeklies + next N monthlies
+    weeklies = config.setting("expirations", "weeklies", default=1)
+    monthlies = config.setting("expirations", "monthlies", default=0)
 
     @classmethod
     def populate(cls, tickers):
-        for ticker in tickers:
-            print(ticker)
-            cls(ticker).get_expr()
+        exprs = cls.resolve_sets(tickers)
+        missing = [ticker for ticker, expr_set in exprs.items() if not expr_set]
+        print(f"{len(exprs) - len(missing)} / {len(exprs)} expirations cached")
+        if missing:
+            print(f"Failed: {', '.join(missing)}")
+
+    @classmethod
+    def fetch_missing(cls, tickers, fetch):
+        """
+        {ticker: fetch(ticker)} fetched concurrently, empty results dropped
+        """
+        with ThreadPoolExecutor(max_workers=cls.concurrency) as pool:
+            res = dict(zip(tickers, pool.map(fetch, tickers)))
+        return {ticker: value for ticker, value in res.items() if value}
+
+    @classmethod
+    def resolve(cls, tickers, retry_count=None):
+        """
+        Bulk get_expr: {ticker: expr (None if it couldn't be fetched)}
+
+        1. The whole hash is read in one HGETALL
+
+        2. Only missing tickers hit the API, concurrently (retry_count
+        attempts each, default cls.retry_count)
+
+        3. Fetched expirations are written back in one HSET
+        """
+        exprs = dict(cls.get_all_exprs())
+        if missing := [t for t in tickers if not exprs.get(t)]:
+            fetched = cls.fetch_missing(
+                missing, lambda t: cls(t).fetch_expr(retry_count)
+            )
+            if fetched:
+                redh.set_expr_dates(fetched)
+                _exprs_cache.publish("all")
+            exprs |= fetched
+
+        return {ticker: exprs.get(ticker) for ticker in tickers}
+
+    @classmethod
+    def resolve_sets(cls, tickers, retry_count=None):
+        """
+        {ticker: [expr, ...]} (empty if it couldn't be fetched)
+        """
+        if cls.weeklies == 1 and not cls.monthlies:
+            return {
+                t: [e] if e else []
+                for t, e in cls.resolve(tickers, retry_count).items()
+            }
+
+        metadata = cls.chain_metadata(tickers, retry_count)
+        return {
+            ticker: dh.select_exprs(
+                metadata.get(ticker, {}).get("expiration_dates", []),
+                cls.weeklies,
+                cls.monthlies,
+            )
+            for ticker in tickers
+        }
+
+    @classmethod
+    def chain_metadata(cls, tickers, retry_count=None):
+        """
+        {ticker: {"id", "expiration_dates"}}, same HGETALL / concurrent
+        fetch of missing tickers / single HSET as resolve
+        """
+        metadata = {t: m for t in tickers if (m := _chain_metadata_cache.get(t))}
+        if len(metadata) == len(tickers):
+            return metadata
+
+        metadata = redh.get_all_chain_metadata()
+        if missing := [t for t in tickers if t not in metadata]:
+            fetched = cls.fetch_missing(
+                missing, lambda t: cls(t).fetch_chain_metadata(retry_count)
+            )
+            if fetched:
+                redh.set_chain_metadata(fetched)
+                _chain_metadata_cache.publish(*fetched)
+            metadata |= fetched
+
+        for ticker, m in metadata.items():
+            _chain_metadata_cache.set(ticker, m)
+        return {ticker: metadata[ticker] for ticker in tickers if ticker in metadata}
+
+    @classmethod
+    def chain_id(cls, ticker):
+        if metadata := _chain_metadata_cache.get_or_load(
+            ticker, lambda: redh.get_chain_metadata(ticker)
+        ):
+            return metadata.get("id")
+        return None
 
     @classmethod
     def purge(cls):
         redh.purge_expr_dates()
+        redh.purge_chain_metadata()
+        _exprs_cache.publish()
+        _chain_metadata_cache.publish()
 
     @classmethod
     def get_all_exprs(cls):
-        return redh.get_all_expr_dates()
+        return (
+            _exprs_cache.get_or_load("all", lambda: redh.get_all_expr_dates() or None)
+            or {}
+        )
 
     @classmethod
     def get_all_exprs_dates(cls, compress=False):
@@ -53,10 +176,30 @@ class ExpirationDateCache:
         return redh.get_expr_date(self.ticker) or self.get_set_expr()
 
     def get_set_expr(self):
-        for _ in range(self.retry_count):
-            if res := dh.next_expr_for_ticker(self.ticker):
-                redh.set_expr_date(self.ticker, res)
-                return res
-            time.sleep(self.retry_sleep)
+        if res := self.fetch_expr():
+            redh.set_expr_date(self.ticker, res)
+            _exprs_cache.publish("all")
+            return res
 
         return None
+
+    def fetch_expr(self, retry_count=None):
+        return call_with_retry(
+            dh.next_expr_for_ticker,
+            self.ticker,
+            retry_count=retry_count or self.retry_count,
+        )
+
+    def fetch_chain_metadata(self, retry_count=None):
+        if not (
+            res := call_with_retry(
+                hood.get_chains,
+                self.ticker,
+                retry_count=retry_count or self.retry_count,
+            )
+        ):
+            return None
+        return {
+            "id": res.get("id"),
+            "expiration_dates": sorted(res.get("expiration_dates") or []),
+        }
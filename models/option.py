@@ -1,5 +1,162 @@
 from config import config
 
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from helpers import chain_helpers as ch
+
+_DUPLICATE_KEY_ERROR = 11000
+
+# unique key of a snapshot, one document per ticker / expiration / sweep
+_SNAPSHOT_KEY = [("ticker", 1), ("expiration", 1), ("scraper_timestamp", 1)]
+
+# unique key of deployments predating multiple expirations per ticker,
+# it rejects every expiration of a sweep but the first
+_LEGACY_SNAPSHOT_KEY = [("ticker", 1), ("scraper_timestamp", 1)]
+
+# properties needed to rebuild delta encoded chains
+_DELTA_PROJECTION = {
+    "ticker": 1,
+    "expiration": 1,
+    "scraper_timestamp": 1,
+    "keyframe": 1,
+    "keyframe_timestamp": 1,
+    "prev_timestamp": 1,
+    "delta": 1,
+}
+
+
+_STRIKES_PROJECTION = {
+    "_id": 0,
+    "scraper_timestamp": 1,
+    "price": 1,
+    "options.type": 1,
+    "options.strike_price": 1,
+    "options.volume": 1,
+    "options.open_interest": 1,
+    "chain.strikes": 1,
+    "chain.call.volume": 1,
+    "chain.call.open_interest": 1,
+    "chain.put.volume": 1,
+    "chain.put.open_interest": 1,
+}
+
+
+# scraper_timestamp is stored as a 10 digit epoch string
+_MAX_TIMESTAMP = 9999999999
+
+
+def _timestamp_bound(ts):
+    """
+    epoch (int or digit string) as a stored scraper_timestamp, so range
+    bounds compare numerically even though the field is a string
+    """
+    return f"{min(max(int(ts), 0), _MAX_TIMESTAMP):010d}"
+
+
+def _snapshot_filter(
+    ticker, expr, timestamp=None, from_ts=None, to_ts=None, after=None
+):
+    """
+    from_ts / to_ts: epoch bounds (inclusive)
+    after: pagination cursor, scraper_timestamp of the last snapshot of the previous page
+    """
+    _filter = {"ticker": ticker, "expiration": expr}
+    if timestamp:
+        _filter["scraper_timestamp"] = timestamp
+        return _filter
+
+    conditions = {}
+    if from_ts is not None:
+        conditions["$gte"] = _timestamp_bound(from_ts)
+    if to_ts is not None:
+        conditions["$lte"] = _timestamp_bound(to_ts)
+    if after is not None:
+        conditions["$gt"] = _timestamp_bound(after)
+    if conditions:
+        _filter["scraper_timestamp"] = conditions
+    return _filter
+
+
+def _in_window(strike, strike_min=None, strike_max=None):
+    return (strike_min is None or strike >= strike_min) and (
+        strike_max is None or strike <= strike_max
+    )
+
+
+def _compact_entries(option_type):
+    """
+    aggregation expression: compact chain arrays -> [{strike, type, volume, open_interest}]
+    """
+    return {
+        "$map": {
+            "input": {"$range": [0, {"$size": {"$ifNull": ["$chain.strikes", []]}}]},
+            "as": "i",
+            "in": {
+                "strike": {"$arrayElemAt": ["$chain.strikes", "$$i"]},
+                "type": option_type,
+                "volume": {"$arrayElemAt": [f"$chain.{option_type}.volume", "$$i"]},
+                "open_interest": {
+                    "$arrayElemAt": [f"$chain.{option_type}.open_interest", "$$i"]
+                },
+            },
+        }
+    }
+
+
+# aggregation expression: raw options -> [{strike, type, volume, open_interest}]
+_RAW_ENTRIES = {
+    "$map": {
+        "input": {"$ifNull": ["$options", []]},
+        "as": "o",
+        "in": {
+            "strike": {
+                "$convert": {
+                    "input": "$$o.strike_price",
+                    "to": "double",
+                    "onError": None,
+                    "onNull": None,
+                }
+            },
+            "type": "$$o.type",
+            "volume": {"$ifNull": ["$$o.volume", 0]},
+            "open_interest": {"$ifNull": ["$$o.open_interest", 0]},
+        },
+    }
+}
+
+
+def _pivot(option_type):
+    return {
+        "$max": {
+            "$cond": [
+                {"$eq": ["$entries.type", option_type]},
+                {
+                    "volume": {"$ifNull": ["$entries.volume", 0]},
+                    "open_interest": {"$ifNull": ["$entries.open_interest", 0]},
+                },
+                None,
+            ]
+        }
+    }
+
+
+def _stored(write_error):
+    """
+    True if a bulk write error is a duplicate of the full snapshot
+    key (or _id), any other unique index means the document is lost
+    """
+    if write_error.get("code") != _DUPLICATE_KEY_ERROR:
+        return False
+    if (pattern := write_error.get("keyPattern")) is not None:
+        return list(pattern) in [[k for k, _ in _SNAPSHOT_KEY], ["_id"]]
+
+    # servers without keyPattern only name the index in errmsg
+    errmsg = write_error.get("errmsg", "")
+    return "index: _id_ " in errmsg or (
+        "index: ticker_1_expiration_1_scraper_timestamp_1 " in errmsg
+    )
+
 
 class Option:
     """
@@ -12,7 +169,15 @@ class Option:
     2. API data is from HOOD
     """
 
-    collection_name = ".".join([config.namespace, "options"])
+    collection_name = config.LazyAttribute(
+        lambda: ".".join([config.namespace, "options"])
+    )
+
+    # expirations / timestamps are tracked in Catalog when written
+    cataloged = True
+
+    # (database, collection) pairs whose indexes were ensured
+    indexed = set()
 
     @classmethod
     def test_mongo(cls):
@@ -30,6 +195,24 @@ class Option:
     def validate_properties(self, docs):
         pass
 
+    def ensure_index(self):
+        """
+        (ticker, expiration, scraper_timestamp) unique index, created once
+        per process. A legacy (ticker, scraper_timestamp) unique index is
+        dropped once the new one exists
+        """
+        if (key := (self.db.name, self.collection_name)) in self.indexed:
+            return
+        self.collection.create_index(_SNAPSHOT_KEY, unique=True)
+        for name, index in self.collection.index_information().items():
+            if index.get("unique") and list(index["key"]) == _LEGACY_SNAPSHOT_KEY:
+                try:
+                    self.collection.drop_index(name)
+                except OperationFailure as err:
+                    # dropped concurrently by another process
+                    print(f"Unexpected {err=}, {type(err)=}")
+        self.indexed.add(key)
+
     def create(self, docs):
         """
         inserts a dict or array of dicts
@@ -40,9 +223,248 @@ class Option:
             return self.collection.insert_one(docs)
         return self.collection.insert_many(docs)
 
+    def bulk_create(self, docs):
+        """
+        unordered bulk insert of an array of dicts. Documents hitting
+        the (ticker, expiration, scraper_timestamp) unique index (or their
+        own _id on a retry) are already stored so retrying a batch is
+        idempotent
+
+        returns the documents that failed for any other reason
+        """
+        self.validate_properties(docs)
+        self.ensure_index()
+
+        try:
+            self.collection.bulk_write([InsertOne(d) for d in docs], ordered=False)
+        except BulkWriteError as err:
+            return [
+                docs[e["index"]]
+                for e in err.details.get("writeErrors", [])
+                if not _stored(e)
+            ]
+        return []
+
     def find(self, query=None):
         return list(self.collection.find(query))
 
+    def find_chains(self, query=None, projection=None, limit=0):
+        """
+        Generator of documents sorted by scraper_timestamp where delta
+        encoded documents have their 'chain' rebuilt. Consecutive
+        deltas are applied to the previous document's chain, only the
+        first delta of a ticker / expiration needs a keyframe lookup
+        """
+        if projection:
+            projection = projection | _DELTA_PROJECTION
+
+        last = {}
+        cursor = (
+            self.collection.find(query, projection)
+            .sort("scraper_timestamp", 1)
+            .limit(limit)
+        )
+        for doc in cursor:
+            key = (doc.get("ticker"), doc.get("expiration"))
+            if "delta" in doc:
+                prev_timestamp, chain = last.get(key, (None, None))
+                if prev_timestamp == doc["prev_timestamp"] and chain:
+                    doc["chain"] = ch.apply_compact_diff(chain, doc.pop("delta"))
+                else:
+                    doc.pop("delta")
+                    if chain := self.chain_at(*key, doc["scraper_timestamp"]):
+                        doc["chain"] = chain
+            if "chain" in doc:
+                last[key] = (doc.get("scraper_timestamp"), doc["chain"])
+            yield doc
+
+    def aggregate_strikes(
+        self,
+        ticker,
+        expr,
+        timestamp=None,
+        from_ts=None,
+        to_ts=None,
+        strike_min=None,
+        strike_max=None,
+        after=None,
+        limit=0,
+    ):
+        """
+        Generator of {"scraper_timestamp", "price", "strikes": {strike: {type: {volume, open_interest}}}}
+        sorted by scraper_timestamp, at most limit snapshots after the
+        `after` cursor. Unwinding, strike window filtering,
+        grouping by strike and the call / put pivot all run inside mongo
+        so only one reshaped snapshot at a time is held here.
+
+        $group / $sort are blocking stages: the first snapshot is only
+        returned once every matched one is grouped, so time to first
+        byte grows with the range unless limit bounds it.
+        strikes_history streams from the first document
+
+        Raw and compact documents only, delta documents need
+        find_chains (see strikes_history)
+        """
+        entry_conditions = [
+            {"$ne": ["$$e.strike", None]},
+            {"$in": ["$$e.type", ch.OPTION_TYPES]},
+            {
+                "$or": [
+                    {"$ne": ["$$e.volume", None]},
+                    {"$ne": ["$$e.open_interest", None]},
+                ]
+            },
+        ]
+        if strike_min is not None:
+            entry_conditions.append({"$gte": ["$$e.strike", strike_min]})
+        if strike_max is not None:
+            entry_conditions.append({"$lte": ["$$e.strike", strike_max]})
+
+        pipeline = [
+            {
+                "$match": _snapshot_filter(
+                    ticker, expr, timestamp, from_ts, to_ts, after
+                )
+                | {"delta": {"$exists": False}}
+            },
+            # one document per snapshot, so pages are limited before unwinding
+            {"$sort": {"scraper_timestamp": 1}},
+        ]
+        if limit:
+            pipeline.append({"$limit": limit})
+        pipeline += [
+            {
+                "$project": {
+                    "_id": 0,
+                    "scraper_timestamp": 1,
+                    "price": 1,
+                    "entries": {
+                        "$filter": {
+                            "input": {
+                                "$cond": [
+                                    {"$isArray": "$chain.strikes"},
+                                    {
+                                        "$concatArrays": [
+                                            _compact_entries(t) for t in ch.OPTION_TYPES
+                                        ]
+                                    },
+                                    _RAW_ENTRIES,
+                                ]
+                            },
+                            "as": "e",
+                            "cond": {"$and": entry_conditions},
+                        }
+                    },
+                }
+            },
+            # snapshots without strikes in the window are kept (empty strikes)
+            {"$unwind": {"path": "$entries", "preserveNullAndEmptyArrays": True}},
+            {
+                "$group": {
+                    "_id": {"ts": "$scraper_timestamp", "strike": "$entries.strike"},
+                    "price": {"$first": "$price"},
+                }
+                | {t: _pivot(t) for t in ch.OPTION_TYPES}
+            },
+            {"$sort": {"_id.ts": 1, "_id.strike": 1}},
+            {
+                "$group": {
+                    "_id": "$_id.ts",
+                    "price": {"$first": "$price"},
+                    "strikes": {
+                        "$push": {"strike": "$_id.strike"}
+                        | {t: f"${t}" for t in ch.OPTION_TYPES}
+                    },
+                }
+            },
+            {"$sort": {"_id": 1}},
+        ]
+
+        for doc in self.collection.aggregate(pipeline, allowDiskUse=True):
+            yield {
+                "scraper_timestamp": doc["_id"],
+                "price": doc.get("price", 0),
+                "strikes": {
+                    s["strike"]: {t: s[t] for t in ch.OPTION_TYPES if s.get(t)}
+                    for s in doc["strikes"]
+                    if s.get("strike") is not None
+                },
+            }
+
+    def strikes_history(
+        self,
+        ticker,
+        expr,
+        timestamp=None,
+        from_ts=None,
+        to_ts=None,
+        strike_min=None,
+        strike_max=None,
+        after=None,
+        limit=0,
+    ):
+        """
+        Same output as aggregate_strikes, reshaped here from find_chains
+        so it works for every storage mode (including delta)
+        """
+        docs = self.find_chains(
+            _snapshot_filter(ticker, expr, timestamp, from_ts, to_ts, after),
+            _STRIKES_PROJECTION,
+            limit,
+        )
+        for doc in docs:
+            if not (scraper_timestamp := doc.get("scraper_timestamp")):
+                continue
+            yield {
+                "scraper_timestamp": scraper_timestamp,
+                "price": doc.get("price", 0),
+                "strikes": {
+                    strike: types
+                    for strike, types in ch.strikes_from_document(doc).items()
+                    if _in_window(strike, strike_min, strike_max)
+                },
+            }
+
+    def chain_at(self, ticker, expr, scraper_timestamp):
+        """
+        Compact chain of a ticker / expiration at scraper_timestamp
+        regardless of how it was stored (raw, compact or delta)
+        """
+        _filter = {"ticker": ticker, "expiration": expr}
+        doc = self.collection.find_one(
+            _filter | {"scraper_timestamp": scraper_timestamp},
+            _DELTA_PROJECTION | {"chain": 1, "options": 1},
+        )
+        if not doc:
+            return None
+        if "delta" not in doc:
+            return doc.get("chain") or ch.compact_chain(doc.get("options", []))
+
+        docs = {
+            d["scraper_timestamp"]: d
+            for d in self.collection.find(
+                _filter
+                | {
+                    "scraper_timestamp": {
+                        "$gte": doc["keyframe_timestamp"],
+                        "$lt": scraper_timestamp,
+                    }
+                },
+                _DELTA_PROJECTION | {"chain": 1},
+            )
+        }
+
+        deltas = []
+        while "delta" in doc:
+            deltas.append(doc["delta"])
+            if not (doc := docs.get(doc["prev_timestamp"])):
+                return None
+
+        chain = doc["chain"]
+        for delta in reversed(deltas):
+            chain = ch.apply_compact_diff(chain, delta)
+        return chain
+
     def update(self):
         raise NotImplementedError
 
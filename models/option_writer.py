@@ -0,0 +1,183 @@
+import time
+import uuid
+from collections import defaultdict
+
+import bson
+from pymongo.errors import PyMongoError
+
+from helpers import redis_helpers as redh
+from helpers.retry_helpers import backoff_delay
+from models.catalog import Catalog
+from models.option import Option
+from models.strike_rollup import StrikeRollup
+
+
+class OptionWriter:
+    """
+    Write-behind buffer for scraped option documents
+
+    1. Documents are BSON encoded when added, either into a
+    local buffer (in process scrapes) or onto a redis list
+    shared by the rq workers (queued=True) so scrape jobs
+    never touch mongo
+
+    2. Buffers are flushed in unordered bulk_write batches
+    capped by document count and encoded size
+
+    3. Every flush that writes something bumps the data version
+    which invalidates cached API responses (see wsgi.py)
+
+    4. Written option documents are added to the expirations /
+    timestamps Catalog and rolled up into StrikeRollup series,
+    delta encoded ones mark their snapshot as stored
+
+    5. Failed batches are retried with backoff. Duplicates of
+    the (ticker, expiration, scraper_timestamp) unique index
+    (created / migrated by Option.ensure_index) count as
+    written, so retries are idempotent. Documents that still
+    fail are pushed (back) onto the redis queue for the next
+    flush_queued (flush job / flush-writes)
+
+    6. Queued documents are moved onto a processing list while
+    they are written and only dropped once bulk_create returned,
+    documents of a flush that crashed are requeued by the next one
+    """
+
+    batch_count = 200
+    batch_bytes = 8 * 1024 * 1024
+    retry_count = 4
+
+    @classmethod
+    def flush_queued(cls, model=Option):
+        """
+        Drains the redis document queue of model's collection,
+        returns # of documents written. One flush per collection
+        runs at a time, others return 0
+        """
+        writer = cls(model)
+        name = model.collection_name
+        token = uuid.uuid4().hex
+        if not redh.acquire_flush_lock(name, token):
+            print(f"{name} documents are already being flushed")
+            return 0
+
+        written = 0
+        try:
+            if requeued := redh.requeue_claimed_documents(name):
+                print(f"Requeued {requeued} unreleased {name} documents")
+
+            while blobs := redh.claim_documents(name, writer.batch_count):
+                failed = writer.write(blobs, model)
+                redh.release_documents(name, *failed)
+                written += len(blobs) - len(failed)
+                if failed or not redh.acquire_flush_lock(name, token):
+                    break
+        finally:
+            redh.release_flush_lock(name, token)
+
+        if written:
+            redh.bump_data_version()
+        return written
+
+    def __init__(self, model=Option, queued=False, database=None):
+        """
+        model: default model documents are written to, add() can
+        route documents to other models (e.g. RawOption)
+        """
+        self.model = model
+        self.queued = queued
+        self.database = database
+        self.collections = {}
+        self.buffers = defaultdict(list)
+        self.buffer_bytes = defaultdict(int)
+
+    def add(self, doc, model=None):
+        model = model or self.model
+        blob = bson.encode(doc)
+
+        if self.queued:
+            redh.push_documents(model.collection_name, blob)
+            return
+
+        self.buffers[model].append(blob)
+        self.buffer_bytes[model] += len(blob)
+        if (
+            len(self.buffers[model]) >= self.batch_count
+            or self.buffer_bytes[model] >= self.batch_bytes
+        ):
+            self.flush(model)
+
+    def flush(self, model=None):
+        """
+        flushes model's buffer or all buffers, returns blobs that
+        failed. Those are pushed onto the redis queue for flush_queued
+        """
+        failed, written = [], 0
+        for m in [model] if model else list(self.buffers):
+            if blobs := self.buffers.pop(m, []):
+                m_failed = self.write(blobs, m)
+                written += len(blobs) - len(m_failed)
+                failed += m_failed
+                if m_failed:
+                    redh.push_documents(m.collection_name, *m_failed)
+                    print(f"Queued {len(m_failed)} {m.collection_name} documents")
+            self.buffer_bytes.pop(m, None)
+
+        if written:
+            redh.bump_data_version()
+        return failed
+
+    def batches(self, blobs):
+        batch, size = [], 0
+        for blob in blobs:
+            if batch and (
+                len(batch) >= self.batch_count or size + len(blob) > self.batch_bytes
+            ):
+                yield batch
+                batch, size = [], 0
+            batch.append(blob)
+            size += len(blob)
+        if batch:
+            yield batch
+
+    def write(self, blobs, model=None):
+        """
+        returns blobs that could not be written
+        """
+        failed = []
+        for batch in self.batches(blobs):
+            failed += self.write_batch(batch, model or self.model)
+        return failed
+
+    def write_batch(self, blobs, model):
+        if model not in self.collections:
+            self.collections[model] = model(self.database)
+
+        batch = docs = [bson.decode(b) for b in blobs]
+        for attempt in range(self.retry_count):
+            try:
+                if not (docs := self.collections[model].bulk_create(docs)):
+                    break
+            except PyMongoError as err:
+                print(f"Unexpected {err=}, {type(err)=}")
+            if attempt < self.retry_count - 1:
+                time.sleep(backoff_delay(attempt))
+
+        if model.cataloged:
+            failed_ids = {id(d) for d in docs}
+            written = [d for d in batch if id(d) not in failed_ids]
+            Catalog.add(written)
+            StrikeRollup.add(written, self.database)
+            # delta encoded snapshots may only diff against written ones
+            if stored := {
+                (d["ticker"], d["expiration"]): d["scraper_timestamp"]
+                for d in written
+                if "keyframe" in d
+            }:
+                redh.set_delta_stored(stored)
+
+        if not docs:
+            return []
+
+        print(f"Failed to write {len(docs)} {model.collection_name} documents")
+        return [bson.encode(d) for d in docs]
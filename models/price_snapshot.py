@@ -0,0 +1,63 @@
+from helpers import redis_helpers as redh
+from helpers import hood_helpers as hood
+
+
+class PriceSnapshot:
+    """
+    1. Underlying prices for every ticker of a sweep, fetched
+    in bulk quote requests when the sweep starts instead of
+    one get_price call per ticker (and per retry)
+
+    2. Keyed by the sweep's scraper_timestamp in redis so every
+    worker of the sweep reads the same price and every document
+    of one scraper_timestamp is consistent
+
+    3. Tickers missing from the snapshot (quote failed) fall
+    back to a single get_price call which is then saved. A
+    failed snapshot never aborts the sweep, every ticker
+    then falls back
+    """
+
+    @classmethod
+    def take(cls, timestamp, tickers):
+        snapshot = cls(timestamp)
+        try:
+            snapshot.save(hood.get_prices(tickers))
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            print(f"Unexpected {err=}, {type(err)=}")
+            print(f"Failed to take price snapshot {timestamp}")
+        return snapshot
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        self.prices = None
+
+    def load(self):
+        if self.prices is None:
+            self.prices = (
+                redh.get_price_snapshot(self.timestamp) if self.timestamp else {}
+            )
+        return self.prices
+
+    def save(self, prices, overwrite=True):
+        """
+        overwrite=False only fills in tickers not yet in the snapshot
+        """
+        if self.timestamp and prices:
+            redh.set_price_snapshot(self.timestamp, prices, overwrite=overwrite)
+        self.prices = None
+
+    def get(self, ticker):
+        if price := self.load().get(ticker):
+            return price
+
+        try:
+            price = hood.get_price(ticker)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            print(f"Unexpected {err=}, {type(err)=}")
+            return None
+
+        if price:
+            self.save({ticker: price}, overwrite=False)
+            return self.load().get(ticker, price)
+        return price
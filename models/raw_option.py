@@ -0,0 +1,19 @@
+from config import config
+from models.option import Option
+
+
+class RawOption(Option):
+    """
+    Cold storage of the untouched option API JSON for compact
+    storage mode (storage.keep_raw in settings.yml). Documents:
+
+    - scraper_timestamp (int)
+    - ticker (str)
+    - expiration (ISO8601 date str)
+    - options (array of dict JSON responses HOOD API returns)
+    """
+
+    collection_name = config.LazyAttribute(
+        lambda: ".".join([config.namespace, "options_raw"])
+    )
+    cataloged = False
@@ -0,0 +1,99 @@
+from config import config
+
+import statistics
+
+from helpers import redis_helpers as redh
+from helpers.chain_helpers import OPTION_TYPES
+
+
+class ScrapePlan:
+    """
+    Orders a sweep's scrape jobs to minimize its makespan
+
+    1. Each ticker / expiration's cost is the seconds its scrape
+    took in the previous sweep, or the ticker's expiration at the
+    same position when expirations rolled over. Ones without
+    timings are estimated from their contract count, ones never
+    seen cost as much as the most expensive one so they are
+    started early
+
+    2. Chains with more than `max_contracts` contracts are split
+    into call / put shards scraped by separate jobs and merged
+    before being stored (see merge_shards_job)
+
+    3. Jobs are returned longest first (LPT scheduling). The first
+    `workers` jobs go to the high priority queue so every worker
+    starts on one of the biggest chains
+    """
+
+    max_contracts = config.setting("sharding", "max_contracts", default=2000)
+
+    high_priority_queue = config.LazyAttribute(lambda: f"{config.namespace}_high")
+    default_queue = config.LazyAttribute(lambda: config.namespace)
+
+    @classmethod
+    def queue_names(cls):
+        """
+        in the order workers should listen to them
+        """
+        return [cls.high_priority_queue, cls.default_queue]
+
+    def __init__(self, timestamp, exprs):
+        """
+        exprs: {ticker: [expr, ...]}
+        """
+        self.timestamp = timestamp
+        self.exprs = exprs
+
+        prev_timestamp = redh.swap_last_sweep(timestamp)
+        self.costs = redh.get_job_costs(prev_timestamp) if prev_timestamp else {}
+
+        # previous costs by ticker in expiration order
+        self.slots = {}
+        for ticker, expr in sorted(self.costs):
+            self.slots.setdefault(ticker, []).append(self.costs[(ticker, expr)])
+
+    def estimate(self, ticker, expr, slot=0):
+        """
+        (contracts, seconds) expected for the scrape of ticker's
+        expr, slot: position of expr in the ticker's expirations
+        """
+        cost = self.costs.get((ticker, expr))
+        if cost is None and slot < len(slots := self.slots.get(ticker, [])):
+            cost = slots[slot]
+        cost = cost or {}
+        contracts = cost.get("contracts", 0)
+        if seconds := cost.get("seconds"):
+            return contracts, seconds
+
+        timed = [c for c in self.costs.values() if c.get("seconds")]
+        per_contract = [
+            c["seconds"] / c["contracts"] for c in timed if c.get("contracts")
+        ]
+        if contracts and per_contract:
+            return contracts, contracts * statistics.median(per_contract)
+        return contracts, max((c["seconds"] for c in timed), default=1.0)
+
+    def jobs(self):
+        """
+        [(ticker, expr, option_type (None unless sharded), estimated seconds)]
+        longest first
+        """
+        res = []
+        for ticker, exprs in self.exprs.items():
+            for slot, expr in enumerate(exprs):
+                contracts, seconds = self.estimate(ticker, expr, slot)
+                if contracts > self.max_contracts:
+                    shard_seconds = seconds / len(OPTION_TYPES)
+                    res += [(ticker, expr, t, shard_seconds) for t in OPTION_TYPES]
+                else:
+                    res.append((ticker, expr, None, seconds))
+        return sorted(res, key=lambda job: job[3], reverse=True)
+
+    def queue_name(self, position):
+        """
+        queue of the job at position (in jobs() order)
+        """
+        if position < config.conf.workers:
+            return self.high_priority_queue
+        return self.default_queue
@@ -0,0 +1,298 @@
+from config import config
+
+import time
+import uuid
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from helpers import chain_helpers as ch
+from helpers import redis_helpers as redh
+from helpers.retry_helpers import backoff_delay
+from models.option import _DUPLICATE_KEY_ERROR, Option
+
+# option documents replayed per add() call by rebuild()
+_REBUILD_BATCH = 200
+
+
+def _volume_change(volume, prev_volume):
+    """
+    volume is cumulative for the session, a drop means a new session started
+    """
+    if prev_volume is None:
+        return None
+    return volume - prev_volume if volume >= prev_volume else volume
+
+
+def _point(timestamp, types, prev_types):
+    """
+    one time series entry of a strike:
+
+    {
+        "t": scraper_timestamp (int),
+        "call": {"volume", "open_interest", "volume_change", "open_interest_change"},
+        "put": {...},
+        "put_call_ratio": put volume / call volume (None without call volume),
+    }
+
+    changes are None on the strike's first entry
+    """
+    res = {"t": timestamp}
+    for option_type in ch.OPTION_TYPES:
+        if not (values := types.get(option_type)):
+            continue
+        prev = prev_types.get(option_type, {})
+        prev_open_interest = prev.get("open_interest")
+        res[option_type] = values | {
+            "volume_change": _volume_change(values["volume"], prev.get("volume")),
+            "open_interest_change": (
+                None
+                if prev_open_interest is None
+                else values["open_interest"] - prev_open_interest
+            ),
+        }
+
+    call_volume = res.get("call", {}).get("volume")
+    put_volume = res.get("put", {}).get("volume", 0)
+    res["put_call_ratio"] = put_volume / call_volume if call_volume else None
+    return res
+
+
+class StrikeRollup:
+    """
+    Precomputed volume / open interest time series, one document
+    per ticker / expiration / strike:
+
+    - ticker (str)
+    - expiration (ISO8601 date str)
+    - strike (float)
+    - last_timestamp (int)
+    - series (array of entries, see _point)
+
+    1. Maintained incrementally by OptionWriter as option documents
+    are written. Each snapshot is compared against the previous one
+    of its ticker / expiration (volume / open interest only, kept in
+    redis) and only strikes that changed get an entry appended, so
+    a series is a step function of the scraped values
+
+    2. Delta encoded documents are applied to the previous state
+    directly, chain_at() is only needed when the state is stale
+
+    3. rebuild() replays the whole options collection (first deploy
+    / after a purge)
+
+    4. add() holds a redis lock from reading the states to saving
+    them, so concurrent writers never diff against the same state.
+    It's extended before each write, states aren't saved once it's lost.
+    Entries are pushed at most once per timestamp (unique index +
+    filter on series.t) so retried operations are idempotent, states
+    of ticker / expirations whose operations failed aren't advanced
+    """
+
+    collection_name = config.LazyAttribute(
+        lambda: ".".join([config.namespace, "strike_rollups"])
+    )
+
+    retry_count = 3
+
+    # (database, collection) whose unique index is known to exist
+    indexed = set()
+
+    @classmethod
+    def add(cls, docs, database=None):
+        """
+        rolls up option documents, returns # of strike entries appended
+        """
+        docs = sorted(
+            (d for d in docs if d.get("ticker") and d.get("expiration")),
+            key=lambda d: int(d.get("scraper_timestamp") or 0),
+        )
+        if not docs:
+            return 0
+
+        rollup = cls(database)
+        token = uuid.uuid4().hex
+        redh.acquire_rollup_lock(token)
+        try:
+            return rollup.roll_up(docs, token)
+        finally:
+            redh.release_rollup_lock(token)
+
+    @classmethod
+    def rebuild(cls):
+        rollup = cls()
+        rollup.collection.drop()
+        cls.indexed.discard((rollup.db.name, rollup.collection_name))
+        redh.purge_rollup_states()
+
+        batch = []
+        for doc in Option().find_chains(
+            projection={"price": 1, "chain": 1, "options": 1}
+        ):
+            batch.append(doc)
+            if len(batch) >= _REBUILD_BATCH:
+                cls.add(batch)
+                batch = []
+        cls.add(batch)
+
+    def __init__(self, database=None):
+        self.db = database if database is not None else config.mongo_db()
+        self.collection = self.db[self.collection_name]
+
+    def ensure_index(self):
+        """
+        (ticker, expiration, strike) unique index, created once per process
+        """
+        if (key := (self.db.name, self.collection_name)) in self.indexed:
+            return
+        self.collection.create_index(
+            [("ticker", 1), ("expiration", 1), ("strike", 1)], unique=True
+        )
+        self.indexed.add(key)
+
+    def roll_up(self, docs, token):
+        """
+        add() with the lock held by token
+        """
+        states = redh.get_rollup_states(
+            list({(d["ticker"], d["expiration"]) for d in docs})
+        )
+        updated, ops = {}, []
+        for doc in docs:
+            key = (doc["ticker"], doc["expiration"])
+            timestamp = int(doc.get("scraper_timestamp") or 0)
+            state = states.get(key)
+
+            # already rolled up (retried batch / replayed queue)
+            if state and timestamp <= int(state["timestamp"]):
+                continue
+            if (chain := self.chain_of(doc, state)) is None:
+                continue
+
+            ops += [(key, op) for op in self.updates(key, timestamp, chain, state)]
+            states[key] = updated[key] = {
+                "timestamp": timestamp,
+                "chain": ch.project_compact(chain),
+            }
+
+        failed = self.write(ops, token)
+        if failed_keys := {key for key, _ in failed}:
+            print(f"Failed to roll up {len(failed)} strike entries")
+
+        # another writer may have read the states since the lock expired,
+        # written entries are idempotent but these states are stale
+        if not redh.extend_rollup_lock(token):
+            print("Lost the rollup lock, states not saved")
+            return len(ops) - len(failed)
+        redh.set_rollup_states(
+            {key: state for key, state in updated.items() if key not in failed_keys}
+        )
+        return len(ops) - len(failed)
+
+    def write(self, ops, token):
+        """
+        ops: [(key, UpdateOne)], retried with backoff, returns the ones
+        that failed. Duplicates of the unique index were already applied.
+        The lock held by token is extended before each attempt, nothing
+        is written once it's lost
+        """
+        for attempt in range(self.retry_count):
+            if not ops:
+                break
+            if not redh.extend_rollup_lock(token):
+                print("Lost the rollup lock")
+                break
+            try:
+                self.ensure_index()
+                self.collection.bulk_write([op for _, op in ops], ordered=False)
+                ops = []
+            except BulkWriteError as err:
+                ops = [
+                    ops[e["index"]]
+                    for e in err.details.get("writeErrors", [])
+                    if e.get("code") != _DUPLICATE_KEY_ERROR
+                ]
+            except PyMongoError as err:
+                print(f"Unexpected {err=}, {type(err)=}")
+            if ops and attempt < self.retry_count - 1:
+                time.sleep(backoff_delay(attempt))
+        return ops
+
+    def chain_of(self, doc, state):
+        """
+        compact chain of an option document in any storage mode
+        """
+        if "chain" in doc:
+            return doc["chain"]
+        if "options" in doc:
+            return ch.compact_chain(doc["options"])
+        if "delta" not in doc:
+            return None
+
+        if state and int(state["timestamp"]) == int(doc["prev_timestamp"]):
+            return ch.apply_compact_diff(state["chain"], doc["delta"])
+        return Option(self.db).chain_at(
+            doc["ticker"], doc["expiration"], doc["scraper_timestamp"]
+        )
+
+    def updates(self, key, timestamp, chain, state):
+        """
+        UpdateOne per strike whose volume / open interest changed. An
+        entry already pushed for timestamp doesn't match the filter, the
+        upsert then hits the unique index instead of pushing it again
+        """
+        ticker, expr = key
+        curr = ch.strikes_from_compact(chain)
+        prev = ch.strikes_from_compact(state["chain"]) if state else {}
+
+        res = []
+        for strike, types in curr.items():
+            if types == (prev_types := prev.get(strike, {})):
+                continue
+            res.append(
+                UpdateOne(
+                    {
+                        "ticker": ticker,
+                        "expiration": expr,
+                        "strike": strike,
+                        "series.t": {"$ne": timestamp},
+                    },
+                    {
+                        "$push": {"series": _point(timestamp, types, prev_types)},
+                        "$set": {"last_timestamp": timestamp},
+                    },
+                    upsert=True,
+                )
+            )
+        return res
+
+    def series(
+        self,
+        ticker,
+        expr,
+        from_ts=None,
+        to_ts=None,
+        strike_min=None,
+        strike_max=None,
+    ):
+        """
+        {strike: [entries]} sorted by strike, entries within from_ts / to_ts (int)
+        """
+        _filter = {"ticker": ticker, "expiration": expr}
+        if strike_min is not None or strike_max is not None:
+            _filter["strike"] = {}
+            if strike_min is not None:
+                _filter["strike"]["$gte"] = strike_min
+            if strike_max is not None:
+                _filter["strike"]["$lte"] = strike_max
+
+        res = {}
+        docs = self.collection.find(_filter, {"_id": 0, "strike": 1, "series": 1})
+        for doc in docs.sort("strike", 1):
+            res[doc["strike"]] = [
+                entry
+                for entry in doc.get("series", [])
+                if (from_ts is None or entry["t"] >= from_ts)
+                and (to_ts is None or entry["t"] <= to_ts)
+            ]
+        return res
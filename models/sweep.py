@@ -0,0 +1,122 @@
+from config import config
+
+import contextlib
+import time
+
+from helpers import redis_helpers as redh
+
+
+class Sweep:
+    """
+    Progress of one sweep (id = scraper_timestamp) in redis
+
+    1. begin() fails while another sweep is in flight so cron ticks
+    never pile sweeps up on the API budget, the skipped tick is
+    counted on the running sweep instead. A sweep that never
+    finishes stops blocking new ones after `timeout` seconds
+
+    2. Every ticker / expiration is one tracked job (its scrape,
+    or the merge of its shards). Job outcomes are recorded by rq callbacks
+    (see on_job_success / on_job_failure), the sweep ends once
+    completed + failed reaches expected
+
+    3. stats() reports duration and lag (age of the newest
+    complete sweep's data)
+
+    4. A sweep whose queueing / scraping raises is aborted (see
+    abort_on_error) so its lock doesn't block sweeps for `timeout`
+    """
+
+    timeout = config.setting("sweep", "timeout", default=900)
+
+    @classmethod
+    def begin(cls, sweep_id, expected):
+        """
+        None if a sweep is already in flight
+        """
+        if redh.begin_sweep(sweep_id, expected, time.time(), cls.timeout):
+            return cls(sweep_id)
+
+        if current := redh.get_current_sweep():
+            redh.incr_sweep(current, skipped=1)
+            print(f"Sweep {current} still in flight, skipping")
+        return None
+
+    @classmethod
+    def current(cls):
+        if sweep_id := redh.get_current_sweep():
+            return cls(sweep_id)
+        return None
+
+    @classmethod
+    def recent(cls, count=10):
+        return [cls(sweep_id) for sweep_id in redh.get_recent_sweeps(count)]
+
+    def __init__(self, sweep_id):
+        self.id = str(sweep_id)
+
+    def abort(self):
+        """
+        ends the sweep as aborted and releases the in flight lock
+        """
+        redh.end_sweep(self.id, time.time(), aborted=True)
+
+    @contextlib.contextmanager
+    def abort_on_error(self):
+        try:
+            yield self
+        except Exception:
+            print(f"Sweep {self.id} failed, aborting")
+            self.abort()
+            raise
+
+    def record(self, completed=0, failed=0):
+        sweep = redh.incr_sweep(self.id, completed=completed, failed=failed)
+        done = int(sweep["completed"]) + int(sweep["failed"])
+        if "ended_at" not in sweep and done >= int(sweep["expected"]):
+            redh.end_sweep(self.id, time.time())
+
+    def stats(self):
+        if not (sweep := redh.get_sweep(self.id)):
+            return None
+
+        started_at = float(sweep["started_at"])
+        ended_at = float(sweep["ended_at"]) if "ended_at" in sweep else None
+        return {
+            "id": self.id,
+            "expected": int(sweep["expected"]),
+            "completed": int(sweep["completed"]),
+            "failed": int(sweep["failed"]),
+            "skipped": int(sweep["skipped"]),
+            "started_at": started_at,
+            "ended_at": ended_at,
+            "duration": (ended_at or time.time()) - started_at,
+            "in_flight": ended_at is None,
+            "aborted": "aborted" in sweep,
+        }
+
+
+def lag(sweeps):
+    """
+    seconds since the newest complete sweep's scraper_timestamp
+    """
+    for stats in sweeps:
+        if stats and not (stats["in_flight"] or stats["aborted"]):
+            return time.time() - int(stats["id"])
+    return None
+
+
+####################
+# RQ JOB CALLBACKS #
+####################
+
+
+def on_job_success(job, connection, result, *args, **kwargs):
+    if sweep_id := job.meta.get("sweep"):
+        Sweep(sweep_id).record(completed=1 if result else 0, failed=0 if result else 1)
+
+
+def on_job_failure(job, connection, exc_type, exc_value, tb):
+    # failed attempts rq retries aren't final
+    if (sweep_id := job.meta.get("sweep")) and not job.retries_left:
+        Sweep(sweep_id).record(failed=1)
@@ -1,22 +1,110 @@
+from collections import defaultdict
 from datetime import datetime, timezone
-from rq import Retry, Queue
+from rq import Callback, Retry, Queue
+from rq.job import Dependency
 
 from config import config
+from models.anomaly_detector import AnomalyDetector
+from models.expiration_date_cache import ExpirationDateCache
+from models.price_snapshot import PriceSnapshot
+from models.scrape_plan import ScrapePlan
+from models.sweep import Sweep, on_job_failure, on_job_success
 
-from workers import scrape_ticker_job
+from workers import (
+    flush_documents_job,
+    merge_shards_job,
+    scrape_ticker_job,
+    send_alerts_job,
+)
+
+# dependents can only be released while their dependencies' results exist
+_SCRAPE_RESULT_TTL = 600
 
 
 def queue_scraping():
-    queue = Queue(
-        config.namespace, connection=config.redis_client(decode_responses=False)
-    )
+    connection = config.redis_client(decode_responses=False)
+    queues = {
+        name: Queue(name, connection=connection) for name in ScrapePlan.queue_names()
+    }
     timestamp = str(round(datetime.timestamp(datetime.now(timezone.utc))))
-    for ticker in config.crypto_tickers:
-        queue.enqueue(
+
+    # resolved once here, before taking the sweep's lock, and passed to the
+    # jobs. Every expiration of a ticker shares its chain metadata and price
+    exprs = ExpirationDateCache.resolve_sets(
+        config.crypto_tickers, ExpirationDateCache.sweep_retry_count
+    )
+    unresolved = sum(1 for expr_set in exprs.values() if not expr_set)
+    expected = sum(len(expr_set) for expr_set in exprs.values()) + unresolved
+    if not (sweep := Sweep.begin(timestamp, expected)):
+        return None
+
+    with sweep.abort_on_error():
+        if unresolved:
+            sweep.record(failed=unresolved)
+        queue_sweep(sweep, queues, exprs)
+    return timestamp
+
+
+def queue_sweep(sweep, queues, exprs):
+    """
+    Queues the jobs of a begun sweep, exprs: {ticker: [expr, ...]}
+    """
+    timestamp = sweep.id
+    queue = queues[ScrapePlan.default_queue]
+    tickers = [ticker for ticker, expr_set in exprs.items() if expr_set]
+
+    PriceSnapshot.take(timestamp, tickers)
+
+    # one tracked job per ticker / expiration (scrape or shard merge) reports to the sweep
+    tracked = {
+        "meta": {"sweep": timestamp},
+        "on_success": Callback(on_job_success),
+        "on_failure": Callback(on_job_failure),
+    }
+
+    # longest first, see ScrapePlan
+    plan = ScrapePlan(timestamp, {ticker: exprs[ticker] for ticker in tickers})
+    jobs, shards = [], defaultdict(dict)
+    for position, (ticker, expr, option_type, _) in enumerate(plan.jobs()):
+        job = queues[plan.queue_name(position)].enqueue(
             scrape_ticker_job.scrape_ticker_job,
-            args=(ticker, timestamp),
-            result_ttl=0,
+            args=(ticker, timestamp, expr, option_type),
+            result_ttl=_SCRAPE_RESULT_TTL,
             retry=Retry(max=2),
+            **({} if option_type else tracked),
+        )
+        if option_type:
+            shards[(ticker, expr)][option_type] = job
+        else:
+            jobs.append(job)
+
+    # sharded chains are stored once all their shards are scraped
+    for (ticker, expr), shard_jobs in shards.items():
+        jobs.append(
+            queues[ScrapePlan.high_priority_queue].enqueue(
+                merge_shards_job.merge_shards_job,
+                args=(ticker, timestamp, list(shard_jobs), expr),
+                depends_on=Dependency(
+                    jobs=list(shard_jobs.values()), allow_failure=True
+                ),
+                result_ttl=_SCRAPE_RESULT_TTL,
+                **tracked,
+            )
+        )
+
+    # bulk write everything the sweep buffered once all scrapes are done
+    queue.enqueue(
+        flush_documents_job.flush_documents_job,
+        depends_on=Dependency(jobs=jobs, allow_failure=True),
+        result_ttl=0,
+    )
+
+    # anomalies flagged by the sweep's scrapes go out in batched messages
+    if AnomalyDetector.enabled():
+        queue.enqueue(
+            send_alerts_job.send_alerts_job,
+            depends_on=Dependency(jobs=jobs, allow_failure=True),
+            result_ttl=0,
         )
 
 
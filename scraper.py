@@ -5,13 +5,29 @@ import os
 import sys
 import time
 from datetime import datetime, date
-from pprint import pprint  # pylint: disable=unused-import
+from pprint import pprint
+from rq import Queue, Worker
 
+import helpers.async_helpers as ah
+import helpers.cache_helpers as cah
+import helpers.chain_helpers as ch
 import helpers.date_helpers as dh
+import helpers.export_helpers as exh
 import helpers.hood_helpers as hood
+import helpers.redis_helpers as redh
+import helpers.retry_helpers as rth
 
+from models.anomaly_detector import AnomalyDetector
+from models.catalog import Catalog
 from models.expiration_date_cache import ExpirationDateCache
 from models.option import Option
+from models.option_writer import OptionWriter
+from models.price_snapshot import PriceSnapshot
+from models.raw_option import RawOption
+from models.scrape_plan import ScrapePlan
+from models.strike_rollup import StrikeRollup
+from models.sweep import Sweep, lag
+from workers.flush_documents_job import flush_documents_job
 
 
 def read_csv(file_path, delimiter="\t"):
@@ -38,22 +54,122 @@ class OptionsScraper:
 
     # scrape attempts assuming network/rate limit/etc errors
     retry_count = 8
-    retry_sleep = 10.1
+
+    # raw: entire option API JSON per document (v1)
+    # compact: pruned numeric arrays per snapshot, raw JSON optional in RawOption
+    # delta: compact keyframe every keyframe_interval sweeps, changes in between
+    storage = config.setting("storage", "mode", default="raw")
+    keep_raw = config.setting("storage", "keep_raw", default=False)
+    keyframe_interval = config.setting("storage", "keyframe_interval", default=30)
+
+    # per contract volume / open interest outliers, see AnomalyDetector
+    anomaly_detection = config.LazyAttribute(AnomalyDetector.enabled)
 
     # blocking scrape not utilizing background workers
     @classmethod
     def exec_blocking(cls):
-        exprs = ExpirationDateCache.get_all_exprs()
         timestamp = str(round(datetime.timestamp(datetime.utcnow())))
-        db = config.mongo_client()
+        ticker_exprs = cls.ticker_exprs()
+        if not (sweep := Sweep.begin(timestamp, len(ticker_exprs))):
+            return
+        with sweep.abort_on_error():
+            snapshot = PriceSnapshot.take(timestamp, config.crypto_tickers)
+            writer = OptionWriter()
+
+            for ticker, expr in ticker_exprs:
+                # expiration couldn't be resolved, see ticker_exprs
+                if not expr:
+                    sweep.record(failed=1)
+                    continue
+                try:
+                    scraper = cls(ticker, expr, timestamp, None, snapshot, writer)
+                    if scraper.scrape():
+                        sweep.record(completed=1)
+                        continue
+                except Exception as err:  # pylint: disable=broad-exception-caught
+                    print(f"Failed to scrape {ticker}: {err=}, {type(err)=}")
+                sweep.record(failed=1)
+
+            writer.flush()
+            if cls.anomaly_detection:
+                AnomalyDetector.send_alerts()
+            cah.print_cache_stats()
+
+    # concurrent scrape in a single process, see AsyncChainFetcher
+    @classmethod
+    def exec_concurrent(cls):
+        timestamp = str(round(datetime.timestamp(datetime.utcnow())))
+        ticker_exprs = cls.ticker_exprs()
+        if not (sweep := Sweep.begin(timestamp, len(ticker_exprs))):
+            return
+        with sweep.abort_on_error():
+            snapshot = PriceSnapshot(timestamp)
+            writer = OptionWriter()
+
+            scrapers = {
+                (ticker, expr): cls(ticker, expr, timestamp, None, snapshot, writer)
+                for ticker, expr in ticker_exprs
+                if expr
+            }
+            completed = 0
+            chain_ids = {
+                ticker: ExpirationDateCache.chain_id(ticker) for ticker, _ in scrapers
+            }
+
+            for attempt in range(cls.retry_count):
+                if not scrapers:
+                    break
+                if rth.api_breaker.is_open():
+                    print("Circuit open, aborting sweep")
+                    break
+
+                prices, chains = ah.fetch_chains(
+                    list(scrapers),
+                    ch.KEPT_FIELDS if cls.streaming() else None,
+                    chain_ids,
+                )
+                # first quotes received win so retried tickers keep the sweep's price
+                snapshot.save(prices, overwrite=False)
+
+                for ticker_expr, chain in chains.items():
+                    if isinstance(chain, Exception):
+                        rth.record_failure(chain)
+                        continue
+                    if not chain:
+                        continue
+                    scraper = scrapers[ticker_expr]
+                    if not (sorted_chain := scraper.process_chain(chain)):
+                        continue
+                    scraper.store(sorted_chain)
+                    sweep.record(completed=1)
+                    completed += 1
+                    del scrapers[ticker_expr]
+
+                if scrapers and attempt < cls.retry_count - 1:
+                    time.sleep(rth.backoff_delay(attempt))
+
+            # expirations never scraped, tickers without expiration
+            sweep.record(failed=len(ticker_exprs) - completed)
+            writer.flush()
+            if cls.anomaly_detection:
+                AnomalyDetector.send_alerts()
+            cah.print_cache_stats()
 
-        for ticker in config.crypto_tickers:
-            try:
-                scraper = cls(ticker, exprs.get(ticker), timestamp, db)
-                scraper.scrape()
-            except Exception:  # pylint: disable=broad-exception-caught
-                # TODO: add some logging
-                pass
+    @classmethod
+    def ticker_exprs(cls):
+        """
+        [(ticker, expr)] to scrape, every expiration of a ticker is one
+        tracked job of the sweep (None: expiration couldn't be resolved).
+        Resolved before the sweep takes its lock, with a small retry budget
+        """
+        exprs = ExpirationDateCache.resolve_sets(
+            config.crypto_tickers, ExpirationDateCache.sweep_retry_count
+        )
+        return [
+            (ticker, expr)
+            for ticker in config.crypto_tickers
+            for expr in exprs.get(ticker) or [None]
+        ]
 
     def __init__(
         self,
@@ -61,46 +177,151 @@ class OptionsScraper:
         expr,
         scrape_start_timestamp=None,
         client=None,
+        price_snapshot=None,
+        writer=None,
+        option_type=None,
     ):
+        """
+        option_type: scrape only calls / puts, a shard of a big chain
+        which is stored by merge_shards once every shard is scraped
+        """
         self.ticker = ticker
-        self.expr = expr or ExpirationDateCache(ticker).get_expr()
+        self.option_type = option_type
+        self.expr = expr
 
         self.price = 0
+        self.chain_arrays = None
+        self.compact = None
 
         self.scrape_start_timestamp = scrape_start_timestamp
-
-        self.option_collection = (
-            Option(client[config.conf.mongo.database]) if client else None
+        self.price_snapshot = price_snapshot or PriceSnapshot(scrape_start_timestamp)
+
+        # scrapers sharing a writer leave flushing to its owner
+        self.owns_writer = writer is None
+        self.writer = writer or (
+            OptionWriter(database=client[config.conf.mongo.database])
+            if client
+            else None
         )
 
     def scrape(self):
         if not (self.ticker and self.expr):
             return None
 
-        for _ in range(self.retry_count):
-            if not (res := hood.get_option_chain(self.ticker, self.expr)):
-                time.sleep(self.retry_sleep)
-                continue
-            if not (sorted_chain := self.process_chain(res)):
-                time.sleep(self.retry_sleep)
-                continue
-            if self.option_collection:
-                self.insert_options_to_db(sorted_chain)
+        started = time.monotonic()
+        sorted_chain = rth.call_with_retry(
+            self.fetch_chain,
+            retry_count=self.retry_count,
+            # a shard (e.g. every put) can be empty, only None is a failure
+            accept=(lambda res: res is not None) if self.option_type else bool,
+        )
+        if sorted_chain is None:
+            return None
+
+        # job costs for the next sweep's ScrapePlan
+        if self.scrape_start_timestamp:
+            redh.add_job_cost(
+                self.scrape_start_timestamp,
+                self.ticker,
+                self.expr,
+                len(self.chain_arrays),
+                time.monotonic() - started,
+            )
+
+        if self.option_type:
+            redh.set_shard(
+                self.scrape_start_timestamp,
+                self.ticker,
+                self.expr,
+                self.option_type,
+                sorted_chain,
+            )
             return True
 
-        return None
+        self.store(sorted_chain)
+        return True
 
-    def process_chain(self, chain):
-        if not (price := hood.get_price(self.ticker)):
+    def merge_shards(self, option_types):
+        """
+        Stores the chain of every shard's options, nothing when a
+        shard is missing (None) so partial chains are never stored.
+        Empty shards ([]) were scraped and are merged
+        """
+        shards = redh.pop_shards(
+            self.scrape_start_timestamp, self.ticker, self.expr, option_types
+        )
+        if any(shard is None for shard in shards.values()):
+            print(f"Missing shards of {self.ticker}, skipping")
+            return None
+
+        chain = [option for t in option_types for option in shards[t]]
+        if not (sorted_chain := self.process_chain(chain)):
+            return None
+
+        self.store(sorted_chain)
+        return True
+
+    def store(self, sorted_chain):
+        if self.writer:
+            self.insert_options_to_db(sorted_chain)
+            if self.owns_writer:
+                self.writer.flush()
+        self.observe_anomalies(sorted_chain)
+
+    @classmethod
+    def streaming(cls):
+        """
+        compact / delta documents only need chain_helpers.KEPT_FIELDS
+        so chains are streamed and projected page by page. keep_raw
+        needs the full API JSON so it fetches whole chains
+        """
+        return cls.storage in ["compact", "delta"] and not cls.keep_raw
+
+    def fetch_chain(self):
+        if self.streaming():
+            return self.process_chain(
+                hood.iter_option_chain(
+                    self.ticker,
+                    self.expr,
+                    option_type=self.option_type,
+                    chain_id=ExpirationDateCache.chain_id(self.ticker),
+                )
+            )
+
+        if (
+            res := hood.get_option_chain(self.ticker, self.expr, self.option_type)
+        ) is None:
+            return None
+        return self.process_chain(res)
+
+    def compact_chain(self, chain):
+        """
+        compact chain of the last processed chain, computed once
+        """
+        if self.compact is None:
+            # not `self.chain_arrays or chain`: an empty ChainArrays is falsy
+            self.compact = ch.compact_chain(
+                chain if self.chain_arrays is None else self.chain_arrays
+            )
+        return self.compact
+
+    def observe_anomalies(self, chain):
+        if self.anomaly_detection and self.scrape_start_timestamp:
+            AnomalyDetector(self.ticker, self.expr).observe(
+                self.scrape_start_timestamp, self.compact_chain(chain)
+            )
+
+    def process_chain(self, chain, price=None):
+        if not (price := price or self.price_snapshot.get(self.ticker)):
             return None
 
         self.price = float(price)
-        return sorted(chain, key=lambda x: abs(self.price - float(x["strike_price"])))
+        self.chain_arrays = ch.ChainArrays(chain)
+        self.compact = None
+        return self.chain_arrays.sorted_by_atm(self.price)
 
     # v2 TODO:
     # 1. move to model
-    # 2. prune properties
-    # 3. batch insert or move to low priority background worker
     def insert_options_to_db(self, chain):
         """
         v1: Currently shoving entire option JS returned by hood API,
@@ -116,13 +337,24 @@ class OptionsScraper:
         - expiration (ISO8601 date str)
         - price (float)
         - expires_at (datetime)
-        - absolute_seconds_remaining (int)
-        - market_seconds_remaining (int)
+        - absolute_seconds_remaining (float, as of scraper_timestamp)
+        - market_seconds_remaining (int, as of scraper_timestamp)
         - created_at (datetime)
         - options (array of dict JSON responses HOOD API returns)
+
+        compact storage replaces options with:
+
+        - chain (strikes array + per type numeric arrays, see chain_helpers.compact_chain)
+
+        delta storage stores chain on keyframes only, otherwise:
+
+        - keyframe (bool)
+        - keyframe_timestamp (scraper_timestamp of the keyframe)
+        - prev_timestamp (scraper_timestamp the delta applies to)
+        - delta (changed contracts / fields, see chain_helpers.diff_compact)
         """
 
-        if self.scrape_start_timestamp and self.option_collection:
+        if self.scrape_start_timestamp and self.writer:
             document = {
                 "scraper_timestamp": self.scrape_start_timestamp,
                 "scraper_iso_date": date.fromtimestamp(
@@ -131,24 +363,129 @@ class OptionsScraper:
                 "ticker": self.ticker,
                 "expiration": self.expr,
                 "price": float(self.price),
-                "expires_at": dh.market_closes_at(self.expr),
-                "absolute_seconds_remaining": dh.absolute_seconds_until_expr(self.expr),
-                "market_seconds_remaining": dh.market_seconds_until_expr(self.expr),
+                **dh.expr_time_context(self.expr, self.scrape_start_timestamp),
                 "created_at": datetime.utcnow(),
-                "options": chain,
             }
-            self.option_collection.create(document)
+
+            if self.storage not in ["compact", "delta"]:
+                self.writer.add(document | {"options": chain})
+                return
+
+            compact = self.compact_chain(chain)
+            if self.storage == "compact":
+                self.writer.add(document | {"chain": compact})
+            else:
+                self.writer.add(document | self.delta_properties(compact))
+            if self.keep_raw:
+                self.writer.add(
+                    {
+                        "scraper_timestamp": self.scrape_start_timestamp,
+                        "ticker": self.ticker,
+                        "expiration": self.expr,
+                        "options": chain,
+                    },
+                    RawOption,
+                )
+
+    def delta_properties(self, compact):
+        """
+        Diffs compact against the ticker / expiration's previous
+        snapshot (kept in redis) or starts a new keyframe. The
+        previous snapshot must have been written (see
+        OptionWriter.write_batch), a lost document forces a keyframe
+        instead of breaking every later delta
+        """
+        timestamp = self.scrape_start_timestamp
+        state = redh.get_delta_state(self.ticker, self.expr)
+
+        diff = None
+        if (
+            state
+            and state["count"] < self.keyframe_interval
+            and state["stored"] == str(state["timestamp"])
+        ):
+            diff = ch.diff_compact(state["chain"], compact)
+
+        if diff is None:
+            redh.set_delta_state(
+                self.ticker,
+                self.expr,
+                {
+                    "timestamp": timestamp,
+                    "keyframe": timestamp,
+                    "count": 0,
+                    "chain": compact,
+                },
+            )
+            return {"keyframe": True, "keyframe_timestamp": timestamp, "chain": compact}
+
+        redh.set_delta_state(
+            self.ticker,
+            self.expr,
+            {
+                "timestamp": timestamp,
+                "keyframe": state["keyframe"],
+                "count": state["count"] + 1,
+                "chain": compact,
+            },
+        )
+        return {
+            "keyframe": False,
+            "keyframe_timestamp": state["keyframe"],
+            "prev_timestamp": state["timestamp"],
+            "delta": diff,
+        }
+
+
+def workers_running():
+    """
+    True if long lived workers (see workers command) are listening
+    """
+    connection = config.redis_client(decode_responses=False)
+    queue = Queue(ScrapePlan.default_queue, connection=connection)
+    return Worker.count(connection=connection, queue=queue) > 0
+
+
+def worker_pool_command(burst=True):
+    flags = f"-n {config.conf.workers} -w rq.worker.SimpleWorker"
+    if burst:
+        flags = f"-b {flags}"
+    queues = " ".join(ScrapePlan.queue_names())
+
+    if sys.platform != "darwin":
+        return f"rq worker-pool {flags} {queues} -u redis://:{config.conf.redis.password}@{config.conf.redis.host}:{config.conf.redis.port}/0"
+    return f"OBJC_DISABLE_INITIALIZE_FORK_SAFETY=YES rq worker-pool {flags} {queues}"
 
 
 if __name__ == "__main__":
     COMMANDS = [
         "scrape",
         "scrape-force",
+        "scrape-async",
+        "workers",
+        "sweeps",
         "populate-exprs",
         "purge-exprs",
+        "flush-writes",
+        "rebuild-catalog",
+        "rebuild-rollups",
     ]
+    if len(sys.argv) == 5 and sys.argv[1] == "export":
+        # python scraper.py export <ticker> <expiration> <path.npz>
+        _, _, ticker, expr, path = sys.argv
+        option = Option()
+        query = (
+            option.strikes_history
+            if OptionsScraper.storage == "delta"
+            else option.aggregate_strikes
+        )
+        with open(path, "wb") as f:
+            f.write(exh.to_npz(exh.chain_series(query(ticker, expr))))
+        sys.exit(0)
+
     if len(sys.argv) != 2 or sys.argv[1] not in COMMANDS:
         print(f"Usage: python scraper.py <{' / '.join(COMMANDS)}>")
+        print("       python scraper.py export <ticker> <expiration> <path.npz>")
         sys.exit(0)
 
     if sys.argv[1] in ["scrape", "scrape-force"]:
@@ -157,14 +494,28 @@ if __name__ == "__main__":
             sys.exit(0)
 
         os.system("python queue_jobs.py")
-        if sys.platform != "darwin":
-            os.system(
-                f"rq worker-pool -b {config.namespace} -n {config.conf.workers} -u redis://:{config.conf.redis.password}@{config.conf.redis.host}:{config.conf.redis.port}/0"
-            )
-        else:
-            os.system(
-                f"OBJC_DISABLE_INITIALIZE_FORK_SAFETY=YES rq worker-pool -b {config.namespace} -n {config.conf.workers}"
-            )
+
+        # long lived workers pick the sweep up, otherwise a burst pool runs it
+        if not workers_running():
+            os.system(worker_pool_command())
+        sys.exit(0)
+
+    if sys.argv[1] == "workers":
+        os.system(worker_pool_command(burst=False))
+        sys.exit(0)
+
+    if sys.argv[1] == "sweeps":
+        stats = [sweep.stats() for sweep in Sweep.recent()]
+        pprint(stats)
+        print(f"lag: {lag(stats)}")
+        sys.exit(0)
+
+    if sys.argv[1] == "scrape-async":
+        if not dh.is_market_open_now():
+            print("Market is closed")
+            sys.exit(0)
+
+        OptionsScraper.exec_concurrent()
         sys.exit(0)
 
     if sys.argv[1] == "populate-exprs":
@@ -174,3 +525,15 @@ if __name__ == "__main__":
     if sys.argv[1] == "purge-exprs":
         ExpirationDateCache.purge()
         sys.exit(0)
+
+    if sys.argv[1] == "rebuild-catalog":
+        Catalog.rebuild()
+        sys.exit(0)
+
+    if sys.argv[1] == "rebuild-rollups":
+        StrikeRollup.rebuild()
+        sys.exit(0)
+
+    if sys.argv[1] == "flush-writes":
+        print(f"Wrote {flush_documents_job()} documents")
+        sys.exit(0)
@@ -0,0 +1,17 @@
+import pathlib
+
+import yaml
+
+from config import config
+
+_CONFIG_DIR = pathlib.Path(__file__).parent.parent / "config"
+
+
+def _example(name):
+    with open(_CONFIG_DIR / f"{name}.yml.example", "r", encoding="utf-8") as f:
+        return yaml.safe_load(f)
+
+
+# example settings instead of config/settings.yml / vendors.yml,
+# config.conf is loaded lazily so assigning it first skips the YAML files
+config.conf = config.DictAsMember(_example("settings") | _example("vendors"))
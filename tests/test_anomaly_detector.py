@@ -0,0 +1,166 @@
+import json
+
+import pytest
+
+pytest.importorskip("requests")
+
+# pylint: disable=wrong-import-position
+import helpers.chain_helpers as ch
+from helpers import notification_helper as nh
+from helpers import redis_helpers as redh
+from models.anomaly_detector import AnomalyDetector, _realign
+
+
+@pytest.fixture(name="redis_state")
+def fixture_redis_state(monkeypatch):
+    """
+    anomaly states / alerts queue in memory instead of redis
+    """
+    states, alerts = {}, []
+
+    def set_anomaly_state(ticker, expr, state):
+        # round trip through JSON like redis does
+        states[(ticker, expr)] = json.loads(json.dumps(state))
+
+    def pop_alerts(count):
+        popped = alerts[:count]
+        del alerts[:count]
+        return popped
+
+    monkeypatch.setattr(redh, "get_anomaly_state", lambda t, e: states.get((t, e)))
+    monkeypatch.setattr(redh, "set_anomaly_state", set_anomaly_state)
+    monkeypatch.setattr(redh, "push_alerts", lambda *a: alerts.extend(a))
+    monkeypatch.setattr(redh, "pop_alerts", pop_alerts)
+    monkeypatch.setattr(AnomalyDetector, "min_samples", 5)
+    monkeypatch.setattr(AnomalyDetector, "stdev", 3)
+    monkeypatch.setattr(AnomalyDetector, "alpha", 0.1)
+    return states, alerts
+
+
+def _compact(volumes, strikes=(10, 20)):
+    """
+    call chain with cumulative volumes per strike, constant open interest
+    """
+    return ch.compact_chain(
+        [
+            {
+                "strike_price": str(strike),
+                "type": "call",
+                "volume": volume,
+                "open_interest": 100,
+            }
+            for strike, volume in zip(strikes, volumes)
+        ]
+    )
+
+
+def _steady(sweeps):
+    """
+    cumulative volumes growing 8 / 12 contracts per sweep on both strikes
+    """
+    return [(10 * n + 2 * (n % 2), 10 * n + 2 * (n % 2)) for n in range(sweeps)]
+
+
+def _observe(detector, volumes_per_sweep, start=1700000000, strikes=(10, 20)):
+    alerts = []
+    for n, volumes in enumerate(volumes_per_sweep):
+        alerts += detector.observe(start + n * 120, _compact(volumes, strikes))
+    return alerts
+
+
+def test_realign_on_changed_strikes():
+    res = _realign([1.0, 2.0, 3.0], [10, 20, 30], [10, 15, 30], fill=0)
+
+    assert res.tolist() == [1.0, 0.0, 3.0]
+
+
+def test_no_alerts_before_min_samples(redis_state):
+    _, alerts = redis_state
+
+    # a spike on the 3rd sweep, statistics aren't trusted yet
+    volumes = [(0, 0), (10, 10), (1000, 20)]
+    assert _observe(AnomalyDetector("MSTR", "2026-10-23"), volumes) == []
+    assert alerts == []
+
+
+def test_spike_is_flagged_and_queued(redis_state):
+    _, alerts = redis_state
+
+    # steady ~10 contracts per sweep on both strikes, then a spike on 20
+    volumes = _steady(12)
+    volumes.append((volumes[-1][0] + 10, volumes[-1][1] + 500))
+    flagged = _observe(AnomalyDetector("MSTR", "2026-10-23"), volumes)
+
+    assert len(flagged) == 1
+    assert flagged[0].startswith("MSTR 2026-10-23 20C volume +500")
+    assert alerts == flagged
+
+
+def test_volume_reset_is_a_new_session(redis_state):
+    # cumulative volume drops at the open: the change is the new volume
+    volumes = _steady(12) + [(10, 10)]
+    assert _observe(AnomalyDetector("MSTR", "2026-10-23"), volumes) == []
+
+
+def test_stale_snapshot_is_ignored(redis_state):
+    states, _ = redis_state
+    detector = AnomalyDetector("MSTR", "2026-10-23")
+    detector.observe(1700000120, _compact((10, 10)))
+    state = states[("MSTR", "2026-10-23")]
+
+    # replayed / out of order snapshots don't update statistics
+    assert detector.observe(1700000000, _compact((5000, 5000))) == []
+    assert states[("MSTR", "2026-10-23")] == state
+
+
+def test_new_strike_keeps_existing_statistics(redis_state):
+    states, _ = redis_state
+    detector = AnomalyDetector("MSTR", "2026-10-23")
+    _observe(detector, [(10 * n, 10 * n) for n in range(4)])
+
+    # a strike listed in between is aligned without shifting the others
+    detector.observe(1700001000, _compact((40, 5, 40), strikes=(10, 15, 20)))
+
+    stats = states[("MSTR", "2026-10-23")]["stats"]["call"]["volume"]
+    assert states[("MSTR", "2026-10-23")]["strikes"] == [10.0, 15.0, 20.0]
+    assert stats["n"] == [4, 0, 4]
+
+
+def test_send_alerts_drains_queue(redis_state, monkeypatch):
+    _, alerts = redis_state
+    alerts += [f"alert {n}" for n in range(5)]
+    monkeypatch.setattr(AnomalyDetector, "batch_size", 2)
+
+    class Notifier:
+        def __init__(self):
+            self.sent = []
+
+        def warn(self, message):
+            self.sent.append(message)
+
+        def flush(self):
+            pass
+
+    notifier = Notifier()
+    assert AnomalyDetector.send_alerts(notifier) == 5
+    assert notifier.sent == [f"alert {n}" for n in range(5)]
+    assert alerts == []
+
+
+def test_send_alerts_posts_each_batch_inline(redis_state, monkeypatch):
+    _, alerts = redis_state
+    alerts += [f"alert {n}" for n in range(5)]
+    monkeypatch.setattr(AnomalyDetector, "batch_size", 2)
+
+    posted = []
+    monkeypatch.setattr(
+        nh, "_post", lambda url, content, retry_count: posted.append(content) or True
+    )
+
+    notifier = nh.DiscordNotifier("https://discord.invalid/webhook", background=False)
+    assert AnomalyDetector.send_alerts(notifier) == 5
+
+    # one coalesced message per popped batch, no dispatcher thread
+    assert len(posted) == 3
+    assert "alert 4" in posted[-1]
+    assert not nh._dispatchers  # pylint: disable=protected-access
@@ -0,0 +1,206 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+requests = pytest.importorskip("requests")
+pytest.importorskip("robin_stocks")
+
+# pylint: disable=wrong-import-position
+from helpers import async_helpers as ah
+from helpers import retry_helpers as rth
+
+_EXPR = "2026-10-23"
+
+# contracts per ticker: two instruments pages, two marketdata batches
+_CONTRACTS = 25
+
+
+class FakeAPI(BaseHTTPRequestHandler):
+    """
+    quotes / instruments / options instruments (paginated) /
+    marketdata endpoints of the broker API, requests are recorded
+    """
+
+    requests = []
+    status = 200
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.requests.append((url.path, params))
+
+        if self.status != 200:
+            self.send_response(self.status)
+            self.send_header("Retry-After", "1")
+            self.end_headers()
+            return
+
+        handler = {
+            "/quotes/": self.quotes,
+            "/instruments/": self.instruments,
+            "/options/instruments/": self.option_instruments,
+            "/marketdata/options/": self.market_data,
+        }[url.path]
+        body = json.dumps(handler(params)).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def quotes(self, params):
+        return {
+            "results": [
+                {"symbol": s, "last_trade_price": "15.00"}
+                for s in params["symbols"].split(",")
+            ]
+        }
+
+    def instruments(self, params):
+        if params["symbol"] == "UNLISTED":
+            return {"results": []}
+        return {"results": [{"tradable_chain_id": f"chain-{params['symbol']}"}]}
+
+    def option_instruments(self, params):
+        ticker = params["chain_symbol"]
+        urls = [f"https://fake/options/{ticker}/{n}/" for n in range(_CONTRACTS)]
+        page = [
+            {"url": url, "expiration_date": params["expiration_dates"], "n": n}
+            for n, url in enumerate(urls)
+        ]
+        # other expirations the API may return are dropped by the fetcher
+        page.append({"url": "https://fake/other/", "expiration_date": "2099-01-01"})
+
+        if params.get("cursor"):
+            return {"results": page[20:], "next": None}
+        host = f"http://{self.headers['Host']}"
+        query = "&".join(f"{k}={v}" for k, v in params.items())
+        return {
+            "results": page[:20],
+            "next": f"{host}/options/instruments/?{query}&cursor=2",
+        }
+
+    def market_data(self, params):
+        return {
+            "results": [
+                {"instrument": url, "volume": 1}
+                for url in params["instruments"].split(",")
+            ]
+        }
+
+
+@pytest.fixture(name="api")
+def fixture_api(monkeypatch):
+    acquired, paused, failures = [], [], []
+    monkeypatch.setattr(rth.api_bucket, "acquire", lambda: acquired.append(1))
+    monkeypatch.setattr(rth.api_bucket, "pause", paused.append)
+    monkeypatch.setattr(rth.api_breaker, "record_failure", lambda: failures.append(1))
+    monkeypatch.setattr(FakeAPI, "requests", [])
+    monkeypatch.setattr(FakeAPI, "status", 200)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAPI)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with requests.Session() as session:
+            yield {
+                "session": session,
+                "api_url": f"http://127.0.0.1:{server.server_port}",
+                "acquired": acquired,
+                "paused": paused,
+                "failures": failures,
+            }
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _paths(path):
+    return [params for p, params in FakeAPI.requests if p == path]
+
+
+def test_fetch_chains(api):
+    ticker_exprs = [("MSTR", _EXPR), ("MSTR", "2026-10-30"), ("COIN", _EXPR)]
+
+    prices, chains = ah.fetch_chains(
+        ticker_exprs, session=api["session"], api_url=api["api_url"]
+    )
+
+    assert prices == {"MSTR": "15.00", "COIN": "15.00"}
+    assert set(chains) == set(ticker_exprs)
+    for chain in chains.values():
+        assert [o["n"] for o in chain] == list(range(_CONTRACTS))
+        assert all(o["volume"] == 1 for o in chain)
+
+    # one quote request, one chain id lookup per ticker shared by its expirations
+    assert _paths("/quotes/") == [{"symbols": "MSTR,COIN"}]
+    assert sorted(p["symbol"] for p in _paths("/instruments/")) == ["COIN", "MSTR"]
+
+    # both instruments pages, market data in batches of 20 instruments
+    assert len(_paths("/options/instruments/")) == 2 * len(ticker_exprs)
+    batches = [len(p["instruments"].split(",")) for p in _paths("/marketdata/options/")]
+    assert sorted(batches) == sorted([20, 5] * len(ticker_exprs))
+
+    # one rate limit token per HTTP request
+    assert len(api["acquired"]) == len(FakeAPI.requests)
+    assert not api["failures"]
+
+
+def test_fetch_chains_with_known_chain_ids_and_fields(api):
+    prices, chains = ah.fetch_chains(
+        [("MSTR", _EXPR)],
+        fields=["n"],
+        chain_ids={"MSTR": "chain-MSTR"},
+        session=api["session"],
+        api_url=api["api_url"],
+    )
+
+    assert prices == {"MSTR": "15.00"}
+    assert not _paths("/instruments/")
+    assert [o["n"] for o in chains[("MSTR", _EXPR)]] == list(range(_CONTRACTS))
+
+
+def test_fetch_chains_without_chain_id(api):
+    _, chains = ah.fetch_chains(
+        [("UNLISTED", _EXPR), ("MSTR", _EXPR)],
+        session=api["session"],
+        api_url=api["api_url"],
+    )
+
+    # a failed lookup fails the chain instead of returning an empty one
+    assert isinstance(chains[("UNLISTED", _EXPR)], ConnectionError)
+    assert len(chains[("MSTR", _EXPR)]) == _CONTRACTS
+    assert not [p for p in _paths("/options/instruments/") if "UNLISTED" in str(p)]
+
+
+def test_fetch_chains_http_error(api):
+    FakeAPI.status = 503
+
+    prices, chains = ah.fetch_chains(
+        [("MSTR", _EXPR)], session=api["session"], api_url=api["api_url"]
+    )
+
+    # failures are returned per chain, counted once per request
+    assert prices == {}
+    assert isinstance(chains[("MSTR", _EXPR)], requests.HTTPError)
+    assert len(api["failures"]) == len(FakeAPI.requests)
+    assert not api["paused"]
+
+
+def test_fetch_chains_rate_limited(api):
+    FakeAPI.status = 429
+
+    _, chains = ah.fetch_chains(
+        [("MSTR", _EXPR)], session=api["session"], api_url=api["api_url"]
+    )
+
+    # a 429 pauses the shared bucket for Retry-After seconds
+    assert isinstance(chains[("MSTR", _EXPR)], requests.HTTPError)
+    assert api["paused"] and all(seconds == 1.0 for seconds in api["paused"])
@@ -0,0 +1,31 @@
+from config import config
+
+
+def test_get_setting_walks_path_with_default(monkeypatch):
+    monkeypatch.setattr(
+        config, "conf", config.DictAsMember({"storage": {"mode": "delta"}})
+    )
+
+    assert config.get_setting("storage", "mode") == "delta"
+    assert config.get_setting("storage", "keep_raw", default=False) is False
+    assert config.get_setting("storage", "mode", "nested", default=1) == 1
+    assert config.get_setting("sharding", "max_contracts", default=2000) == 2000
+
+
+def test_setting_is_read_on_access(monkeypatch):
+    class Settings:
+        mode = config.setting("storage", "mode", default="raw")
+
+    monkeypatch.setattr(config, "conf", config.DictAsMember({}))
+    assert Settings.mode == "raw"
+
+    # settings loaded after the class was defined
+    monkeypatch.setattr(
+        config, "conf", config.DictAsMember({"storage": {"mode": "compact"}})
+    )
+    assert Settings.mode == "compact"
+
+    # instances can still override it
+    settings = Settings()
+    settings.mode = "delta"
+    assert settings.mode == "delta"
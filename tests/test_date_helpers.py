@@ -0,0 +1,122 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+pytest.importorskip("redis")
+pytest.importorskip("requests")
+
+# pylint: disable=wrong-import-position
+import helpers.date_helpers as dh
+
+# 2026-10-19 is a monday, 11-26 thanksgiving and 11-27 a half day
+_HOLIDAYS = {"2026-11-26"}
+_HALF_DAYS = {"2026-11-27"}
+
+
+def _market_hours(iso_date):
+    """
+    synthetic market hours: 14:30 - 21:00 UTC on weekdays, 18:00 close on half days
+    """
+    d = date.fromisoformat(iso_date)
+    if d.weekday() >= 5 or iso_date in _HOLIDAYS:
+        return {"is_open": False, "opens_at": None, "closes_at": None}
+    closes_at = "18:00" if iso_date in _HALF_DAYS else "21:00"
+    return {
+        "is_open": True,
+        "opens_at": f"{iso_date}T14:30:00Z",
+        "closes_at": f"{iso_date}T{closes_at}:00Z",
+    }
+
+
+@pytest.fixture(name="calendar")
+def fixture_calendar(monkeypatch):
+    """
+    empty process calendar loading synthetic hours, fetched dates are recorded
+    """
+    fetched = []
+
+    def get_market_hours(iso_date):
+        fetched.append(iso_date)
+        return _market_hours(iso_date)
+
+    monkeypatch.setattr(dh, "_market_calendar", None)
+    monkeypatch.setattr(dh.MarketCalendar, "from_cache", lambda: dh.MarketCalendar({}))
+    monkeypatch.setattr(dh, "get_market_hours", get_market_hours)
+    return fetched
+
+
+@pytest.mark.parametrize(
+    "dt_from, dt_to, seconds",
+    [
+        # within a session
+        (datetime(2026, 10, 19, 15), datetime(2026, 10, 19, 16), 3600),
+        # before the open / after the close only count the session
+        (datetime(2026, 10, 19, 9), datetime(2026, 10, 19, 23), 6.5 * 3600),
+        # friday's last hour + monday's first hour
+        (datetime(2026, 10, 16, 20), datetime(2026, 10, 19, 15, 30), 7200),
+        # wednesday's last hour, thanksgiving, friday's half day
+        (datetime(2026, 11, 25, 20), datetime(2026, 11, 30, 14, 30), 3600 + 12600),
+        (datetime(2026, 10, 19, 16), datetime(2026, 10, 19, 15), 0),
+    ],
+)
+def test_market_seconds_between(calendar, dt_from, dt_to, seconds):
+    assert dh.market_seconds_between(dt_from, dt_to) == seconds
+
+
+def test_calendar_is_reused_once_it_covers_dates(calendar):
+    dh.market_seconds_between(datetime(2026, 10, 12), datetime(2026, 10, 23))
+    fetched = len(calendar)
+
+    dh.market_seconds_between(datetime(2026, 10, 14), datetime(2026, 10, 20))
+
+    assert fetched == 12
+    assert len(calendar) == fetched
+
+
+def test_open_days_skip_weekends_and_holidays(calendar):
+    cal = dh.market_calendar(date(2026, 11, 23), date(2026, 11, 30))
+
+    # monday to monday: thanksgiving and the weekend are closed
+    assert cal.open_days_between(date(2026, 11, 23), date(2026, 11, 30)) == 4
+
+
+@pytest.mark.parametrize(
+    "seconds, dt_to, expected",
+    [
+        (1800, datetime(2026, 10, 19, 16), datetime(2026, 10, 19, 15, 30)),
+        # across the weekend
+        (7200, datetime(2026, 10, 19, 15, 30), datetime(2026, 10, 16, 20)),
+        # across the half day and thanksgiving
+        (16200, datetime(2026, 11, 30, 14, 30), datetime(2026, 11, 25, 20)),
+    ],
+)
+def test_remaining_market_seconds_to_datetime(calendar, seconds, dt_to, expected):
+    res = dh.remaining_market_seconds_to_datetime(seconds, dt_to)
+
+    assert res.replace(tzinfo=None) == expected
+    assert dh.market_seconds_between(res.replace(tzinfo=None), dt_to) == seconds
+
+
+def test_remaining_market_seconds_lookback_is_bounded(calendar, monkeypatch):
+    monkeypatch.setattr(dh, "_MAX_LOOKBACK_DAYS", 60)
+
+    # more market seconds than 60 days hold
+    with pytest.raises(ValueError):
+        dh.remaining_market_seconds_to_datetime(
+            45 * 6.5 * 3600, datetime(2026, 10, 19, 16)
+        )
+    assert all(d >= "2026-08-20" for d in calendar)
+
+
+def test_remaining_market_seconds_without_hours(calendar, monkeypatch):
+    monkeypatch.setattr(dh, "_MAX_LOOKBACK_DAYS", 60)
+    fetched = []
+    monkeypatch.setattr(
+        dh, "get_market_hours", lambda iso_date: fetched.append(iso_date)
+    )
+
+    # hours that can't be fetched aren't indexed as closed days, the
+    # lookback doubles (7, 14, 28, 56 days) and gives up past the bound
+    with pytest.raises(ValueError):
+        dh.remaining_market_seconds_to_datetime(3600, datetime(2026, 10, 19, 16))
+    assert min(fetched) == (date(2026, 10, 19) - timedelta(56)).isoformat()
@@ -0,0 +1,14 @@
+import pytest
+
+pytest.importorskip("robin_stocks")
+
+# pylint: disable=wrong-import-position
+import helpers.hood_helpers as hood
+
+
+def test_iter_option_chain_without_chain_id(monkeypatch):
+    monkeypatch.setattr(hood, "_chain_id", lambda ticker: None)
+
+    # an empty chain would be stored as a complete one
+    with pytest.raises(ConnectionError):
+        list(hood.iter_option_chain("MSTR", "2026-10-23"))
@@ -0,0 +1,376 @@
+import copy
+
+import pytest
+
+pymongo = pytest.importorskip("pymongo")
+
+# pylint: disable=wrong-import-position
+import helpers.chain_helpers as ch
+from config import config
+from models.option import Option, _snapshot_filter, _stored
+
+
+def _matches(doc, query):
+    for field, condition in (query or {}).items():
+        value = doc.get(field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for op, operand in condition.items():
+            if op == "$exists" and (field in doc) != operand:
+                return False
+            if op in ["$gt", "$gte", "$lt", "$lte"] and value is None:
+                return False
+            if op == "$gt" and not value > operand:
+                return False
+            if op == "$gte" and not value >= operand:
+                return False
+            if op == "$lt" and not value < operand:
+                return False
+            if op == "$lte" and not value <= operand:
+                return False
+    return True
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, field, direction):
+        self.docs.sort(key=lambda d: d[field], reverse=direction < 0)
+        return self
+
+    def limit(self, limit):
+        if limit:
+            self.docs = self.docs[:limit]
+        return self
+
+    def __iter__(self):
+        return iter(self.docs)
+
+
+class FakeCollection:
+    """
+    find / find_one over a list of documents (projections are ignored)
+    """
+
+    def __init__(self, docs, indexes=None):
+        self.docs = docs
+        self.indexes = indexes or {}
+
+    def create_index(self, keys, unique=False):
+        name = "_".join(f"{k}_{d}" for k, d in keys)
+        self.indexes[name] = {"key": keys, "unique": unique}
+        return name
+
+    def index_information(self):
+        return copy.deepcopy(self.indexes)
+
+    def drop_index(self, name):
+        del self.indexes[name]
+
+    def find(self, query=None, projection=None):  # pylint: disable=unused-argument
+        return FakeCursor([copy.deepcopy(d) for d in self.docs if _matches(d, query)])
+
+    def find_one(self, query=None, projection=None):
+        return next(iter(self.find(query, projection)), None)
+
+
+class FakeDatabase(dict):
+    name = "test"
+
+
+def _option(strike, option_type, volume, open_interest):
+    return {
+        "strike_price": str(strike),
+        "type": option_type,
+        "volume": volume,
+        "open_interest": open_interest,
+    }
+
+
+def _compact(volume):
+    return ch.compact_chain(
+        [
+            _option(10, "call", volume, 100),
+            _option(10, "put", 1, 50),
+            _option(20, "call", volume * 2, 200),
+        ]
+    )
+
+
+def _delta_docs(volumes):
+    """
+    keyframe followed by deltas, one snapshot per volume
+    """
+    docs, prev = [], None
+    for n, volume in enumerate(volumes):
+        timestamp = str(1700000000 + n * 120)
+        doc = {"ticker": "MSTR", "expiration": "2026-10-23", "price": 15.0}
+        doc["scraper_timestamp"] = timestamp
+        compact = _compact(volume)
+        if prev is None:
+            doc |= {"keyframe": True, "keyframe_timestamp": timestamp, "chain": compact}
+        else:
+            doc |= {
+                "keyframe": False,
+                "keyframe_timestamp": docs[0]["scraper_timestamp"],
+                "prev_timestamp": prev["scraper_timestamp"],
+                "delta": ch.diff_compact(_compact(volumes[n - 1]), compact),
+            }
+        docs.append(doc)
+        prev = doc
+    return docs
+
+
+def _option_model(docs):
+    return Option(FakeDatabase({Option.collection_name: FakeCollection(docs)}))
+
+
+def test_snapshot_filter_compares_timestamps_numerically():
+    _filter = _snapshot_filter(
+        "MSTR", "2026-10-23", from_ts=999999999, to_ts=1700000000
+    )
+
+    # stored as 10 digit strings, a 9 digit bound must not compare as "9..."
+    assert _filter["scraper_timestamp"] == {"$gte": "0999999999", "$lte": "1700000000"}
+
+
+def test_snapshot_filter_exact_timestamp():
+    _filter = _snapshot_filter("MSTR", "2026-10-23", "1700000000", from_ts=1)
+
+    assert _filter == {
+        "ticker": "MSTR",
+        "expiration": "2026-10-23",
+        "scraper_timestamp": "1700000000",
+    }
+
+
+def test_find_chains_rebuilds_deltas():
+    docs = _delta_docs([1, 2, 2, 5])
+
+    chains = [d["chain"] for d in _option_model(docs).find_chains()]
+
+    assert chains == [_compact(v) for v in [1, 2, 2, 5]]
+
+
+def test_find_chains_rebuilds_deltas_from_keyframe_lookup():
+    docs = _delta_docs([1, 2, 3, 4])
+
+    # the window starts after the keyframe, chain_at walks back to it
+    option = _option_model(docs)
+    chains = list(
+        option.find_chains(
+            {"scraper_timestamp": {"$gte": docs[2]["scraper_timestamp"]}}
+        )
+    )
+
+    assert [d["chain"] for d in chains] == [_compact(3), _compact(4)]
+
+
+def test_chain_at_missing_prev_document():
+    docs = _delta_docs([1, 2, 3])
+    del docs[1]
+
+    assert (
+        _option_model(docs).chain_at("MSTR", "2026-10-23", docs[1]["scraper_timestamp"])
+        is None
+    )
+
+
+def test_strikes_history_window_and_range():
+    docs = _delta_docs([1, 2, 3])
+
+    snapshots = list(
+        _option_model(docs).strikes_history(
+            "MSTR", "2026-10-23", from_ts=1700000120, strike_min=15
+        )
+    )
+
+    assert [s["scraper_timestamp"] for s in snapshots] == ["1700000120", "1700000240"]
+    assert [s["strikes"] for s in snapshots] == [
+        {20.0: {"call": {"volume": 4, "open_interest": 200}}},
+        {20.0: {"call": {"volume": 6, "open_interest": 200}}},
+    ]
+
+
+@pytest.fixture(name="mongo_db")
+def fixture_mongo_db():
+    """
+    throwaway database on the configured mongod, aggregation operators
+    ($convert, $range, ...) need a real server so tests skip without one
+    """
+    client = pymongo.MongoClient(
+        config.conf.mongo.host, config.conf.mongo.port, serverSelectionTimeoutMS=500
+    )
+    try:
+        client.admin.command("ping")
+    except pymongo.errors.PyMongoError as err:
+        client.close()
+        pytest.skip(f"no mongod at {config.conf.mongo.host}: {type(err).__name__}")
+
+    database = client["test_aggregate_strikes"]
+    try:
+        yield database
+    finally:
+        client.drop_database(database.name)
+        client.close()
+
+
+def _snapshots():
+    """
+    compact, raw and out of window snapshots of one ticker / expiration
+    """
+    doc = {"ticker": "MSTR", "expiration": "2026-10-23"}
+    return [
+        doc | {"scraper_timestamp": "1700000000", "price": 15.0, "chain": _compact(1)},
+        doc
+        | {
+            "scraper_timestamp": "1700000120",
+            "price": 16.0,
+            "options": [
+                _option(10, "call", 3, 100),
+                _option(15, "put", 2, 20),
+                _option(20, "call", 6, 200),
+            ],
+        },
+        doc
+        | {
+            "scraper_timestamp": "1700000240",
+            "price": 17.0,
+            "chain": ch.compact_chain([_option(30, "call", 1, 1)]),
+        },
+    ]
+
+
+def test_aggregate_strikes_groups_strikes(mongo_db):
+    option = Option(mongo_db)
+    option.create(_snapshots())
+
+    snapshots = list(option.aggregate_strikes("MSTR", "2026-10-23", strike_max=15))
+
+    assert snapshots == [
+        {
+            "scraper_timestamp": "1700000000",
+            "price": 15.0,
+            "strikes": {
+                10.0: {
+                    "call": {"volume": 1, "open_interest": 100},
+                    "put": {"volume": 1, "open_interest": 50},
+                }
+            },
+        },
+        {
+            "scraper_timestamp": "1700000120",
+            "price": 16.0,
+            "strikes": {
+                10.0: {"call": {"volume": 3, "open_interest": 100}},
+                15.0: {"put": {"volume": 2, "open_interest": 20}},
+            },
+        },
+        # no strike in the window
+        {"scraper_timestamp": "1700000240", "price": 17.0, "strikes": {}},
+    ]
+
+
+def test_aggregate_strikes_matches_strikes_history(mongo_db):
+    option = Option(mongo_db)
+    option.create(_snapshots())
+
+    for window in [{}, {"strike_min": 15}, {"strike_min": 10, "strike_max": 20}]:
+        assert list(option.aggregate_strikes("MSTR", "2026-10-23", **window)) == list(
+            option.strikes_history("MSTR", "2026-10-23", **window)
+        )
+
+
+def test_aggregate_strikes_drops_invalid_entries(mongo_db):
+    option = Option(mongo_db)
+    option.create(
+        {
+            "ticker": "MSTR",
+            "expiration": "2026-10-23",
+            "scraper_timestamp": "1700000000",
+            "price": 15.0,
+            "options": [
+                _option(10, "put", 2, None),
+                # unparsable strikes / unknown types
+                _option("", "call", 1, 1),
+                _option("n/a", "call", 1, 1),
+                _option(10, "future", 1, 1),
+            ],
+        }
+    )
+
+    assert [s["strikes"] for s in option.aggregate_strikes("MSTR", "2026-10-23")] == [
+        {10.0: {"put": {"volume": 2, "open_interest": 0}}}
+    ]
+
+
+def test_aggregate_strikes_pages_and_skips_deltas(mongo_db):
+    option = Option(mongo_db)
+    delta = _delta_docs([1, 2])[1] | {"scraper_timestamp": "1700000060"}
+    option.create(_snapshots() + [delta])
+
+    pages = [
+        [
+            s["scraper_timestamp"]
+            for s in option.aggregate_strikes(
+                "MSTR", "2026-10-23", after=after, limit=2
+            )
+        ]
+        for after in [None, 1700000120, 1700000240]
+    ]
+
+    # delta documents are left to strikes_history
+    assert pages == [["1700000000", "1700000120"], ["1700000240"], []]
+
+
+def test_ensure_index_migrates_legacy_unique_index(monkeypatch):
+    monkeypatch.setattr(Option, "indexed", set())
+    collection = FakeCollection(
+        [],
+        {
+            "ticker_1": {"key": [("ticker", 1)]},
+            "ticker_1_scraper_timestamp_1": {
+                "key": [("ticker", 1), ("scraper_timestamp", 1)],
+                "unique": True,
+            },
+        },
+    )
+
+    Option(FakeDatabase({Option.collection_name: collection})).ensure_index()
+
+    assert sorted(collection.indexes) == [
+        "ticker_1",
+        "ticker_1_expiration_1_scraper_timestamp_1",
+    ]
+    assert collection.indexes["ticker_1_expiration_1_scraper_timestamp_1"]["unique"]
+
+
+@pytest.mark.parametrize(
+    "write_error, stored",
+    [
+        (
+            {
+                "code": 11000,
+                "keyPattern": {"ticker": 1, "expiration": 1, "scraper_timestamp": 1},
+            },
+            True,
+        ),
+        ({"code": 11000, "keyPattern": {"_id": 1}}, True),
+        # the legacy index rejects another expiration of the same sweep
+        ({"code": 11000, "keyPattern": {"ticker": 1, "scraper_timestamp": 1}}, False),
+        (
+            {
+                "code": 11000,
+                "errmsg": "E11000 duplicate key error collection: db.options"
+                " index: ticker_1_scraper_timestamp_1 dup key: { ... }",
+            },
+            False,
+        ),
+        ({"code": 121, "errmsg": "Document failed validation"}, False),
+    ],
+)
+def test_only_full_key_duplicates_count_as_stored(write_error, stored):
+    assert _stored(write_error) is stored
@@ -0,0 +1,46 @@
+import pytest
+
+requests = pytest.importorskip("requests")
+
+# pylint: disable=wrong-import-position
+from helpers import retry_helpers as rth
+
+
+class FakeBreaker:
+    def __init__(self):
+        self.failures = 0
+
+    def is_open(self):
+        return False
+
+    def record_failure(self):
+        self.failures += 1
+
+
+def _failing(err):
+    def fn():
+        raise err
+
+    return fn
+
+
+@pytest.mark.parametrize(
+    "err, failures",
+    [
+        # counted by RateLimitedAdapter when the request was sent
+        (requests.ConnectionError("refused"), 0),
+        (requests.Timeout("timed out"), 0),
+        (requests.HTTPError("503 Server Error"), 0),
+        # the adapter can't see these
+        (ValueError("unparsable"), 3),
+        (ConnectionError("builtin"), 3),
+    ],
+)
+def test_call_with_retry_counts_each_failure_once(err, failures):
+    breaker = FakeBreaker()
+
+    assert (
+        rth.call_with_retry(_failing(err), retry_count=3, base=0, breaker=breaker)
+        is None
+    )
+    assert breaker.failures == failures
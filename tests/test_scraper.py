@@ -0,0 +1,160 @@
+import contextlib
+
+import pytest
+
+for module in ["pymongo", "requests", "rq"]:
+    pytest.importorskip(module)
+
+# pylint: disable=wrong-import-position
+import helpers.cache_helpers as cah
+import helpers.chain_helpers as ch
+import helpers.hood_helpers as hood
+import helpers.redis_helpers as redh
+import helpers.retry_helpers as rth
+import scraper as scraper_module
+from scraper import ExpirationDateCache, OptionsScraper
+
+
+def test_compact_chain_reuses_empty_chain_arrays():
+    scraper = OptionsScraper("MSTR", "2026-10-23")
+    scraper.chain_arrays = ch.ChainArrays([])
+
+    # an empty ChainArrays is falsy but must not be rebuilt from chain
+    assert scraper.compact_chain(["unparsable"]) == ch.ChainArrays([]).compact()
+
+
+@pytest.mark.parametrize(
+    "storage, keep_raw, streaming",
+    [
+        ("raw", False, False),
+        ("compact", False, True),
+        ("delta", False, True),
+        ("compact", True, False),
+        ("delta", True, False),
+    ],
+)
+def test_streaming(monkeypatch, storage, keep_raw, streaming):
+    monkeypatch.setattr(OptionsScraper, "storage", storage)
+    monkeypatch.setattr(OptionsScraper, "keep_raw", keep_raw)
+
+    # RawOption documents need unprojected API JSON
+    assert OptionsScraper.streaming() is streaming
+
+
+def _option(strike, option_type):
+    return {"strike_price": str(strike), "type": option_type, "volume": 1}
+
+
+@pytest.fixture(name="shard_scraper")
+def fixture_shard_scraper(monkeypatch):
+    scraper = OptionsScraper("MSTR", "2026-10-23", "1700000000")
+    monkeypatch.setattr(scraper.price_snapshot, "get", lambda ticker: "15")
+    monkeypatch.setattr(redh, "add_job_cost", lambda *args: None)
+    monkeypatch.setattr(rth.api_breaker, "is_open", lambda: False)
+
+    stored = []
+    monkeypatch.setattr(scraper, "store", stored.append)
+    return scraper, stored
+
+
+def test_merge_shards_with_empty_shard(shard_scraper, monkeypatch):
+    scraper, stored = shard_scraper
+    shards = {"call": [_option(10, "call"), _option(20, "call")], "put": []}
+    monkeypatch.setattr(redh, "pop_shards", lambda *args: shards)
+
+    # a genuinely empty shard (no puts listed) is merged
+    assert scraper.merge_shards(["call", "put"]) is True
+    assert sorted(o["strike_price"] for o in stored[0]) == ["10", "20"]
+
+
+def test_merge_shards_with_missing_shard(shard_scraper, monkeypatch):
+    scraper, stored = shard_scraper
+    shards = {"call": [_option(10, "call")], "put": None}
+    monkeypatch.setattr(redh, "pop_shards", lambda *args: shards)
+
+    assert scraper.merge_shards(["call", "put"]) is None
+    assert not stored
+
+
+def test_empty_shard_is_stored_as_empty(shard_scraper, monkeypatch):
+    scraper, _ = shard_scraper
+    scraper.option_type = "put"
+    monkeypatch.setattr(scraper, "fetch_chain", lambda: scraper.process_chain([]))
+
+    shards = {}
+    monkeypatch.setattr(
+        redh,
+        "set_shard",
+        lambda ts, t, e, option_type, chain: shards.update({option_type: chain}),
+    )
+
+    # no retries: an empty shard is a result, not a failure
+    assert scraper.scrape() is True
+    assert shards == {"put": []}
+
+
+def test_shard_without_chain_id_is_a_failure(shard_scraper, monkeypatch):
+    scraper, _ = shard_scraper
+    scraper.option_type = "put"
+    scraper.retry_count = 2
+    monkeypatch.setattr(OptionsScraper, "storage", "compact")
+    monkeypatch.setattr(OptionsScraper, "keep_raw", False)
+    monkeypatch.setattr(ExpirationDateCache, "chain_id", lambda ticker: None)
+    monkeypatch.setattr(hood, "_chain_id", lambda ticker: None)
+    monkeypatch.setattr(rth.api_breaker, "record_failure", lambda: None)
+    monkeypatch.setattr(rth.time, "sleep", lambda seconds: None)
+
+    shards = {}
+    monkeypatch.setattr(
+        redh,
+        "set_shard",
+        lambda ts, t, e, option_type, chain: shards.update({option_type: chain}),
+    )
+
+    # retried and failed instead of storing an empty put shard
+    assert scraper.scrape() is None
+    assert not shards
+
+
+class FakeSweep:
+    def __init__(self):
+        self.completed = self.failed = 0
+
+    @contextlib.contextmanager
+    def abort_on_error(self):
+        yield self
+
+    def record(self, completed=0, failed=0):
+        self.completed += completed
+        self.failed += failed
+
+
+def test_exec_blocking_skips_unresolved_expirations(monkeypatch):
+    sweep = FakeSweep()
+    monkeypatch.setattr(
+        OptionsScraper,
+        "ticker_exprs",
+        lambda: [("MSTR", "2026-10-23"), ("COIN", None), ("MSTR", "2026-10-30")],
+    )
+    monkeypatch.setattr(scraper_module.Sweep, "begin", lambda ts, expected: sweep)
+    monkeypatch.setattr(scraper_module.PriceSnapshot, "take", lambda *args: None)
+    monkeypatch.setattr(scraper_module.OptionWriter, "flush", lambda self: None)
+    monkeypatch.setattr(OptionsScraper, "anomaly_detection", False)
+    monkeypatch.setattr(cah, "print_cache_stats", lambda: None)
+
+    looked_up = []
+    monkeypatch.setattr(
+        ExpirationDateCache, "get_expr", lambda self: looked_up.append(self.ticker)
+    )
+
+    scraped = []
+    monkeypatch.setattr(
+        OptionsScraper, "scrape", lambda self: scraped.append(self.expr) or True
+    )
+
+    OptionsScraper.exec_blocking()
+
+    # unresolved expirations fail without another lookup
+    assert not looked_up
+    assert scraped == ["2026-10-23", "2026-10-30"]
+    assert (sweep.completed, sweep.failed) == (2, 1)
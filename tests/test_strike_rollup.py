@@ -0,0 +1,90 @@
+import pytest
+
+pytest.importorskip("pymongo")
+pytest.importorskip("redis")
+
+# pylint: disable=wrong-import-position
+import helpers.chain_helpers as ch
+from models import strike_rollup as sr
+
+
+class FakeCollection:
+    def __init__(self):
+        self.writes = []
+
+    def create_index(self, keys, unique=False):  # pylint: disable=unused-argument
+        return "_".join(f"{k}_{d}" for k, d in keys)
+
+    def bulk_write(self, ops, ordered=True):  # pylint: disable=unused-argument
+        self.writes.append(ops)
+
+
+class FakeDatabase(dict):
+    name = "test"
+
+
+def _doc(timestamp, volume):
+    return {
+        "ticker": "MSTR",
+        "expiration": "2026-10-23",
+        "scraper_timestamp": str(timestamp),
+        "chain": ch.compact_chain(
+            [
+                {
+                    "strike_price": "10",
+                    "type": "call",
+                    "volume": volume,
+                    "open_interest": 1,
+                }
+            ]
+        ),
+    }
+
+
+@pytest.fixture(name="rollup")
+def fixture_rollup(monkeypatch):
+    """
+    StrikeRollup over a fake collection, lock extensions answer from
+    `held` (one per call, the last one repeats) and saved states are recorded
+    """
+    collection = FakeCollection()
+    res = {"collection": collection, "held": [True], "saved": []}
+
+    def extend_rollup_lock(token):  # pylint: disable=unused-argument
+        return res["held"].pop(0) if len(res["held"]) > 1 else res["held"][0]
+
+    monkeypatch.setattr(sr.StrikeRollup, "indexed", set())
+    monkeypatch.setattr(sr.redh, "acquire_rollup_lock", lambda token: None)
+    monkeypatch.setattr(sr.redh, "release_rollup_lock", lambda token: None)
+    monkeypatch.setattr(sr.redh, "extend_rollup_lock", extend_rollup_lock)
+    monkeypatch.setattr(sr.redh, "get_rollup_states", lambda ticker_exprs: {})
+    monkeypatch.setattr(sr.redh, "set_rollup_states", res["saved"].append)
+    monkeypatch.setattr(sr.time, "sleep", lambda seconds: None)
+    res["database"] = FakeDatabase({sr.StrikeRollup.collection_name: collection})
+    return res
+
+
+def test_add_writes_and_saves_states(rollup):
+    assert sr.StrikeRollup.add([_doc(1700000000, 1)], rollup["database"]) == 1
+
+    assert len(rollup["collection"].writes) == 1
+    assert [list(states) for states in rollup["saved"]] == [[("MSTR", "2026-10-23")]]
+
+
+def test_add_doesnt_write_without_the_lock(rollup):
+    rollup["held"] = [False]
+
+    assert sr.StrikeRollup.add([_doc(1700000000, 1)], rollup["database"]) == 0
+
+    assert not rollup["collection"].writes
+    assert not rollup["saved"]
+
+
+def test_add_doesnt_save_states_once_the_lock_is_lost(rollup):
+    # held for the write, expired before the states are saved
+    rollup["held"] = [True, False]
+
+    sr.StrikeRollup.add([_doc(1700000000, 1)], rollup["database"])
+
+    assert len(rollup["collection"].writes) == 1
+    assert not rollup["saved"]
@@ -0,0 +1,7 @@
+from models.option import Option
+from models.option_writer import OptionWriter
+from models.raw_option import RawOption
+
+
+def flush_documents_job():
+    return sum(OptionWriter.flush_queued(model) for model in [Option, RawOption])
@@ -0,0 +1,8 @@
+from models.option_writer import OptionWriter
+from scraper import OptionsScraper
+
+
+def merge_shards_job(ticker, timestamp, option_types, expr=None):
+    return OptionsScraper(
+        ticker, expr, timestamp, writer=OptionWriter(queued=True)
+    ).merge_shards(option_types)
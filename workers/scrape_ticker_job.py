@@ -1,8 +1,16 @@
-from config import config
+from models.expiration_date_cache import ExpirationDateCache
+from models.option_writer import OptionWriter
 from scraper import OptionsScraper
 
 
-def scrape_ticker_job(ticker, timestamp):
-    mongo_client = config.mongo_client()
-    OptionsScraper(ticker, None, timestamp, mongo_client).scrape()
-    mongo_client.close()
+def scrape_ticker_job(ticker, timestamp, expr=None, option_type=None):
+    """
+    expr: resolved when the sweep is queued, looked up here if None
+    """
+    return OptionsScraper(
+        ticker,
+        expr or ExpirationDateCache(ticker).get_expr(),
+        timestamp,
+        writer=OptionWriter(queued=True),
+        option_type=option_type,
+    ).scrape()
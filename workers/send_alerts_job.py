@@ -0,0 +1,5 @@
+from models.anomaly_detector import AnomalyDetector
+
+
+def send_alerts_job():
+    return AnomalyDetector.send_alerts()
@@ -1,11 +1,67 @@
-from collections import defaultdict
-from flask import Flask, jsonify, request
+import functools
+import hashlib
+import json
+from datetime import datetime, timezone
+
+from flask import Flask, Response, jsonify, request, stream_with_context
+from models.catalog import Catalog
 from models.option import Option
+from models.strike_rollup import StrikeRollup
+from models.sweep import Sweep, lag
 from config import config
+from helpers import export_helpers as exh
+from helpers import redis_helpers as redh
+from helpers.general_helpers import key_join
 
 app = Flask(__name__)
 
 
+def _option_chains_mode():
+    """
+    default /option_chains mode, delta documents must be rebuilt
+    """
+    if config.get_setting("storage", "mode") == "delta":
+        return "rebuild"
+    return "aggregate"
+
+
+def cached_response(view):
+    """
+    Caches 200 responses in redis keyed by endpoint + query string
+    and versioned by the data version, which is bumped whenever a
+    sweep's documents are written. The version also makes the ETag
+    so conditional requests (If-None-Match) get a 304 without
+    touching mongo or the cached body. Streamed responses are
+    tagged but never cached
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        query = "&".join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+        key = key_join(redh.get_data_version(), request.path, query)
+        etag = hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+        if etag in request.if_none_match:
+            return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+        if (body := redh.get_cached_response(etag)) is None:
+            response = app.make_response(view(*args, **kwargs))
+            if response.is_streamed:
+                response.set_etag(etag)
+                return response
+            if response.status_code != 200:
+                return response
+            body = response.get_data(as_text=True)
+            redh.set_cached_response(etag, body)
+
+        response = Response(body, mimetype="application/json")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    return wrapper
+
+
 @app.route("/tickers")
 def tickers():
     res = {}
@@ -16,7 +72,59 @@ def tickers():
     return jsonify(res)
 
 
+def _timestamp_arg(name):
+    """
+    Query parameter as epoch seconds, given as epoch seconds or an
+    ISO 8601 date / datetime (UTC unless it has an offset). None if
+    missing, raises ValueError if unparsable
+    """
+    if not (value := request.args.get(name)):
+        return None
+    if value.isdigit():
+        return int(value)
+
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError as err:
+        raise ValueError(f"Invalid '{name}': {value}") from err
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def _snapshots(ticker, expr, timestamp=None, limit=0):
+    """
+    Snapshot generator for the option chain endpoints' common
+    parameters, raises ValueError for invalid ones
+    """
+    # unparsable values are ignored (no window)
+    strike_min = request.args.get("strike_min", type=float)
+    strike_max = request.args.get("strike_max", type=float)
+
+    # aggregate: reshaped inside mongo, rebuild: reshaped here (required for delta storage)
+    mode = request.args.get("mode") or _option_chains_mode()
+    if mode not in ["aggregate", "rebuild"]:
+        raise ValueError(f"Invalid 'mode': {mode}")
+    if mode == "aggregate" and _option_chains_mode() == "rebuild":
+        raise ValueError("mode=aggregate can't rebuild delta documents, use rebuild")
+
+    option = Option()
+    query = option.aggregate_strikes if mode == "aggregate" else option.strikes_history
+    return query(
+        ticker,
+        expr,
+        timestamp=timestamp,
+        from_ts=_timestamp_arg("from"),
+        to_ts=_timestamp_arg("to"),
+        strike_min=strike_min,
+        strike_max=strike_max,
+        after=_timestamp_arg("after"),
+        limit=limit,
+    )
+
+
 @app.route("/option_chains")
+@cached_response
 def option_chains():
     expr = request.args.get("expr") or request.args.get("expiration")
     ticker = request.args.get("ticker")
@@ -25,64 +133,113 @@ def option_chains():
     if not (expr and ticker):
         return jsonify("Missing required parameters 'expr' and/or 'ticker'"), 400
 
-    _filter = {"ticker": ticker, "expiration": expr}
-    if timestamp:
-        _filter["scraper_timestamp"] = timestamp
-
-    query = list(
-        Option()
-        .collection.find(
-            _filter,
-            {
-                "_id": 0,
-                "scraper_timestamp": 1,
-                "price": 1,
-                "options.type": 1,
-                "options.strike_price": 1,
-                "options.volume": 1,
-                "options.open_interest": 1,
-            },
+    # cursor pagination: pass the previous page's "next" as after
+    limit = request.args.get("limit", default=0, type=int)
+    if limit < 0:
+        return jsonify("Invalid 'limit': must be 0 (no limit) or more"), 400
+
+    try:
+        snapshots = _snapshots(ticker, expr, timestamp, limit)
+    except ValueError as err:
+        return jsonify(str(err)), 400
+
+    # one JSON line per snapshot, sent as each snapshot is read from mongo.
+    # mode=aggregate groups / sorts every matched snapshot before the first
+    # one is returned (bound it with limit), mode=rebuild streams from the start
+    if request.args.get("format") == "ndjson":
+        return Response(
+            stream_with_context(json.dumps(s) + "\n" for s in snapshots),
+            mimetype="application/x-ndjson",
         )
-        .sort("scraper_timestamp", 1)
-    )
 
     data = {}
-    for doc in query:
-        scraper_timestamp = doc.get("scraper_timestamp")
-        if not scraper_timestamp:
-            continue
-
-        data[scraper_timestamp] = {}
-        data[scraper_timestamp]["price"] = doc.get("price", 0)
-        data[scraper_timestamp]["strikes"] = defaultdict(dict)
-
-        for option in doc["options"]:
-            if not (strike := option.get("strike_price")):
-                continue
-
-            data[scraper_timestamp]["strikes"][float(strike)] |= {
-                option["type"]: {
-                    "volume": option.get("volume", 0),
-                    "open_interest": option.get("open_interest", 0),
-                }
-            }
+    for snapshot in snapshots:
+        data[snapshot["scraper_timestamp"]] = {
+            "price": snapshot["price"],
+            "strikes": snapshot["strikes"],
+        }
 
     res = {}
     res["ticker"] = ticker
     res["expiration"] = expr
     res["data"] = data
-    res["count"] = len(query)
+    res["count"] = len(data)
+    res["next"] = max(data) if limit and len(data) == limit else None
+    res["status"] = 200
+
+    return res
+
+
+@app.route("/option_chains/export")
+def option_chains_export():
+    """
+    Same data and parameters as /option_chains as a NumPy .npz of
+    timestamps x strikes matrices, see export_helpers.chain_series
+    """
+    expr = request.args.get("expr") or request.args.get("expiration")
+    ticker = request.args.get("ticker")
+
+    if not (expr and ticker):
+        return jsonify("Missing required parameters 'expr' and/or 'ticker'"), 400
+
+    timestamp = request.args.get("timestamp")
+    try:
+        snapshots = _snapshots(ticker, expr, timestamp)
+    except ValueError as err:
+        return jsonify(str(err)), 400
+
+    series = exh.chain_series(snapshots)
+    return Response(
+        exh.to_npz(series),
+        mimetype="application/octet-stream",
+        headers={"Content-Disposition": f"attachment; filename={ticker}_{expr}.npz"},
+    )
+
+
+@app.route("/rollups")
+@cached_response
+def rollups():
+    """
+    Per strike volume / open interest series with changes and
+    put / call ratios, see StrikeRollup
+    """
+    expr = request.args.get("expr") or request.args.get("expiration")
+    ticker = request.args.get("ticker")
+
+    if not (expr and ticker):
+        return jsonify("Missing required parameters 'expr' and/or 'ticker'"), 400
+
+    try:
+        from_ts, to_ts = _timestamp_arg("from"), _timestamp_arg("to")
+    except ValueError as err:
+        return jsonify(str(err)), 400
+
+    data = StrikeRollup().series(
+        ticker,
+        expr,
+        from_ts=from_ts,
+        to_ts=to_ts,
+        strike_min=request.args.get("strike_min", type=float),
+        strike_max=request.args.get("strike_max", type=float),
+    )
+
+    res = {}
+    res["ticker"] = ticker
+    res["expiration"] = expr
+    res["data"] = data
+    res["count"] = len(data)
     res["status"] = 200
 
     return res
 
 
 @app.route("/expirations")
+@cached_response
 def expirations():
-    query = Option().collection.distinct("expiration")
+    query = Catalog.expirations()
 
     res = {}
-    res["data"] = sorted(query)
+    res["data"] = query
     res["count"] = len(query)
     res["status"] = 200
 
@@ -90,22 +247,46 @@ def expirations():
 
 
 @app.route("/timestamps")
+@cached_response
 def timestamps():
     expr = request.args.get("expr") or request.args.get("expiration")
     if not expr:
         return jsonify("Missing required parameters 'expr'"), 400
 
-    query = Option().collection.find({"expiration": expr}).distinct("scraper_timestamp")
+    query = Catalog.timestamps(expr)
 
     res = {}
     res["expiration"] = expr
-    res["data"] = sorted(list(map(int, query)))
+    res["data"] = query
     res["count"] = len(query)
     res["status"] = 200
 
     return res
 
 
+@app.route("/sweeps")
+def sweeps():
+    count = request.args.get("count", default=10, type=int)
+    stats = [sweep.stats() for sweep in Sweep.recent(count)]
+
+    res = {}
+    res["data"] = [s for s in stats if s]
+    res["count"] = len(res["data"])
+    res["lag"] = lag(stats)
+    res["status"] = 200
+
+    return res
+
+
+@app.route("/pool_stats")
+def pool_stats():
+    res = {}
+    res["data"] = config.pool_stats()
+    res["status"] = 200
+
+    return res
+
+
 # # Uncomment if testing locally
 # @app.after_request
 # def add_header(response):